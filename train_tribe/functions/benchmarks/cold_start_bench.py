@@ -0,0 +1,126 @@
+# Measures what a cold instance pays before each function can run: importing main, then
+# the modules the handler imports on its first call. Every measurement runs in a fresh
+# interpreter, so nothing is shared between entry points or runs.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/cold_start_bench.py [--runs 5] [--only get_event_full_trip_data] [--output results.json]
+#   python benchmarks/cold_start_bench.py --budget-ms 1500
+#   python benchmarks/cold_start_bench.py --eager
+#
+# The entry points are the functions main.py exports; the modules of a handler are
+# read from its import statements, so the list follows the code, plus DEEPER_IMPORTS.
+# --eager also imports every pipeline module up front, the way main.py did before
+# imports were made lazy.
+# Creating the storage and Firestore clients needs credentials and is not measured.
+# With --budget-ms, entry points whose median cold start exceeds the budget are listed
+# and the exit status is 1.
+
+import argparse
+import dis
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules main.py imported at load time before the handlers imported them lazily
+EAGER_MODULES = ["jsonifier", "event_trip_options_manager", "friends_trains_index", "leg_payloads", "event_options_builder"]
+# Modules imported further down the call path of a handler, on its first real call
+DEEPER_IMPORTS = {
+    "firestore_event_trip_options_create": ["event_options_builder"],
+    "firestore_event_trip_options_update": ["event_options_builder"],
+}
+# Third-party libraries worth knowing about when they show up in a cold start
+HEAVY_MODULES = ["rapidfuzz", "pytz", "requests", "numpy", "google.cloud.storage", "google.cloud.firestore_v1"]
+
+
+def handler_imports(fn):
+    # Modules imported in the body of the handler, following the decorator wrappers
+    while hasattr(fn, "__wrapped__"):
+        fn = fn.__wrapped__
+    return [instruction.argval for instruction in dis.get_instructions(fn) if instruction.opname == "IMPORT_NAME"]
+
+
+def measure(entry_point, eager):
+    # Runs in the child interpreter
+    sys.path.insert(0, FUNCTIONS_DIR)
+    started = time.perf_counter()
+    import main
+    import_main = time.perf_counter() - started
+    if eager:
+        for module in EAGER_MODULES:
+            __import__(module)
+        import_main = time.perf_counter() - started
+
+    modules = handler_imports(getattr(main, entry_point)) + DEEPER_IMPORTS.get(entry_point, [])
+    started = time.perf_counter()
+    for module in modules:
+        __import__(module)
+    first_call = time.perf_counter() - started
+    return {
+        "import_main_ms": round(import_main * 1000, 2),
+        "handler_imports_ms": round(first_call * 1000, 2),
+        "total_ms": round((import_main + first_call) * 1000, 2),
+        "handler_modules": modules,
+        "modules_loaded": len(sys.modules),
+        "heavy_modules": [module for module in HEAVY_MODULES if module in sys.modules],
+    }
+
+
+def entry_points():
+    sys.path.insert(0, FUNCTIONS_DIR)
+    import main
+    # Functions registered with the Firebase decorators
+    return [name for name, value in vars(main).items() if callable(value) and hasattr(value, "__firebase_endpoint__")]
+
+
+def run_child(entry_point, eager):
+    command = [sys.executable, os.path.abspath(__file__), "--child", entry_point] + (["--eager"] if eager else [])
+    env = {**os.environ, "WARM_UP_ON_START": "false", "TRACE_SAMPLE_RATE": "0"}
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--only", action="append", help="entry point to measure (repeatable)")
+    parser.add_argument("--eager", action="store_true", help="import every pipeline module when main is imported")
+    parser.add_argument("--budget-ms", type=float)
+    parser.add_argument("--output")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.eager)))
+        return 0
+
+    results = {}
+    for entry_point in args.only or entry_points():
+        runs = [run_child(entry_point, args.eager) for _ in range(args.runs)]
+        results[entry_point] = {
+            "median_ms": round(statistics.median(run["total_ms"] for run in runs), 2),
+            "import_main_ms": round(statistics.median(run["import_main_ms"] for run in runs), 2),
+            "handler_imports_ms": round(statistics.median(run["handler_imports_ms"] for run in runs), 2),
+            "max_ms": max(run["total_ms"] for run in runs),
+            "handler_modules": runs[0]["handler_modules"],
+            "modules_loaded": runs[0]["modules_loaded"],
+            "heavy_modules": runs[0]["heavy_modules"],
+        }
+
+    report = {"python": sys.version.split()[0], "runs": args.runs, "eager": args.eager, "entry_points": results}
+    if args.budget_ms is not None:
+        report["over_budget"] = [name for name, result in results.items() if result["median_ms"] > args.budget_ms]
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    return 1 if report.get("over_budget") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# Runs many overlapping pipelines in one process, the way an instance with
+# concurrency > 1 would, and checks each output against a sequential run.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/concurrent_pipelines_stress.py [--pipelines 24] [--threads 12] [--jsonify 4]
+#
+# Runs fully offline: local storage backend, synthetic timetable, a stubbed
+# Directions endpoint and a stubbed GTFS download. Exits with status 1 if any
+# concurrent output differs from its sequential reference.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bucket_manager
+import jsonifier
+import maps_asker
+from directions_cache import clear_directions_cache
+from event_options_builder import build_event_options
+from leg_payloads import payload_routes
+from synthetic import FakeDownload, SyntheticDirections, generate_lines, station_name, write_gtfs_zip, write_trips_table
+from trips_cache import clear_trips_cache
+
+bucket_name = "stress-bucket"
+trips_path = "maps/full_info_trips.bin"
+
+
+def event_params(lines, n, run):
+    line = lines[n % len(lines)]
+    start = datetime(2026, 10, 19, 6, 0, tzinfo=timezone.utc) + timedelta(minutes=30 * (n % 8))
+    return {
+        "mode": "transit",
+        "transit_mode": "train",
+        "alternatives": "true",
+        "region": "it",
+        "origin": station_name(line[n % 3]).title(),
+        "destination": station_name(line[-1 - n % 4]).title(),
+        "event_start_time": start,
+        "event_end_time": start + timedelta(hours=2),
+        "key": "stress",
+        "maps_path": f"maps/responses/{run}_{n}",
+        "bucket_name": bucket_name,
+        "trips_path": trips_path,
+        "full_legs_path": f"maps/results/{run}_{n}",
+        "event_options_path": f"maps/events/{run}_{n}.json",
+        "max_concurrency": 4,
+    }
+
+
+def run_event_options(lines, n, run):
+    params = event_params(lines, n, run)
+    result = build_event_options(params)
+    return result["errors"], bucket_manager.get_json(bucket_name, params["event_options_path"])
+
+
+def run_jsonify(n, run):
+    result = jsonifier.jsonify({
+        "compact_output_path": f"maps/{run}_{n}_trips.bin",
+        "result_output_path": f"maps/{run}_{n}_trips.json",
+        "stops_output_path": f"maps/{run}_{n}_stops.json",
+        "bucket_name": bucket_name,
+    })
+    if not result["success"]:
+        return result["message"]
+    return [bucket_manager.get_bytes(bucket_name, f"maps/{run}_{n}_{name}")
+            for name in ("trips.bin", "trips.json", "stops.json")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipelines", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=12)
+    parser.add_argument("--jsonify", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bucket_manager.set_backend(bucket_manager.LocalBackend(workdir))
+        lines = generate_lines()
+        table_path = os.path.join(workdir, "trips.bin")
+        table = write_trips_table(table_path, lines)
+        bucket_manager.upload_to_bucket(table_path, trips_path, bucket_name)
+        zip_path = os.path.join(workdir, "feed.zip")
+        write_gtfs_zip(zip_path, lines)
+        with open(zip_path, 'rb') as f:
+            feed = FakeDownload(f.read())
+        directions = SyntheticDirections(table, latency=args.latency)
+
+        def fake_get(url, **kwargs):
+            # jsonify and maps_asker share the requests module, route by URL
+            return feed(url, **kwargs) if url == jsonifier.zip_url else directions(url, **kwargs)
+
+        with mock.patch.object(maps_asker.requests, "get", fake_get):
+            started = time.perf_counter()
+            reference = [run_event_options(lines, n, "sequential") for n in range(args.pipelines)]
+            reference_feed = run_jsonify(0, "sequential")
+            sequential_seconds = time.perf_counter() - started
+
+            # Cold Directions and trips caches, so the concurrent runs really overlap on the
+            # network path and all ask for the trips table at once
+            clear_directions_cache()
+            clear_trips_cache()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                options = [executor.submit(run_event_options, lines, n, "concurrent") for n in range(args.pipelines)]
+                feeds = [executor.submit(run_jsonify, n, "concurrent") for n in range(args.jsonify)]
+                options = [future.result() for future in options]
+                feeds = [future.result() for future in feeds]
+            concurrent_seconds = time.perf_counter() - started
+
+    mismatched = [n for n, (got, expected) in enumerate(zip(options, reference)) if got != expected or got[0]]
+    mismatched_feeds = [n for n, got in enumerate(feeds) if got != reference_feed]
+    print(json.dumps({
+        "pipelines": args.pipelines,
+        "jsonify_runs": args.jsonify,
+        "threads": args.threads,
+        "sequential_s": round(sequential_seconds, 3),
+        "concurrent_s": round(concurrent_seconds, 3),
+        "options": sum(len(payload_routes(got[1])) for got in options),
+        "slot_errors": sum(len(got[0]) for got in options),
+        "mismatched_pipelines": mismatched,
+        "mismatched_jsonify_runs": mismatched_feeds,
+    }, indent=2))
+    return 1 if mismatched or mismatched_feeds else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Measures build_event_options with sequential vs concurrent slot queries.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/event_options_concurrency_bench.py [--latency 0.3] [--hours 4] [--concurrency 1 4 8]
+#
+# Runs fully offline: local storage backend, synthetic timetable and a stubbed
+# Directions endpoint with the given per-request latency. The Directions cache (memory
+# and bucket) is cleared before every run, so each one makes all its queries. Checks
+# that every run produces the same event options as the sequential one.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bucket_manager
+import maps_asker
+from directions_cache import clear_directions_cache, directions_cache_partial_path
+from event_options_builder import build_event_options
+from leg_payloads import payload_routes
+from synthetic import SyntheticDirections, generate_lines, station_name, write_trips_table
+
+bucket_name = "benchmark-bucket"
+trips_path = "maps/full_info_trips.bin"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--hours", type=float, default=4)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bucket_manager.set_backend(bucket_manager.LocalBackend(workdir))
+        lines = generate_lines()
+        table_path = os.path.join(workdir, "trips.bin")
+        table = write_trips_table(table_path, lines)
+        bucket_manager.upload_to_bucket(table_path, trips_path, bucket_name)
+        directions = SyntheticDirections(table, latency=args.latency)
+
+        start = datetime(2026, 10, 19, 8, 0, tzinfo=timezone.utc)
+        results = []
+        reference = None
+        for concurrency in args.concurrency:
+            params = {
+                "mode": "transit",
+                "transit_mode": "train",
+                "alternatives": "true",
+                "region": "it",
+                "origin": station_name(lines[0][0]).title(),
+                "destination": station_name(lines[0][-1]).title(),
+                "event_start_time": start,
+                "event_end_time": start + timedelta(hours=args.hours),
+                "key": "benchmark",
+                "maps_path": f"maps/responses/bench_{concurrency}",
+                "bucket_name": bucket_name,
+                "trips_path": trips_path,
+                "full_legs_path": f"maps/results/bench_{concurrency}",
+                "event_options_path": f"maps/events/bench_{concurrency}.json",
+                "max_concurrency": concurrency,
+            }
+            directions.calls = 0
+            clear_directions_cache()
+            shutil.rmtree(os.path.join(workdir, bucket_name, directions_cache_partial_path), ignore_errors=True)
+            with mock.patch.object(maps_asker.requests, "get", directions):
+                started = time.perf_counter()
+                result = build_event_options(params)
+                elapsed = time.perf_counter() - started
+            options = payload_routes(bucket_manager.get_json(bucket_name, params["event_options_path"]))
+            if reference is None:
+                reference = options
+            results.append({
+                "concurrency": concurrency,
+                "seconds": round(elapsed, 3),
+                "maps_calls": directions.calls,
+                "options": len(options),
+                "errors": len(result["errors"]),
+                "identical_to_sequential": options == reference,
+            })
+
+    print(json.dumps({"latency_s": args.latency, "event_hours": args.hours, "runs": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
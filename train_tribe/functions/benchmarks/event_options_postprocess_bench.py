@@ -0,0 +1,147 @@
+# Measures the post-processing of build_event_options (dedup, event window filter,
+# ordering) on the routes collected for real events, comparing the old approach
+# (json.dumps keys, linear stop scans, strptime per stop) with select_routes.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/event_options_postprocess_bench.py [--events 16] [--repeat 20]
+#
+# Routes come from the Maps path (stubbed Directions, 30-minute slots over a 6h
+# window) and from the GTFS planner, so they include multi-leg routes and the
+# duplicates produced by overlapping slots. The old approach runs on full legs, as they
+# were before lean payloads. Checks both approaches select the same routes.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bucket_manager
+import maps_asker
+from event_options_builder import collect_gtfs_legs, collect_maps_legs, select_routes
+from leg_payloads import encode_routes, expand_payload
+from synthetic import SyntheticDirections, generate_lines, station_name, write_trips_table
+from trips_cache import get_trips_dataset
+
+bucket_name = "benchmark-bucket"
+trips_path = "maps/full_info_trips.bin"
+
+
+def legacy_select_routes(routes, event_start_time, event_end_time):
+    # build_event_options post-processing before compact route keys
+    unique_legs = []
+    seen = set()
+    for leg in routes:
+        leg_str = json.dumps(leg, sort_keys=True)
+        if leg_str not in seen:
+            seen.add(leg_str)
+            unique_legs.append(leg)
+
+    filtered_legs = []
+    for route in unique_legs:
+        valid = True
+        for leg_key in [k for k in route.keys() if k.startswith('leg')]:
+            leg = route[leg_key]
+            from_stop = next((s for s in leg["stops"] if s["stop_id"] == leg["from"]), None)
+            to_stop = next((s for s in leg["stops"] if s["stop_id"] == leg["to"]), None)
+            for stop in (from_stop, to_stop):
+                if stop:
+                    arr_time = datetime.strptime(stop["arrival_time"][:5], "%H:%M").time()
+                    if arr_time < event_start_time or arr_time > event_end_time:
+                        valid = False
+            if not valid:
+                break
+        if valid:
+            filtered_legs.append(route)
+
+    def get_leg0_departure(route):
+        leg0 = route.get("leg0")
+        if not leg0:
+            return "99:99"
+        from_stop = next((s for s in leg0.get("stops", []) if s["stop_id"] == leg0.get("from")), None)
+        return from_stop.get("departure_time", "99:99") if from_stop else "99:99"
+    filtered_legs.sort(key=get_leg0_departure)
+    return filtered_legs
+
+
+def collect_events(lines, events):
+    collected = []
+    for n in range(events):
+        line = lines[n % len(lines)]
+        start = datetime(2026, 10, 19, 5 + n % 6, 0, tzinfo=timezone.utc)
+        params = {
+            "mode": "transit",
+            "transit_mode": "train",
+            "alternatives": "true",
+            "region": "it",
+            "origin": station_name(line[n % 3]).title(),
+            "destination": station_name(line[-1 - n % 4]).title(),
+            "event_start_time": start,
+            "event_end_time": start + timedelta(hours=6),
+            "key": "benchmark",
+            "maps_path": f"maps/responses/bench_{n}",
+            "bucket_name": bucket_name,
+            "trips_path": trips_path,
+            "full_legs_path": f"maps/results/bench_{n}",
+        }
+        routes, _ = collect_maps_legs(params)
+        routes += collect_gtfs_legs(params) or []
+        collected.append((params, routes))
+    return collected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bucket_manager.set_backend(bucket_manager.LocalBackend(workdir))
+        lines = generate_lines()
+        table_path = os.path.join(workdir, "trips.bin")
+        write_trips_table(table_path, lines)
+        bucket_manager.upload_to_bucket(table_path, trips_path, bucket_name)
+        with mock.patch.object(maps_asker.requests, "get", SyntheticDirections(get_trips_dataset(bucket_name, trips_path)["table"])):
+            collected = collect_events(lines, args.events)
+        table = get_trips_dataset(bucket_name, trips_path)["table"]
+
+        windows = []
+        for params, routes in collected:
+            start = params["event_start_time"].astimezone(ZoneInfo("Europe/Rome"))
+            end = params["event_end_time"].astimezone(ZoneInfo("Europe/Rome"))
+            windows.append((routes, expand_payload(encode_routes(routes, table)), start, end))
+
+        timings = {}
+        outputs = {}
+        for name, select in (
+            ("legacy", lambda routes, full_routes, start, end: legacy_select_routes(full_routes, start.time(), end.time())),
+            ("route_keys", lambda routes, full_routes, start, end: select_routes(
+                routes, start.hour * 3600 + start.minute * 60, end.hour * 3600 + end.minute * 60, table)),
+        ):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                outputs[name] = [select(*window) for window in windows]
+            timings[name] = round((time.perf_counter() - started) / args.repeat * 1000, 2)
+        legacy_keys = [[{leg_key: {k: v for k, v in leg.items() if k != "stops"} for leg_key, leg in route.items()}
+                        for route in routes] for routes in outputs["legacy"]]
+
+    print(json.dumps({
+        "events": args.events,
+        "routes_in": sum(len(window[0]) for window in windows),
+        "routes_out": sum(len(routes) for routes in outputs["route_keys"]),
+        "ms_per_pass": timings,
+        "speedup": round(timings["legacy"] / timings["route_keys"], 1),
+        "identical": legacy_keys == outputs["route_keys"],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
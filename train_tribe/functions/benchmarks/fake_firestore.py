@@ -0,0 +1,250 @@
+# In-memory stand-in for the Firestore client, covering what the functions use:
+# documents and collections, merge writes (with DELETE_FIELD and SERVER_TIMESTAMP),
+# queries with where/limit (including document-id "in" filters), batches and get_all.
+# Reads and writes are counted the way Firestore bills them, so benchmarks can report them.
+#
+# Install it with db_manager.set_db(FakeFirestore()).
+
+import copy
+import operator
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.cloud.firestore_v1 import DELETE_FIELD, SERVER_TIMESTAMP, ArrayRemove, ArrayUnion
+
+_operators = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, values: value in values,
+    "not-in": lambda value, values: value not in values,
+    "array_contains": lambda value, item: isinstance(value, list) and item in value,
+}
+
+
+class FakeSnapshot:
+
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self):
+        self._db.round_trip()
+        return self._db.read(self.path)
+
+    def set(self, data, merge=False):
+        self._db.round_trip()
+        self._db.write(self.path, data, merge)
+
+    def update(self, data):
+        self.set(data, merge=True)
+
+    def delete(self):
+        self._db.round_trip()
+        self._db.remove(self.path)
+
+
+class FakeQuery:
+
+    def __init__(self, collection, filters=(), limit=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._limit = limit
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return FakeQuery(self._collection, self._filters + [(field_path, op_string, value)], self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, count)
+
+    def _matches(self, doc_id, data):
+        for field_path, op_string, value in self._filters:
+            if field_path == "__name__":
+                # Document-id filters compare references (or ids) by id
+                ids = [getattr(v, "id", v) for v in value] if isinstance(value, (list, tuple)) else getattr(value, "id", value)
+                if not _operators[op_string](doc_id, ids):
+                    return False
+            elif field_path not in data or not _operators[op_string](data[field_path], value):
+                return False
+        return True
+
+    def stream(self):
+        db = self._collection._db
+        db.round_trip()
+        matched = 0
+        for path, data, update_time in db.children(self._collection.path):
+            if self._limit is not None and matched >= self._limit:
+                break
+            doc_id = path.rsplit('/', 1)[-1]
+            if self._matches(doc_id, data):
+                matched += 1
+                db.reads += 1
+                yield FakeSnapshot(FakeDocument(db, path), copy.deepcopy(data), update_time)
+        if not matched:
+            db.reads += 1  # an empty query is billed as one read
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+
+    def __init__(self, db, path):
+        super().__init__(self)
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, doc_id):
+        return FakeDocument(self._db, f"{self.path}/{doc_id}")
+
+    def list_documents(self):
+        # Like Firestore, includes the documents that only hold subcollections
+        self._db.round_trip()
+        return [FakeDocument(self._db, f"{self.path}/{doc_id}") for doc_id in self._db.child_ids(self.path)]
+
+
+class FakeWriteBatch:
+
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, reference, data, merge=False):
+        self._ops.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self._ops.append((reference.path, None, False))
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise ValueError("A batch can contain at most 500 writes")
+        self._db.round_trip()
+        self._db.commits += 1
+        for path, data, merge in self._ops:
+            if data is None:
+                self._db.remove(path)
+            else:
+                self._db.write(path, data, merge)
+
+
+class FakeFirestore:
+
+    def __init__(self, latency=0.0):
+        # latency: seconds slept per round-trip, to stand in for the network
+        self.latency = latency
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+        self.round_trips = 0
+        self._docs = {}
+        self._update_times = {}
+        self._clock = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self._lock = threading.Lock()
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def counters(self):
+        return {"reads": self.reads, "writes": self.writes, "commits": self.commits, "round_trips": self.round_trips}
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def document(self, path):
+        return FakeDocument(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        self.round_trip()
+        for reference in references:
+            yield self.read(reference.path)
+
+    def read(self, path):
+        with self._lock:
+            self.reads += 1
+            data = copy.deepcopy(self._docs.get(path))
+            return FakeSnapshot(FakeDocument(self, path), data, self._update_times.get(path))
+
+    def write(self, path, data, merge):
+        with self._lock:
+            self.writes += 1
+            previous = self._docs.get(path)
+            document = copy.deepcopy(previous) if merge and previous is not None else {}
+            _merge(document, data)
+            if document != previous:
+                # Like Firestore, a write that changes nothing keeps the update time
+                self._clock += timedelta(microseconds=1)
+                self._update_times[path] = self._clock
+            self._docs[path] = document
+
+    def remove(self, path):
+        with self._lock:
+            self.writes += 1
+            self._docs.pop(path, None)
+            self._update_times.pop(path, None)
+
+    def child_ids(self, collection_path):
+        prefix = collection_path + '/'
+        with self._lock:
+            return sorted({path[len(prefix):].split('/', 1)[0] for path in self._docs if path.startswith(prefix)})
+
+    def children(self, collection_path):
+        # (path, data, update_time) of the documents directly in the collection, by id
+        prefix = collection_path + '/'
+        with self._lock:
+            return sorted(
+                (path, data, self._update_times[path]) for path, data in self._docs.items()
+                if path.startswith(prefix) and '/' not in path[len(prefix):]
+            )
+
+
+def _merge(document, data):
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            document.pop(key, None)
+        elif value is SERVER_TIMESTAMP:
+            document[key] = datetime.now(timezone.utc)
+        elif isinstance(value, ArrayUnion):
+            current = document.get(key) if isinstance(document.get(key), list) else []
+            document[key] = current + [copy.deepcopy(v) for v in value.values if v not in current]
+        elif isinstance(value, ArrayRemove):
+            current = document.get(key) if isinstance(document.get(key), list) else []
+            document[key] = [v for v in current if v not in value.values]
+        elif isinstance(value, dict):
+            if not isinstance(document.get(key), dict):
+                document[key] = {}
+            _merge(document[key], value)
+        else:
+            document[key] = copy.deepcopy(value)
@@ -0,0 +1,86 @@
+# Plans event windows with the GTFS planner on synthetic timetables and checks that
+# every journey it returns passes the event window filter of build_event_options.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/gtfs_planner_bench.py [--events 16] [--repeat 5]
+#
+# Cases: trains every 30 minutes all day; trains every 5 minutes from 05:00 to 12:00
+# with a 08:00-10:00 window (the max_journeys budget must not go to earlier trains);
+# a window opening hours before the first train of the day. Exits with status 1 if a
+# case plans a journey select_routes drops or no journey at all.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bucket_manager
+from event_options_builder import select_routes
+from gtfs_planner import get_planner, plan_window
+from synthetic import generate_lines, station_name, write_trips_table
+from trips_cache import get_trips_dataset
+
+bucket_name = "benchmark-bucket"
+
+cases = (
+    # name, timetable, (window start, window end) in hours
+    ("regular", {"headway_minutes": 30}, (7, 10)),
+    ("dense", {"headway_minutes": 5, "first_departure": 5 * 60, "last_departure": 12 * 60}, (8, 10)),
+    ("late_first_train", {"headway_minutes": 30, "first_departure": 10 * 60}, (6, 12)),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    report = []
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        bucket_manager.set_backend(bucket_manager.LocalBackend(workdir))
+        lines = generate_lines()
+        for name, timetable, (start_hour, end_hour) in cases:
+            table_path = os.path.join(workdir, f"{name}.bin")
+            trips_path = f"maps/{name}.bin"
+            write_trips_table(table_path, lines, **timetable)
+            bucket_manager.upload_to_bucket(table_path, trips_path, bucket_name)
+            dataset = get_trips_dataset(bucket_name, trips_path)
+            planner = get_planner(dataset)
+            window_start, window_end = start_hour * 3600, end_hour * 3600
+            events = [
+                (station_name(lines[n % len(lines)][n % 3]).title(), station_name(lines[n % len(lines)][-1 - n % 4]).title())
+                for n in range(args.events)
+            ]
+
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                planned = [plan_window(planner, origin, destination, window_start, window_end) or [] for origin, destination in events]
+            seconds = (time.perf_counter() - started) / args.repeat
+            kept = [select_routes(routes, window_start, window_end, dataset["table"]) for routes in planned]
+
+            journeys = sum(len(routes) for routes in planned)
+            dropped = journeys - sum(len(routes) for routes in kept)
+            empty = sum(1 for routes in kept if not routes)
+            failed = failed or dropped > 0 or empty > 0
+            report.append({
+                "case": name,
+                "events": args.events,
+                "journeys": journeys,
+                "dropped_by_select": dropped,
+                "events_without_journeys": empty,
+                "ms_per_event": round(seconds / args.events * 1000, 2),
+            })
+
+    print(json.dumps({"runs": report}, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,356 @@
+# Times every stage of the trip-options pipeline end to end, fully offline, and emits
+# the results as JSON so runs on different commits can be compared.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/pipeline_bench.py [--users 40] [--events-per-user 2] [--output results.json]
+#   python benchmarks/pipeline_bench.py --baseline previous.json [--tolerance 0.2]
+#
+# Stand-ins: a Lombardy-scale synthetic GTFS feed (served to jsonify as the download),
+# synthetic Directions responses answered from the same timetable, a local bucket and
+# an in-memory Firestore (benchmarks/fake_firestore.py). Stages, in pipeline order:
+# jsonify, build_full_info_maps_legs, build_event_options, event_options_save_to_db, the
+# HTTP handler get_event_full_trip_data (full response, then a revalidation with
+# If-None-Match) and delete_event_trip_options_logic. With --recurrence-weeks the events recur weekly.
+# Every stage reports wall time per call plus the storage and Firestore operations it
+# made. With --baseline, stages whose mean time grew by more than --tolerance are
+# listed as regressions and the exit status is 1.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+import bucket_manager
+import db_manager
+import event_friends_finder
+import jsonifier
+import maps_asker
+import tracing
+from event_options_builder import build_event_options
+from event_trip_options_manager import event_options_save_to_db, delete_event_trip_options_logic
+from fake_firestore import FakeFirestore
+from full_legs_builder import build_full_info_maps_legs
+from synthetic import LOMBARDY_SCALE, FakeDownload, SyntheticDirections, generate_lines, station_name, write_gtfs_zip
+from trips_cache import get_trips_dataset
+
+import main
+
+bucket_name = main.bucket_name
+trips_path = "maps/full_info_trips.bin"
+event_date = date(2026, 10, 19)
+
+
+class CountingBackend:
+    # Wraps a storage backend and counts the requests made through it
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.gets = 0
+        self.puts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def counters(self):
+        return {"gets": self.gets, "puts": self.puts, "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+    def get_bytes(self, bucket_name, blob_name, generation=None):
+        data = self.backend.get_bytes(bucket_name, blob_name, generation)
+        with self._lock:
+            self.gets += 1
+            self.bytes_in += len(data)
+        return data
+
+    def put_bytes(self, bucket_name, blob_name, data, content_type, gzip_transfer, if_generation_match=None):
+        self.backend.put_bytes(bucket_name, blob_name, data, content_type, gzip_transfer, if_generation_match)
+        with self._lock:
+            self.puts += 1
+            self.bytes_out += len(data)
+
+    def download_to_filename(self, bucket_name, blob_name, destination_path, generation=None):
+        self.backend.download_to_filename(bucket_name, blob_name, destination_path, generation)
+        with self._lock:
+            self.gets += 1
+            self.bytes_in += os.path.getsize(destination_path)
+
+    def upload_from_filename(self, source_file, bucket_name, blob_name):
+        self.backend.upload_from_filename(source_file, bucket_name, blob_name)
+        with self._lock:
+            self.puts += 1
+            self.bytes_out += os.path.getsize(source_file)
+
+    def get_blob_info(self, bucket_name, blob_name):
+        return self.backend.get_blob_info(bucket_name, blob_name)
+
+
+class StageTimer:
+
+    def __init__(self, storage, db):
+        self.storage = storage
+        self.db = db
+        self.stages = {}
+
+    def run(self, stage, calls):
+        # calls: iterable of zero-argument callables, timed one by one; returns their results
+        before = {**self.storage.counters(), **self.db.counters()}
+        timings = []
+        results = []
+        for call in calls:
+            started = time.perf_counter()
+            results.append(call())
+            timings.append(time.perf_counter() - started)
+        after = {**self.storage.counters(), **self.db.counters()}
+        timings_ms = sorted(t * 1000 for t in timings)
+        self.stages[stage] = {
+            "calls": len(timings),
+            "total_s": round(sum(timings), 3),
+            "mean_ms": round(statistics.fmean(timings_ms), 2) if timings else 0.0,
+            "p50_ms": round(timings_ms[len(timings_ms) // 2], 2) if timings else 0.0,
+            "p95_ms": round(timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))], 2) if timings else 0.0,
+            "max_ms": round(timings_ms[-1], 2) if timings else 0.0,
+            **{name: after[name] - before[name] for name in after},
+        }
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def make_users(db, n_users, friends_per_user, rng):
+    # Mutual friendships, every user visible to its friends
+    users = [f"user{idx:03d}" for idx in range(n_users)]
+    friends = {user: set() for user in users}
+    for user in users:
+        for friend in rng.sample(users, min(friends_per_user, n_users - 1)):
+            if friend != user:
+                friends[user].add(friend)
+                friends[friend].add(user)
+    for user in users:
+        db.collection("users").document(user).set({
+            "username": user,
+            "picture": "",
+            "mood": True,
+            "friends": {friend: {"ghosted": False} for friend in sorted(friends[user])},
+        })
+    return users
+
+
+def make_events(users, events_per_user, lines, rng):
+    # Events share a handful of origin/destination pairs, so friends end up on the same trains
+    pairs = [(line[i], line[-1 - j]) for line in lines[:6] for i, j in ((0, 0), (1, 2))]
+    events = []
+    for user in users:
+        for n in range(events_per_user):
+            origin, destination = rng.choice(pairs)
+            start = datetime(event_date.year, event_date.month, event_date.day, 5 + 2 * n + rng.randrange(2), 0, tzinfo=timezone.utc)
+            events.append({
+                "user_id": user,
+                "event_id": f"event{len(events):04d}",
+                "origin": station_name(origin).title(),
+                "destination": station_name(destination).title(),
+                "event_start": start,
+                "event_end": start + timedelta(hours=2),
+            })
+    return events
+
+
+def event_params(event, planner):
+    suffix = f"_{event['user_id']}_{event['event_id']}"
+    return {
+        "mode": "transit",
+        "transit_mode": "train",
+        "alternatives": "true",
+        "region": "it",
+        "origin": event["origin"],
+        "destination": event["destination"],
+        "event_start_time": event["event_start"],
+        "event_end_time": event["event_end"],
+        "key": "benchmark",
+        "maps_path": "maps/responses/maps_response" + suffix,
+        "bucket_name": bucket_name,
+        "trips_path": trips_path,
+        "full_legs_path": "maps/results/full_info_legs" + suffix,
+        "event_options_path": "maps/events/event_options" + suffix + ".json",
+        "planner": planner,
+    }
+
+
+def http_get(query, headers=None):
+    request = Request(EnvironBuilder(path="/", query_string=query, headers=headers or {}).get_environ())
+    return main.get_event_full_trip_data(request)
+
+
+def compare(stages, baseline, tolerance):
+    regressions = []
+    for stage, result in stages.items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous or not previous["mean_ms"]:
+            continue
+        ratio = result["mean_ms"] / previous["mean_ms"]
+        result["vs_baseline"] = round(ratio, 2)
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--friends-per-user", type=int, default=8)
+    parser.add_argument("--events-per-user", type=int, default=2)
+    parser.add_argument("--maps-responses", type=int, default=50, help="responses fed to build_full_info_maps_legs")
+    parser.add_argument("--jsonify-runs", type=int, default=1)
+    parser.add_argument("--planner", choices=("maps", "gtfs"), default="maps")
+    parser.add_argument("--friends-index", action="store_true", help="read friends from the friends trains index")
+    parser.add_argument("--recurrence-weeks", type=int, default=0, help="weeks every event recurs for, 0 for single events")
+    parser.add_argument("--maps-latency", type=float, default=0.0, help="seconds per Directions request")
+    parser.add_argument("--firestore-latency", type=float, default=0.0, help="seconds per Firestore round-trip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", action="store_true", help="emit the trace of each HTTP request on stdout")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    event_friends_finder.USE_FRIENDS_TRAINS_INDEX = args.friends_index
+    tracing.TRACE_SAMPLE_RATE = 1.0 if args.trace else 0.0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        storage = CountingBackend(bucket_manager.LocalBackend(workdir))
+        bucket_manager.set_backend(storage)
+        db = FakeFirestore(latency=args.firestore_latency)
+        db_manager.set_db(db)
+        timer = StageTimer(storage, db)
+
+        lines = generate_lines(seed=args.seed, **LOMBARDY_SCALE)
+        zip_path = os.path.join(workdir, "feed.zip")
+        write_gtfs_zip(zip_path, lines)
+        with open(zip_path, 'rb') as f:
+            feed = FakeDownload(f.read())
+        jsonify_params = {
+            "compact_output_path": trips_path,
+            "result_output_path": main.jsonified_trenord_trips_data_path,
+            "stops_output_path": main.jsonified_trenord_stops_data_path,
+            "bucket_name": bucket_name,
+        }
+        with mock.patch.object(jsonifier.requests, "get", feed):
+            timer.run("jsonify", [lambda: jsonifier.jsonify(jsonify_params)] * args.jsonify_runs)
+        table = get_trips_dataset(bucket_name, trips_path)["table"]
+        directions = SyntheticDirections(table, latency=args.maps_latency)
+
+        # build_full_info_maps_legs on stored Directions responses
+        response_paths = []
+        for n in range(args.maps_responses):
+            line = lines[n % len(lines)]
+            arrival = datetime(event_date.year, event_date.month, event_date.day, 6 + n % 12, 30, tzinfo=timezone.utc)
+            path = f"maps/responses/bench_{n}.json"
+            bucket_manager.put_json(bucket_name, path, directions.answer(
+                station_name(line[n % 4]).title(), station_name(line[-1 - n % 5]).title(), int(arrival.timestamp())))
+            response_paths.append(path)
+        timer.run("build_full_info_maps_legs", [
+            lambda path=path, n=n: build_full_info_maps_legs({
+                "full_legs_path": f"maps/results/bench_{n}.json",
+                "bucket_name": bucket_name,
+                "trips_path": trips_path,
+                "maps_path": path,
+                "service_date": event_date.isoformat(),
+            })
+            for n, path in enumerate(response_paths)
+        ])
+
+        users = make_users(db, args.users, args.friends_per_user, rng)
+        events = make_events(users, args.events_per_user, lines, rng)
+        params = [event_params(event, args.planner) for event in events]
+        with mock.patch.object(maps_asker.requests, "get", directions):
+            timer.run("build_event_options", [lambda p=p: build_event_options(p) for p in params])
+
+        recurring = args.recurrence_weeks > 0
+        recurrence_end = event_date + timedelta(weeks=args.recurrence_weeks)
+        for event, p in zip(events, params):
+            db.collection("users").document(event["user_id"]).collection("events").document(event["event_id"]).set({
+                "origin": event["origin"],
+                "destination": event["destination"],
+                "event_start": event["event_start"],
+                "event_end": event["event_end"],
+                "recurrent": recurring,
+                **({"recurrence_end": datetime.combine(recurrence_end, datetime.min.time(), timezone.utc)} if recurring else {}),
+            })
+        timer.run("event_options_save_to_db", [
+            lambda event=event, p=p: event_options_save_to_db({
+                "user_id": event["user_id"],
+                "event_id": event["event_id"],
+                "event_start_date": event_date,
+                "event_options_path": p["event_options_path"],
+                "bucket_name": bucket_name,
+                "isRecurring": recurring,
+                "recurrence_end_date": recurrence_end if recurring else None,
+            })
+            for event, p in zip(events, params)
+        ])
+
+        query = "userId={}&date=" + event_date.isoformat()
+        responses = timer.run("get_event_full_trip_data", [
+            lambda user_id=user_id: http_get(query.format(user_id), {"Accept-Encoding": "gzip"}) for user_id in users
+        ])
+        revalidations = timer.run("get_event_full_trip_data_revalidate", [
+            lambda user_id=user_id, etag=response.headers.get("ETag"): http_get(query.format(user_id), {"If-None-Match": etag or ""})
+            for user_id, response in zip(users, responses)
+        ])
+        http = {
+            "statuses": sorted({response.status_code for response in responses}),
+            "response_bytes": sum(len(response.get_data()) for response in responses),
+            "revalidate_statuses": sorted({response.status_code for response in revalidations}),
+        }
+
+        # The trigger gets the deleted event document
+        timer.run("delete_event_trip_options_logic", [
+            lambda event=event: delete_event_trip_options_logic(SimpleNamespace(
+                data=db.collection("users").document(event["user_id"]).collection("events").document(event["event_id"]).get(),
+                params={"user_id": event["user_id"], "event_id": event["event_id"]},
+            ), bucket_name)
+            for event in events
+        ])
+
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {**vars(args), "trips": table.trip_count(), "events": len(events)},
+        "http": http,
+        "stages": timer.stages,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(timer.stages, json.load(f), args.tolerance)
+        result["regressions"] = regressions
+    output = json.dumps(result, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,76 @@
+# Compares the trip_short_name index against the old linear substring scan.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/short_name_index_bench.py path/to/full_info_trips.json [--queries N]
+#
+# The trips file is the output of jsonify (full Lombardy feed). Queries are the
+# feed's own short names plus Google-style variants ("R 2415", "02415").
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trips_cache import group_trips_by_short_name
+from trips_table import TripsTable
+from trip_index import build_short_name_index, lookup_short_name
+
+
+def linear_scan(trips_by_short_name, trip_short_name):
+    return next((v for k, v in trips_by_short_name.items() if trip_short_name in k), [])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trips_path")
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.trips_path, encoding="utf-8") as f:
+        trips = json.load(f)
+    trips_by_short_name = group_trips_by_short_name(TripsTable.from_trips(trips))
+    names = sorted(k for k in trips_by_short_name if k)
+
+    rng = random.Random(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(names)
+        variant = rng.random()
+        if variant < 0.1:
+            name = "R " + name
+        elif variant < 0.2:
+            name = "0" + name
+        queries.append(name)
+
+    start = time.perf_counter()
+    index = build_short_name_index(trips_by_short_name)
+    build_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scan_results = [linear_scan(trips_by_short_name, q) for q in queries]
+    scan_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_results = [lookup_short_name(index, q) for q in queries]
+    index_s = time.perf_counter() - start
+
+    differing = sum(1 for a, b in zip(scan_results, index_results) if a is not b and a != b)
+    print(json.dumps({
+        "trips": len(trips),
+        "short_names": len(names),
+        "queries": len(queries),
+        "index_build_ms": round(build_s * 1000, 2),
+        "scan_us_per_query": round(scan_s / len(queries) * 1e6, 2),
+        "index_us_per_query": round(index_s / len(queries) * 1e6, 2),
+        "speedup": round(scan_s / index_s, 1) if index_s else None,
+        "differing_results": differing,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
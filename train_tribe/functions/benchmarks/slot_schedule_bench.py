@@ -0,0 +1,220 @@
+# Compares the fixed grid of Directions queries with the adaptive schedule: API calls
+# per event and the distinct event options each one ends up with.
+#
+# Usage (from train_tribe/functions):
+#   python benchmarks/slot_schedule_bench.py [--events 40] [--hours 1 2 4 8] [--headway 30] [--alternatives 4] [--noisy]
+#   GOOGLE_MAPS_API_KEY=... python benchmarks/slot_schedule_bench.py --events-file events.json --trips full_info_trips.bin --record recording.json
+#   python benchmarks/slot_schedule_bench.py --events-file events.json --trips full_info_trips.bin --replay recording.json
+#
+# Runs offline on a local storage backend. By default the timetable is synthetic and a
+# stubbed Directions endpoint answers with the `alternatives` trains arriving latest by
+# the requested time (--noisy leaves trains out of answers and adds a slow bus route).
+# That stub agrees with what the adaptive schedule assumes, so the real check is on
+# recorded responses: --record sends the queries of both schedules for the events of
+# --events-file to the real endpoint and saves the answers (merged into the file if it
+# exists), --replay answers from that file only. events.json lists
+#   {"origin": "Milano Centrale", "destination": "Bergamo",
+#    "event_start": "2026-10-19T07:00:00+02:00", "event_end": "2026-10-19T09:00:00+02:00"}
+# and --trips is a local copy of maps/full_info_trips.bin from the same period.
+# Both schedules see the same answers for the same query, and the Directions cache
+# (memory and bucket) is cleared before every run. Exits with status 1 if the adaptive
+# schedule misses an option the grid finds, 2 if a replayed query was not recorded.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bucket_manager
+import maps_asker
+from directions_cache import clear_directions_cache, directions_cache_key, directions_cache_partial_path
+from event_options_builder import build_event_options
+from leg_payloads import payload_routes
+from synthetic import FakeResponse, SyntheticDirections, generate_lines, station_name, write_trips_table
+
+bucket_name = "benchmark-bucket"
+schedules = ("grid", "adaptive")
+
+
+class RecordedDirections:
+    # Drop-in for requests.get on the Directions endpoint, answering from recorded
+    # responses keyed like the Directions cache (the API key is not part of the key).
+    # With `fetch`, queries not recorded yet go to the real endpoint and are recorded
+
+    def __init__(self, recording, fetch=None):
+        self.recording = recording
+        self.fetch = fetch
+        self.calls = 0
+        self.missing = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, url, params=None, **kwargs):
+        key = directions_cache_key(params)
+        with self._lock:
+            self.calls += 1
+            response = self.recording.get(key)
+        if response is None:
+            if self.fetch is None:
+                with self._lock:
+                    self.missing.add(key)
+                return FakeResponse({"status": "NOT_RECORDED", "routes": []})
+            answer = self.fetch(url, params=params, **kwargs)
+            if answer.status_code != 200:
+                return answer
+            response = answer.json()
+            with self._lock:
+                self.recording[key] = response
+        return FakeResponse(response)
+
+
+def synthetic_event(lines, n, hours):
+    line = lines[n % len(lines)]
+    # Starts off the half hour too, so the grid and the trains are not aligned
+    start = datetime(2026, 10, 19, 6, 0, tzinfo=timezone.utc) + timedelta(minutes=17 * n)
+    return {
+        "origin": station_name(line[n % 3]).title(),
+        "destination": station_name(line[-1 - n % 4]).title(),
+        "event_start": start,
+        "event_end": start + timedelta(hours=hours),
+    }
+
+
+def load_events(path):
+    # {event hours: [event, ...]} of the events file
+    with open(path) as f:
+        events = json.load(f)
+    by_hours = {}
+    for event in events:
+        event = {**event, "event_start": datetime.fromisoformat(event["event_start"]),
+                 "event_end": datetime.fromisoformat(event["event_end"])}
+        hours = round((event["event_end"] - event["event_start"]).total_seconds() / 3600, 2)
+        by_hours.setdefault(hours, []).append(event)
+    return dict(sorted(by_hours.items()))
+
+
+def event_params(event, name, schedule, key, trips_path):
+    return {
+        "mode": "transit",
+        "transit_mode": "train",
+        "alternatives": "true",
+        "region": "it",
+        "origin": event["origin"],
+        "destination": event["destination"],
+        "event_start_time": event["event_start"],
+        "event_end_time": event["event_end"],
+        "key": key,
+        "maps_path": f"maps/responses/{schedule}_{name}",
+        "bucket_name": bucket_name,
+        "trips_path": trips_path,
+        "full_legs_path": f"maps/results/{schedule}_{name}",
+        "event_options_path": f"maps/events/{schedule}_{name}.json",
+        "slot_schedule": schedule,
+    }
+
+
+def option_keys(options):
+    return {
+        tuple((route[k]["trip_id"], route[k]["from"], route[k]["to"]) for k in sorted(route) if k.startswith("leg"))
+        for route in options
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=40)
+    parser.add_argument("--hours", type=float, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--headway", type=int, default=30, help="minutes between trains of a line")
+    parser.add_argument("--alternatives", type=int, default=4, help="routes per Directions answer")
+    parser.add_argument("--noisy", action="store_true", help="synthetic answers leave trains out and add a bus route")
+    parser.add_argument("--events-file", help="real events, with --record or --replay")
+    parser.add_argument("--trips", help="local trips artifact, with --record or --replay")
+    recorded = parser.add_mutually_exclusive_group()
+    recorded.add_argument("--record", help="file the real Directions answers are saved to")
+    recorded.add_argument("--replay", help="file of recorded Directions answers")
+    args = parser.parse_args()
+    recording_path = args.record or args.replay
+    if recording_path and not (args.events_file and args.trips):
+        parser.error("--record and --replay need --events-file and --trips")
+    if args.record and not os.environ.get("GOOGLE_MAPS_API_KEY"):
+        parser.error("--record needs GOOGLE_MAPS_API_KEY")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bucket_manager.set_backend(bucket_manager.LocalBackend(workdir))
+        if recording_path:
+            trips_path = "maps/full_info_trips" + os.path.splitext(args.trips)[1]
+            bucket_manager.upload_to_bucket(args.trips, trips_path, bucket_name)
+            recording = {}
+            if os.path.exists(recording_path):
+                with open(recording_path) as f:
+                    recording = json.load(f)
+            directions = RecordedDirections(recording, maps_asker.requests.get if args.record else None)
+            events_by_hours = load_events(args.events_file)
+            key = os.environ.get("GOOGLE_MAPS_API_KEY", "replay")
+        else:
+            trips_path = "maps/full_info_trips.bin"
+            lines = generate_lines()
+            table_path = os.path.join(workdir, "trips.bin")
+            table = write_trips_table(table_path, lines, headway_minutes=args.headway)
+            bucket_manager.upload_to_bucket(table_path, trips_path, bucket_name)
+            directions = SyntheticDirections(table, alternatives=args.alternatives, noisy=args.noisy)
+            events_by_hours = {hours: [synthetic_event(lines, n, hours) for n in range(args.events)] for hours in args.hours}
+            key = "benchmark"
+
+        report = []
+        missing_total = 0
+        for hours, events in events_by_hours.items():
+            calls = dict.fromkeys(schedules, 0)
+            options = dict.fromkeys(schedules, 0)
+            missing = extra = 0
+            for n, event in enumerate(events):
+                keys = {}
+                for schedule in schedules:
+                    params = event_params(event, f"{hours}_{n}", schedule, key, trips_path)
+                    clear_directions_cache()
+                    shutil.rmtree(os.path.join(workdir, bucket_name, directions_cache_partial_path), ignore_errors=True)
+                    calls_before = directions.calls
+                    with mock.patch.object(maps_asker.requests, "get", directions):
+                        build_event_options(params)
+                    calls[schedule] += directions.calls - calls_before
+                    keys[schedule] = option_keys(payload_routes(bucket_manager.get_json(bucket_name, params["event_options_path"])))
+                    options[schedule] += len(keys[schedule])
+                missing += len(keys["grid"] - keys["adaptive"])
+                extra += len(keys["adaptive"] - keys["grid"])
+            missing_total += missing
+            report.append({
+                "event_hours": hours,
+                "events": len(events),
+                "grid_calls_per_event": round(calls["grid"] / len(events), 2),
+                "adaptive_calls_per_event": round(calls["adaptive"] / len(events), 2),
+                "grid_options": options["grid"],
+                "adaptive_options": options["adaptive"],
+                "missed_by_adaptive": missing,
+                "only_in_adaptive": extra,
+            })
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            json.dump(directions.recording, f)
+    not_recorded = len(directions.missing) if recording_path else 0
+    print(json.dumps({
+        "answers": "recorded" if recording_path else ("synthetic, noisy" if args.noisy else "synthetic"),
+        "headway_minutes": None if recording_path else args.headway,
+        "alternatives": None if recording_path else args.alternatives,
+        "not_recorded": not_recorded,
+        "runs": report,
+    }, indent=2))
+    if not_recorded:
+        return 2
+    return 1 if missing_total else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# Synthetic stand-ins shared by the benchmarks: a Trenord-like timetable and a
+# Directions endpoint that answers from it, so the pipeline runs with no network.
+
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from trips_table import TripsTableWriter, TripsTable, format_gtfs_time
+
+
+# Roughly the size of the Trenord network: ~420 stations, 44 lines of 18 stops; with a
+# train every 30 minutes in both directions that is ~3200 trips and ~57k stop times a day
+LOMBARDY_SCALE = {"n_stations": 420, "n_lines": 44, "stops_per_line": 18}
+
+
+def station_name(idx):
+    return f"STAZIONE {idx:03d}"
+
+
+def generate_lines(n_stations=60, n_lines=8, stops_per_line=12, seed=0):
+    rng = random.Random(seed)
+    stations = list(range(n_stations))
+    return [rng.sample(stations, stops_per_line) for _ in range(n_lines)]
+
+
+def generate_trips(lines, headway_minutes=30, first_departure=5 * 60, last_departure=23 * 60, minutes_between_stops=6):
+    # Yields (trip_id, trip_short_name, stops) in the jsonify stops format, both directions
+    trip_number = 0
+    for line_idx, line in enumerate(lines):
+        for direction, stations in enumerate((line, line[::-1])):
+            for start in range(first_departure, last_departure, headway_minutes):
+                stops = []
+                for seq, station in enumerate(stations):
+                    t = (start + seq * minutes_between_stops) * 60
+                    stops.append({
+                        "stop_id": f"S{station:03d}",
+                        "stop_name": station_name(station),
+                        "stop_sequence": str(seq + 1),
+                        "arrival_time": format_gtfs_time(t),
+                        "departure_time": format_gtfs_time(t + 60 if 0 < seq < len(stations) - 1 else t),
+                    })
+                trip_number += 1
+                yield f"L{line_idx}D{direction}T{start}", str(10000 + trip_number), stops
+
+
+def write_trips_table(path, lines, **kwargs):
+    writer = TripsTableWriter()
+    for trip_id, short_name, stops in generate_trips(lines, **kwargs):
+        writer.add_trip(trip_id, short_name, stops)
+    writer.write(path)
+    return TripsTable.from_file(path)
+
+
+def write_gtfs_zip(path, lines, **kwargs):
+    # Same timetable as a GTFS feed, in the layout jsonify downloads
+    stop_times = io.StringIO()
+    stop_times.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+    trips = io.StringIO()
+    trips.write("route_id,service_id,trip_id,trip_short_name\n")
+    stations = {}
+    for trip_id, short_name, stops in generate_trips(lines, **kwargs):
+        trips.write(f"R{trip_id.split('D')[0]},DAILY,{trip_id},{short_name}\n")
+        for stop in stops:
+            stations[stop["stop_id"]] = stop["stop_name"]
+            stop_times.write(f"{trip_id},{stop['arrival_time']},{stop['departure_time']},{stop['stop_id']},{stop['stop_sequence']}\n")
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr("stops.txt", "stop_id,stop_name\n" + "".join(f"{stop_id},{name}\n" for stop_id, name in sorted(stations.items())))
+        z.writestr("trips.txt", trips.getvalue())
+        z.writestr("stop_times.txt", stop_times.getvalue())
+        z.writestr("calendar.txt", "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                                   "DAILY,1,1,1,1,1,1,1,20260101,20271231\n")
+
+
+def _clock(seconds):
+    hours, rest = divmod(seconds // 60, 60)
+    return f"{(hours % 12) or 12}:{rest % 60:02d} {'AM' if hours % 24 < 12 else 'PM'}"
+
+
+class FakeResponse:
+
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+        self.headers = {}
+
+    def json(self):
+        return self.payload
+
+
+class FakeDownload:
+    # Drop-in for the streaming requests.get used by jsonify
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+        self.headers = {}
+
+    def __call__(self, url, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class SyntheticDirections:
+    # Drop-in for requests.get on the Directions endpoint. Answers with up to
+    # `alternatives` direct trains between the two stations arriving by arrival_time,
+    # after sleeping `latency` seconds to stand in for the network round-trip.
+    # With noisy=True answers look less like a timetable lookup: each train is left out
+    # of an answer with probability 1/4 (seeded on the train and the query) and a slow
+    # bus alternative arriving 90 minutes before the requested time is added.
+
+    def __init__(self, table, latency=0.0, alternatives=4, noisy=False):
+        self.table = table
+        self.latency = latency
+        self.alternatives = alternatives
+        self.noisy = noisy
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, url, params=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse(self.answer(params["origin"], params["destination"], int(params["arrival_time"])))
+
+    def _row(self, trip_idx, stop_name):
+        for row in self.table.stop_range(trip_idx):
+            if self.table.stop_names[self.table.stop_index[row]] == stop_name.upper():
+                return row
+        return None
+
+    def answer(self, origin, destination, arrival_epoch):
+        # Like Google, read the requested instant on the local (Italian) clock
+        arrival = datetime.fromtimestamp(arrival_epoch, tz=ZoneInfo("Europe/Rome"))
+        deadline = arrival.hour * 3600 + arrival.minute * 60
+        table = self.table
+        candidates = []
+        for trip_idx in range(table.trip_count()):
+            from_row = self._row(trip_idx, origin)
+            to_row = self._row(trip_idx, destination)
+            if from_row is None or to_row is None or from_row >= to_row:
+                continue
+            if table.arrival[to_row] <= deadline:
+                if self.noisy and random.Random(f"{trip_idx}:{arrival_epoch}").random() < 0.25:
+                    continue
+                candidates.append((table.arrival[to_row], trip_idx, from_row, to_row))
+        candidates.sort(reverse=True)
+
+        routes = []
+        for arrival_s, trip_idx, from_row, to_row in candidates[:self.alternatives]:
+            routes.append({"legs": [{
+                "arrival_time": {"value": int(arrival_epoch - deadline + arrival_s)},
+                "steps": [{
+                    "travel_mode": "TRANSIT",
+                    "transit_details": {
+                        "line": {"agencies": [{"name": "Trenord"}], "vehicle": {"type": "HEAVY_RAIL"}},
+                        "trip_short_name": table.trip_short_names[trip_idx],
+                        "departure_time": {"text": _clock(table.departure[from_row])},
+                        "departure_stop": {"name": table.stop_names[table.stop_index[from_row]].title()},
+                        "arrival_stop": {"name": table.stop_names[table.stop_index[to_row]].title()},
+                    },
+                }],
+            }]})
+        if self.noisy and routes:
+            routes.append({"legs": [{
+                "arrival_time": {"value": int(arrival_epoch - 90 * 60)},
+                "steps": [{
+                    "travel_mode": "TRANSIT",
+                    "transit_details": {
+                        "line": {"agencies": [{"name": "Autoguidovie"}], "vehicle": {"type": "BUS"}},
+                        "trip_short_name": "Z" + origin[-3:],
+                        "departure_time": {"text": _clock(deadline - 150 * 60)},
+                        "departure_stop": {"name": origin},
+                        "arrival_stop": {"name": destination},
+                    },
+                }],
+            }]})
+        return {"status": "OK" if routes else "ZERO_RESULTS", "routes": routes}
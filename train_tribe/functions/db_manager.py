@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import firebase_admin
+from firebase_admin import firestore
+from tracing import add_span, count, in_current_trace
+
+# Firestore access shared by the triggers. get_db() hands out one client per
+# process, initializing the default Firebase app on first use rather than at import;
+# set_db() swaps it (e.g. for an in-memory stand-in when running offline).
+# WriteSet collects writes and deletes, keeps a single operation per document and
+# commits them in batches of at most FIRESTORE_BATCH_SIZE with bounded parallelism.
+FIRESTORE_BATCH_SIZE = int(os.environ.get("FIRESTORE_BATCH_SIZE", 500))
+FIRESTORE_WRITE_CONCURRENCY = int(os.environ.get("FIRESTORE_WRITE_CONCURRENCY", 4))
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    firebase_admin.initialize_app()
+                _db = firestore.client()
+    return _db
+
+
+def set_db(db):
+    global _db
+    _db = db
+
+
+def merge_fields(previous, data):
+    # Same result as applying both merge writes: nested maps are merged key by key
+    merged = dict(previous)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_fields(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class WriteSet:
+
+    def __init__(self, db=None):
+        self.db = db or get_db()
+        self._ops = {}  # document path -> (reference, data or None for delete, merge)
+        self.requested = 0
+
+    def __len__(self):
+        return len(self._ops)
+
+    def set(self, ref, data, merge=False):
+        self.requested += 1
+        previous = self._ops.get(ref.path)
+        if merge and previous is not None and previous[1] is not None:
+            # Two merges into the same document become one; a full set stays a full set
+            data = merge_fields(previous[1], data)
+            merge = previous[2]
+        self._ops[ref.path] = (ref, data, merge)
+
+    def delete(self, ref):
+        self.requested += 1
+        self._ops[ref.path] = (ref, None, False)
+
+    def _commit_batch(self, ops):
+        batch = self.db.batch()
+        for ref, data, merge in ops:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, data, merge=merge)
+        batch.commit()
+
+    def commit(self, max_concurrency=None):
+        # Returns op counts and latency so callers can log them
+        started = time.perf_counter()
+        ops = list(self._ops.values())
+        self._ops = {}
+        batches = [ops[i:i + FIRESTORE_BATCH_SIZE] for i in range(0, len(ops), FIRESTORE_BATCH_SIZE)]
+        if batches:
+            max_workers = max(1, min(max_concurrency or FIRESTORE_WRITE_CONCURRENCY, len(batches)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # list() re-raises the first failed commit
+                list(executor.map(in_current_trace(self._commit_batch), batches))
+        stats = {
+            "requested": self.requested,
+            "ops": len(ops),
+            "batches": len(batches),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        self.requested = 0
+        add_span("firestore.write", stats["seconds"])
+        count("firestore.writes", stats["ops"])
+        count("firestore.batches", stats["batches"])
+        return stats
+
+
+def log_write_stats(label, stats):
+    logging.info("%s: %d ops (%d requested) in %d batches, %.3fs",
+                 label, stats["ops"], stats["requested"], stats["batches"], stats["seconds"])
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from bucket_manager import get_json, put_json, list_blobs, delete_blob
+from tracing import count
+
+# Directions responses shared across users, events and slots. Entries are keyed on
+# the normalized query (origin, destination, arrival slot and mode parameters, never
+# the API key) and live in two tiers: an in-process LRU and the bucket under
+# directions_cache_partial_path. Identical queries issued while one is already in
+# flight wait for its result instead of calling the API again.
+# Stale bucket entries are ignored on read and deleted by prune_directions_cache, run
+# daily by the call_prune_directions_cache scheduled function.
+DIRECTIONS_CACHE_TTL_SECONDS = float(os.environ.get("DIRECTIONS_CACHE_TTL_SECONDS", 24 * 3600))
+DIRECTIONS_CACHE_MAX_ENTRIES = int(os.environ.get("DIRECTIONS_CACHE_MAX_ENTRIES", 512))
+directions_cache_partial_path = "maps/directions_cache/"
+
+# Only definitive answers are cached, quota and transient errors are retried
+cacheable_statuses = ("OK", "ZERO_RESULTS")
+key_params = ("origin", "destination", "arrival_time", "mode", "transit_mode", "alternatives", "language", "region")
+
+_memory = OrderedDict()
+_in_flight = {}
+_lock = threading.Lock()
+stats = {"memory_hits": 0, "bucket_hits": 0, "coalesced": 0, "fetches": 0}
+
+
+def _normalize(value):
+    return " ".join(str(value).split()).casefold()
+
+
+def directions_cache_key(maps_params):
+    normalized = {name: _normalize(maps_params.get(name, "")) for name in key_params}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _fresh(stored_at):
+    return time.time() - stored_at < DIRECTIONS_CACHE_TTL_SECONDS
+
+
+def _memory_get(key):
+    entry = _memory.get(key)
+    if entry is None:
+        return None
+    if not _fresh(entry[0]):
+        del _memory[key]
+        return None
+    _memory.move_to_end(key)
+    return entry[1]
+
+
+def _memory_put(key, stored_at, response):
+    _memory[key] = (stored_at, response)
+    _memory.move_to_end(key)
+    while len(_memory) > DIRECTIONS_CACHE_MAX_ENTRIES:
+        _memory.popitem(last=False)
+
+
+def _bucket_get(bucket_name, key):
+    try:
+        entry = get_json(bucket_name, directions_cache_partial_path + key + ".json")
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("Directions cache read failed for %s: %s", key, e)
+        return None
+    if not _fresh(entry.get("stored_at", 0)):
+        return None
+    return entry
+
+
+def _bucket_put(bucket_name, key, stored_at, response):
+    try:
+        put_json(bucket_name, directions_cache_partial_path + key + ".json",
+                 {"stored_at": stored_at, "response": response}, gzip_transfer=True)
+    except Exception as e:
+        logging.warning("Directions cache write failed for %s: %s", key, e)
+
+
+def _lookup(bucket_name, key):
+    with _lock:
+        response = _memory_get(key)
+        if response is not None:
+            stats["memory_hits"] += 1
+            count("maps.cache_hits")
+            return response
+    entry = _bucket_get(bucket_name, key)
+    if entry is not None:
+        with _lock:
+            stats["bucket_hits"] += 1
+            _memory_put(key, entry["stored_at"], entry["response"])
+        count("maps.cache_hits")
+        return entry["response"]
+    return None
+
+
+def get_directions(maps_params, bucket_name, fetch):
+    # fetch(maps_params) performs the actual API call and returns the parsed response
+    key = directions_cache_key(maps_params)
+    response = _lookup(bucket_name, key)
+    if response is not None:
+        return response
+
+    with _lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[key] = future
+        else:
+            stats["coalesced"] += 1
+            count("maps.coalesced")
+
+    if not owner:
+        return future.result()
+
+    try:
+        # Another request may have filled the cache between the lookup and the claim
+        response = _lookup(bucket_name, key)
+        if response is None:
+            with _lock:
+                stats["fetches"] += 1
+            response = fetch(maps_params)
+            if response.get("status") in cacheable_statuses:
+                stored_at = time.time()
+                with _lock:
+                    _memory_put(key, stored_at, response)
+                _bucket_put(bucket_name, key, stored_at, response)
+        future.set_result(response)
+        return response
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _in_flight.pop(key, None)
+
+
+def prune_directions_cache(bucket_name):
+    # Deletes the bucket entries older than the TTL, judged on the blob update time
+    # (entries are written once, right after the fetch)
+    deleted = kept = 0
+    for blob in list_blobs(bucket_name, directions_cache_partial_path):
+        if _fresh(blob["updated"]):
+            kept += 1
+            continue
+        try:
+            delete_blob(bucket_name, blob["name"])
+            deleted += 1
+        except Exception as e:
+            logging.warning("Could not delete directions cache entry %s: %s", blob["name"], e)
+    logging.info("Directions cache pruned: %d stale entries deleted, %d kept", deleted, kept)
+    return {"deleted": deleted, "kept": kept}
+
+
+def clear_directions_cache():
+    with _lock:
+        _memory.clear()
@@ -1,86 +1,180 @@
-import json
 import logging
-from bucket_manager import download_from_bucket, upload_to_bucket
-import tempfile
-import os
-from firebase_admin import firestore
+from db_manager import get_db
+from friends_trains_index import USE_FRIENDS_TRAINS_INDEX, friends_trains_ref, friends_trains_from_doc
+from recurring_trains import weekday_of, friends_recurring_ref, expand_membership
+from tracing import span, count
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 
-def get_event_trip_friends_logic(params):
+friends_in_query_limit = 30  # max values of a Firestore "in" filter
 
-    logging.info("Starting event trip friends logic...")
 
-    event_options_path = params.get("event_options_path")
-    user_id = params.get("user_id")
-    bucket_name = params.get("bucket_name")
-    date = params.get("date")
+def new_friends_context(db=None):
+    # Request-scoped cache shared by every leg and event of one request. versions lists
+    # (path, update_time) of every document read, the day view derives its ETag from it
+    return {"db": db or get_db(), "friends": {}, "memberships": {}, "recurring": {}, "indexed_dates": set(),
+            "reads": 0, "versions": []}
 
-    db = firestore.Client()
-    user_doc = db.collection("users").document(user_id).get()
-    friends = []
+def record_version(context, snapshot):
+    if snapshot.exists:
+        context["versions"].append((snapshot.reference.path, str(snapshot.update_time)))
+
+def record_reads(context, reads):
+    context["reads"] += reads
+    count("firestore.reads", reads)
+
+def load_visible_friends(context, user_id, candidates=None):
+    # Friends the user can see on trains: not ghosted either way and with mood on,
+    # loaded with a single batched read of their profiles (only candidates, if given)
+    if user_id in context["friends"]:
+        return context["friends"][user_id]
+    db = context["db"]
+    with span("firestore.read"):
+        user_doc = db.collection("users").document(user_id).get()
+    record_reads(context, 1)
+    record_version(context, user_doc)
+    friends = {}
     if user_doc.exists:
         friends_map = user_doc.to_dict().get("friends", {})
-        for friend_id, friend_info in friends_map.items():
-            # Check if the user ghosted the friend
-            user_ghosted_friend = friend_info.get("ghosted", False)
+        # Check if the user ghosted the friend
+        refs = [db.collection("users").document(friend_id)
+                for friend_id, friend_info in friends_map.items()
+                if not friend_info.get("ghosted", False) and (candidates is None or friend_id in candidates)]
+        with span("firestore.read"):
+            friend_docs = list(db.get_all(refs)) if refs else []
+        record_reads(context, len(friend_docs))
+        for friend_doc in friend_docs:
+            record_version(context, friend_doc)
+            if not friend_doc.exists:
+                continue
+            friend = friend_doc.to_dict()
             # Check if the friend ghosted the user
-            friend_doc = db.collection("users").document(friend_id).get()
-            friend_ghosted_user = False
-            friend_mood = friend_doc.to_dict().get("mood", True)
-            if friend_doc.exists:
-                friend_friends_map = friend_doc.to_dict().get("friends", {})
-                friend_ghosted_user = friend_friends_map.get(user_id, {}).get("ghosted", False)
-            if not user_ghosted_friend and not friend_ghosted_user and friend_mood:
-                friends.append(friend_id)
+            friend_ghosted_user = friend.get("friends", {}).get(user_id, {}).get("ghosted", False)
+            if not friend_ghosted_user and friend.get("mood", True):
+                friends[friend_doc.id] = {
+                    "username": friend.get("username", "Unknown"),
+                    "picture": friend.get("picture", ""),
+                }
+    context["friends"][user_id] = friends
+    return friends
+
+def load_friends_trains(context, user_id, date):
+    # Fills the request cache from the friends trains index: the index document, the
+    # user document and one batched read of the friends riding that day, however many
+    # legs and options there are. False when the index is disabled or missing
+    if date in context["indexed_dates"]:
+        return True
+    if not USE_FRIENDS_TRAINS_INDEX or user_id in context["friends"]:
+        return False
+    db = context["db"]
+    with span("firestore.read"):
+        # The date's document and the recurring patterns of its weekday
+        index_doc, recurring_doc = db.get_all([friends_trains_ref(db, date, user_id), friends_recurring_ref(db, weekday_of(date), user_id)])
+    record_reads(context, 2)
+    record_version(context, index_doc)
+    record_version(context, recurring_doc)
+    recurring = context["recurring"][(user_id, weekday_of(date))] = friends_trains_from_doc(recurring_doc) or {}
+    trips = friends_trains_from_doc(index_doc)
+    if trips is None:
+        return False
+    for trip_id, riders in recurring.items():
+        trip_riders = trips.setdefault(trip_id, {})
+        for friend_id, patterns in riders.items():
+            membership = expand_membership(patterns, date, trip_riders.get(friend_id))
+            if membership is not None:
+                trip_riders[friend_id] = membership
+    load_visible_friends(context, user_id, {friend_id for riders in trips.values() for friend_id in riders})
+    for trip_id, riders in trips.items():
+        context["memberships"][(date, trip_id)] = sorted(riders.items())
+    context["indexed_dates"].add(date)
+    return True
+
+def load_friends_recurring(context, user_id, date):
+    # {trip_id: {friend_id: {event_id: pattern}}} of the friends' recurring trains on the
+    # weekday of the date, from the user's friends_trains_recurring document, read once
+    # per request and weekday
+    key = (user_id, weekday_of(date))
+    if key not in context["recurring"]:
+        with span("firestore.read"):
+            doc = friends_recurring_ref(context["db"], key[1], user_id).get()
+        record_reads(context, 1)
+        record_version(context, doc)
+        context["recurring"][key] = friends_trains_from_doc(doc) or {}
+    return context["recurring"][key]
 
-    logging.info(f"Found {len(friends)} friends for user {user_id}.")
+def load_trips_memberships(context, user_id, date, trips_lists):
+    # Fills the request cache with the memberships of the given trains, the same reads
+    # add_friends_to_routes makes for legs on them. trips_lists: trip ids of each event,
+    # False when the trains of an event are not known
+    trips_lists = list(trips_lists)
+    if any(trip_ids is None for trip_ids in trips_lists):
+        return False
+    friends = load_visible_friends(context, user_id)
+    for trip_id in sorted({trip_id for trip_ids in trips_lists for trip_id in trip_ids}):
+        check_friends_on_trip(trip_id, friends, date, context, user_id)
+    return True
 
-    tmp_path = os.path.join(tempfile.gettempdir(), os.path.basename(event_options_path))
-    download_from_bucket(bucket_name, event_options_path, tmp_path)
-    with open(tmp_path, "r", encoding="utf-8") as f:
-        event_routes = json.load(f)
+def add_friends_to_routes(event_routes, user_id, date, context):
+    # Adds the friends riding each leg to the routes, in place
+    load_friends_trains(context, user_id, date)
+    friends = load_visible_friends(context, user_id)
+
+    logging.debug(f"Found {len(friends)} friends for user {user_id}.")
 
     for route in event_routes:
         for leg_key, leg in route.items():
             if leg_key.startswith("leg"):
-                logging.info(f"Checking leg {leg_key} for trip_id {leg.get('trip_id')}...")
-                friends_on_trip = check_friends_on_trip(leg.get("trip_id"), friends, date)
+                friends_on_trip = check_friends_on_trip(leg.get("trip_id"), friends, date, context, user_id)
                 if friends_on_trip:
                     leg["friends"] = friends_on_trip
-                    logging.info(f"Found {len(friends_on_trip)} friends on trip {leg.get('trip_id')}.")
-    
-    # Save the modified event_routes to a new file and upload it
-    new_event_options_path = event_options_path + "_with_friends.json"
-    new_tmp_path = os.path.join(tempfile.gettempdir(), os.path.basename(new_event_options_path))
-    with open(new_tmp_path, "w", encoding="utf-8") as f:
-        json.dump(event_routes, f, ensure_ascii=False, indent=2)
-    upload_to_bucket(new_tmp_path, new_event_options_path, bucket_name)
-
-    logging.info(f"Event trip friends logic completed. New file uploaded to {new_event_options_path}")
-
-    return new_event_options_path
+    return event_routes
 
-def check_friends_on_trip(trip_id, friends, date):
-    db = firestore.Client()
-    users_on_trip = db.collection("trains_match").document(date).collection("trains").document(trip_id).collection("users").get()
+def query_friends(context, users_ref, friends):
+    # {friend_id: document} of the friends' documents in the collection
+    friend_refs = [users_ref.document(friend_id) for friend_id in sorted(friends)]
+    found = {}
+    for i in range(0, len(friend_refs), friends_in_query_limit):
+        chunk = friend_refs[i:i + friends_in_query_limit]
+        with span("firestore.read"):
+            docs = list(users_ref.where(filter=FieldFilter(FieldPath.document_id(), "in", chunk)).stream())
+        record_reads(context, max(1, len(docs)))  # an empty query is billed as one read
+        for doc in docs:
+            record_version(context, doc)
+            found[doc.id] = doc.to_dict()
+    return found
 
-    logging.info(f"Found {len(users_on_trip)} users on trip {trip_id}.")
+def check_friends_on_trip(trip_id, friends, date, context=None, user_id=None):
+    # friends maps friend ids to their profiles, as returned by load_visible_friends;
+    # the recurring trains of the friends are only included when user_id is given
+    context = context or new_friends_context()
+    key = (date, trip_id)
+    if date in context["indexed_dates"]:
+        # Every train with friends on it is in the index
+        context["memberships"].setdefault(key, [])
+    if key not in context["memberships"]:
+        # Only the friends' membership documents are read, not every rider of the train;
+        # their recurring patterns come from the user's recurring index document
+        db = context["db"]
+        users_ref = db.collection("trains_match").document(date).collection("trains").document(trip_id).collection("users")
+        memberships = query_friends(context, users_ref, friends)
+        riders = load_friends_recurring(context, user_id, date).get(trip_id, {}) if user_id is not None else {}
+        for friend_id, patterns in riders.items():
+            membership = expand_membership(patterns, date, memberships.get(friend_id))
+            if membership is not None:
+                memberships[friend_id] = membership
+        context["memberships"][key] = sorted(memberships.items())
 
     friends_on_trip = []
-    
-    for user_on_trip in users_on_trip:
-        logging.info(f"Checking user {user_on_trip.id} on trip {trip_id}...")
-        if user_on_trip.id in friends:
-            user = db.collection("users").document(user_on_trip.id).get().to_dict()
-            name = user.get("username", "Unknown")
-            picture = user.get("picture", "")
-            user_on_trip_dict = user_on_trip.to_dict()
-            friend = {
-                "user_id": user_on_trip.id,
-                "username": name,
-                "picture": picture,
-                "from": user_on_trip_dict.get("from", ""),
-                "to": user_on_trip_dict.get("to", ""),
-                "confirmed": user_on_trip_dict.get("confirmed", False)
-            }
-            friends_on_trip.append(friend)
-    return friends_on_trip
\ No newline at end of file
+    for friend_id, user_on_trip_dict in context["memberships"][key]:
+        if friend_id not in friends:
+            continue
+        friend = {
+            "user_id": friend_id,
+            "username": friends[friend_id]["username"],
+            "picture": friends[friend_id]["picture"],
+            "from": user_on_trip_dict.get("from", ""),
+            "to": user_on_trip_dict.get("to", ""),
+            "confirmed": user_on_trip_dict.get("confirmed", False)
+        }
+        friends_on_trip.append(friend)
+    return friends_on_trip
@@ -1,10 +1,15 @@
 from maps_asker import ask_maps
 from datetime import datetime, timedelta
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import os
 import pytz
-import json
-from bucket_manager import download_from_bucket, upload_to_bucket
+import logging
+from bucket_manager import put_json
+from trips_cache import get_trips_dataset
+from gtfs_planner import get_planner, plan_window
+from trips_table import NO_TIME, parse_gtfs_time
+from leg_payloads import encode_routes
+from tracing import span, in_current_trace
 
 """
     params = {
@@ -19,107 +24,239 @@ from bucket_manager import download_from_bucket, upload_to_bucket
         "key": GOOGLE_MAPS_API_KEY.value,
         "maps_path": maps_response_full_path,
         "bucket_name": bucket_name,
-        "trips_path": jsonified_trenord_data_path,
+        "trips_path": jsonified_trenord_data_path,  # compact .bin or legacy .json
         "full_legs_path": full_legs_full_path,
         "event_options_path": event_options_full_path,
+        "max_concurrency": 4,  # optional, defaults to MAPS_MAX_CONCURRENCY
+        "planner": "maps",  # optional, "maps" or "gtfs", defaults to TRIP_PLANNER
+        "slot_schedule": "grid",  # optional, "grid" or "adaptive", defaults to MAPS_SLOT_SCHEDULE
     }
 """
 
-def build_event_options(params):
-    event_start = params["event_start_time"]
-    event_end = params["event_end_time"]
-    interval = timedelta(minutes=30)
-    i = 0
-    all_legs = []
-    errors = []
-    current_time = event_start
-    while current_time <= event_end:
-        arrival_time_str = current_time.strftime("%Y-%m-%d %H:%M")
-        maps_asker_params = {
-            "mode": params["mode"],
-            "transit_mode": params["transit_mode"],
-            "alternatives": params["alternatives"],
-            "region": params["region"],
-            "origin": params["origin"],
-            "destination": params["destination"],
-            "arrival_time": arrival_time_str,
-            "key": params["key"],
-            "maps_path": f"{params['maps_path']}_{i}.json",
-            "trips_path": params["trips_path"],
-            "full_legs_path": f"{params['full_legs_path']}_{i}.json",
-            "bucket_name": params["bucket_name"],
-        }
+MAPS_MAX_CONCURRENCY = int(os.environ.get("MAPS_MAX_CONCURRENCY", 4))
+# "maps" queries Google Directions per slot, "gtfs" plans on the local timetable
+# and falls back to Google Directions when it finds nothing
+TRIP_PLANNER = os.environ.get("TRIP_PLANNER", "maps")
+# "grid" queries Google Directions every SLOT_INTERVAL over the event window,
+# "adaptive" queries some of the grid slots and skips those its neighbours agree on
+MAPS_SLOT_SCHEDULE = os.environ.get("MAPS_SLOT_SCHEDULE", "grid")
+SLOT_INTERVAL = timedelta(minutes=30)
+# Grid slots between two first probes of the adaptive schedule
+MAPS_ADAPTIVE_PROBE_SLOTS = int(os.environ.get("MAPS_ADAPTIVE_PROBE_SLOTS", 4))
+no_departure = 100 * 60  # minutes, sorts after any GTFS time
+
+def leg_stop_times(leg, table=None):
+    # (from arrival, to arrival, from departure) in seconds after midnight, None when unknown.
+    # Without a table, only full legs (carrying their stops) have times
+    trip_idx = table.trip_position(leg["trip_id"]) if table else None
+    if trip_idx is not None:
+        from_row = table.find_stop(trip_idx, leg["from"])
+        to_row = table.find_stop(trip_idx, leg["to"])
+        times = (
+            table.arrival[from_row] if from_row is not None else NO_TIME,
+            table.arrival[to_row] if to_row is not None else NO_TIME,
+            table.departure[from_row] if from_row is not None else NO_TIME,
+        )
+    else:
+        stops = leg.get("stops", [])
+        from_stop = next((s for s in stops if s["stop_id"] == leg["from"]), {})
+        to_stop = next((s for s in stops if s["stop_id"] == leg["to"]), {})
+        times = (
+            parse_gtfs_time(from_stop.get("arrival_time")),
+            parse_gtfs_time(to_stop.get("arrival_time")),
+            parse_gtfs_time(from_stop.get("departure_time")),
+        )
+    return tuple(None if t == NO_TIME else t for t in times)
+
+def leg_number(leg_key):
+    return int(leg_key[3:])
+
+def route_key(route):
+    # The (trip_id, from, to) tuple of every leg in order
+    return tuple((route[k]["trip_id"], route[k]["from"], route[k]["to"])
+                 for k in sorted((k for k in route if k.startswith('leg')), key=leg_number))
+
+def compact_routes(routes, table=None):
+    # Deduplicated routes as (key, arrival minutes, leg0 departure minute, route), where
+    # key is the (trip_id, from, to) tuple of every leg in order. Stop times are looked
+    # up once per distinct leg, in integer minutes after midnight.
+    leg_times = {}
+    seen = set()
+    compact = []
+    for route in routes:
+        leg_keys = sorted((k for k in route if k.startswith('leg')), key=leg_number)
+        key = route_key(route)
+        if key in seen:
+            continue
+        seen.add(key)
+        arrivals = []
+        departure = no_departure
+        for leg_key, leg_id in zip(leg_keys, key):
+            times = leg_times.get(leg_id)
+            if times is None:
+                times = leg_times[leg_id] = tuple(None if t is None else t // 60 for t in leg_stop_times(route[leg_key], table))
+            arrivals.extend(t for t in times[:2] if t is not None)
+            if leg_key == "leg0" and times[2] is not None:
+                departure = times[2]
+        compact.append((key, arrivals, departure, route))
+    return compact
+
+def select_routes(routes, event_start_seconds, event_end_seconds, table=None):
+    # Dedup on the route key, keep routes whose 'from' and 'to' stops are all reached
+    # within the event window (at minute resolution), ordered by leg0 departure
+    start_minute = -(-event_start_seconds // 60)
+    end_minute = event_end_seconds // 60
+    selected = [
+        (departure, route) for _, arrivals, departure, route in compact_routes(routes, table)
+        if all(start_minute <= arrival <= end_minute for arrival in arrivals)
+    ]
+    # Routes without leg0 go last
+    selected.sort(key=lambda entry: entry[0])
+    return [route for _, route in selected]
+
+def query_slot(params, i, arrival_time):
+    # Runs one Directions query + leg build; returns (legs, error) and never raises
+    maps_asker_params = {
+        "mode": params["mode"],
+        "transit_mode": params["transit_mode"],
+        "alternatives": params["alternatives"],
+        "region": params["region"],
+        "origin": params["origin"],
+        "destination": params["destination"],
+        "arrival_time": arrival_time.strftime("%Y-%m-%d %H:%M"),
+        "key": params["key"],
+        "maps_path": f"{params['maps_path']}_{i}.json",
+        "trips_path": params["trips_path"],
+        "full_legs_path": f"{params['full_legs_path']}_{i}.json",
+        "bucket_name": params["bucket_name"],
+        # Service day of the slot, used to keep only the trips running that day
+        "service_date": arrival_time.astimezone(pytz.timezone("Europe/Rome")).date().isoformat(),
+    }
+    try:
         result = ask_maps(maps_asker_params)
         if not result.get("success"):
-            errors.append({"interval": i, "error": result.get("message", "Unknown error")})
+            return None, {"interval": i, "error": result.get("message", "Unknown error")}
+        # The legs come back in memory; the slot's blob is only a record of the run
+        return result["full_legs"], None
+    except Exception as e:
+        logging.error("Slot %d failed: %s", i, e)
+        return None, {"interval": i, "error": str(e)}
+
+def grid_slots(event_start, event_end):
+    slots = []
+    current_time = event_start
+    while current_time <= event_end:
+        slots.append(current_time)
+        current_time += SLOT_INTERVAL
+    return slots
+
+def query_slots(params, slots, indices):
+    # Queries the slots at the given indices concurrently, results come back in that order
+    max_concurrency = max(1, min(params.get("max_concurrency", MAPS_MAX_CONCURRENCY), len(indices) or 1))
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(in_current_trace(lambda i: query_slot(params, i, slots[i])), indices))
+
+def query_grid(params):
+    slots = grid_slots(params["event_start_time"], params["event_end_time"])
+    return query_slots(params, slots, range(len(slots)))
+
+def same_answer(result, other):
+    legs, error = result
+    other_legs, other_error = other
+    return not error and not other_error and {route_key(route) for route in legs} == {route_key(route) for route in other_legs}
+
+def query_adaptive(params):
+    # Queries only grid slots: every MAPS_ADAPTIVE_PROBE_SLOTS-th one and the last, then
+    # the slot halfway between two queried slots whose routes differ, until every pair of
+    # neighbours is either adjacent or agrees. Directions answers with the trains arriving
+    # latest by the requested time, so when two queries return the same trains none
+    # arrived in between and the slots between them would return those trains too.
+    # A failed query counts as a disagreement. Never makes more queries than the grid
+    slots = grid_slots(params["event_start_time"], params["event_end_time"])
+    if not slots:
+        return []
+    indices = sorted(set(range(0, len(slots), max(1, MAPS_ADAPTIVE_PROBE_SLOTS))) | {len(slots) - 1})
+    results = {}
+    while indices:
+        results.update(zip(indices, query_slots(params, slots, indices)))
+        queried = sorted(results)
+        indices = [
+            (i + j) // 2 for i, j in zip(queried, queried[1:])
+            if j - i > 1 and not same_answer(results[i], results[j])
+        ]
+    return [results[i] for i in sorted(results)]
+
+def collect_maps_legs(params):
+    if params.get("slot_schedule", MAPS_SLOT_SCHEDULE) == "adaptive":
+        results = query_adaptive(params)
+    else:
+        results = query_grid(params)
+
+    all_legs = []
+    errors = []
+    for legs, error in results:
+        if error:
+            errors.append(error)
         else:
-            try:
-                blob_name = f"{params['full_legs_path']}_{i}.json"
-                tmp_path = os.path.join(tempfile.gettempdir(), f"full_legs_{i}.json")
-                download_from_bucket(params["bucket_name"], blob_name, tmp_path)
-                with open(tmp_path, "r", encoding="utf-8") as f:
-                    legs = json.load(f)
-                    all_legs.extend(legs)
-            except Exception as e:
-                errors.append({"interval": i, "error": str(e)})
-        current_time += interval
-        i += 1
-
-    # Remove duplicate routes
-    unique_legs = []
-    seen = set()
-    for leg in all_legs:
-        leg_str = json.dumps(leg, sort_keys=True)
-        if leg_str not in seen:
-            seen.add(leg_str)
-            unique_legs.append(leg)
+            all_legs.extend(legs)
+    return all_legs, errors
+
+def collect_gtfs_legs(params):
+    # Whole event window in one pass over the local timetable, None when it has no answer
+    rome_tz = pytz.timezone("Europe/Rome")
+    start = params["event_start_time"].astimezone(rome_tz)
+    end = params["event_end_time"].astimezone(rome_tz)
+    window_start = start.hour * 3600 + start.minute * 60 + start.second
+    window_end = end.hour * 3600 + end.minute * 60 + end.second
+    service_date = start.date().isoformat()
+    try:
+        dataset = get_trips_dataset(params["bucket_name"], params["trips_path"])
+        table = dataset["table"]
+        runs = (lambda trip_idx: table.runs_on(trip_idx, service_date)) if table.has_calendar() else None
+        routes = plan_window(get_planner(dataset), params["origin"], params["destination"], window_start, window_end, runs)
+    except Exception as e:
+        logging.error("GTFS planner failed: %s", e)
+        return None
+    return routes or None
+
+def build_event_options(params):
+    planner = params.get("planner", TRIP_PLANNER)
+    all_legs = None
+    errors = []
+    if planner == "gtfs":
+        with span("event_options.plan_gtfs"):
+            all_legs = collect_gtfs_legs(params)
+        if all_legs is None:
+            logging.warning("GTFS planner found no routes, falling back to Google Maps")
+    if all_legs is None:
+        with span("event_options.collect_maps"):
+            all_legs, errors = collect_maps_legs(params)
+        planner = "maps"
 
     # Remove routes with legs whose 'from' or 'to' stop arrival_time is outside event timeframe
     rome_tz = pytz.timezone("Europe/Rome")
     event_start_time = params["event_start_time"].astimezone(rome_tz).time()
     event_end_time = params["event_end_time"].astimezone(rome_tz).time()
-    filtered_legs = []
-    for route in unique_legs:
-        valid = True
-        for leg_key in [k for k in route.keys() if k.startswith('leg')]:
-            leg = route[leg_key]
-            stops = leg["stops"]
-            from_id = leg["from"]
-            to_id = leg["to"]
-            from_stop = next((s for s in stops if s["stop_id"] == from_id), None)
-            to_stop = next((s for s in stops if s["stop_id"] == to_id), None)
-            if from_stop:
-                arr_time_str = from_stop["arrival_time"][:5]
-                arr_time = datetime.strptime(arr_time_str, "%H:%M").time()
-                if arr_time < event_start_time or arr_time > event_end_time:
-                    valid = False
-                    break
-            if to_stop:
-                arr_time_str = to_stop["arrival_time"][:5]
-                arr_time = datetime.strptime(arr_time_str, "%H:%M").time()
-                if arr_time < event_start_time or arr_time > event_end_time:
-                    valid = False
-                    break
-        if valid:
-            filtered_legs.append(route)
-
-    # Sort routes by departure_time of "from" station of leg0
-    def get_leg0_departure(route):
-        leg0 = route.get("leg0")
-        if not leg0:
-            return "99:99"  # Put routes without leg0 at the end
-        stops = leg0.get("stops", [])
-        from_id = leg0.get("from")
-        from_stop = next((s for s in stops if s["stop_id"] == from_id), None)
-        if from_stop:
-            return from_stop.get("departure_time", "99:99")
-        return "99:99"
-    filtered_legs.sort(key=lambda route: get_leg0_departure(route))
-
-    # Save merged file to a temp file and upload to bucket
-    tmp_event_options_path = os.path.join(tempfile.gettempdir(), os.path.basename(params["event_options_path"]))
-    with open(tmp_event_options_path, "w", encoding="utf-8") as f:
-        json.dump(filtered_legs, f, ensure_ascii=False, indent=4)
-    upload_to_bucket(tmp_event_options_path, params["event_options_path"], params["bucket_name"])
+    event_start_seconds = event_start_time.hour * 3600 + event_start_time.minute * 60 + event_start_time.second
+    event_end_seconds = event_end_time.hour * 3600 + event_end_time.minute * 60 + event_end_time.second
+
+    # Stop times are read from the cached trips table rather than from the legs' stop lists
+    try:
+        table = get_trips_dataset(params["bucket_name"], params["trips_path"])["table"]
+    except Exception as e:
+        logging.warning("Trips table unavailable, reading stop times from the legs: %s", e)
+        table = None
+
+    with span("event_options.select"):
+        filtered_legs = select_routes(all_legs, event_start_seconds, event_end_seconds, table)
+    if not filtered_legs and planner == "gtfs":
+        logging.warning("No GTFS route fits the event window, falling back to Google Maps")
+        with span("event_options.collect_maps"):
+            all_legs, errors = collect_maps_legs(params)
+        with span("event_options.select"):
+            filtered_legs = select_routes(all_legs, event_start_seconds, event_end_seconds, table)
+
+    # Upload merged file to bucket, the stops of each trip are stored once (see leg_payloads)
+    put_json(params["bucket_name"], params["event_options_path"], encode_routes(filtered_legs, table))
     success = len(errors) == 0
     return {"success": success, "message": "Event options built successfully", "errors": errors}
\ No newline at end of file
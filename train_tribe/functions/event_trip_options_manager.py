@@ -2,20 +2,34 @@ from heapq import merge
 from firebase_admin import firestore
 from zoneinfo import ZoneInfo
 import datetime
+import hashlib
 import json
-import os
-import tempfile
 import logging
-from bucket_manager import download_from_bucket
-from event_options_builder import build_event_options
-from day_event_options_merger import get_day_event_trip_options_logic
-from event_friends_finder import get_event_trip_friends_logic
-from datetime import datetime, timezone, timedelta
+import os
+from bucket_manager import get_json, put_json, get_blob_info
+from db_manager import get_db, WriteSet, log_write_stats, FIRESTORE_WRITE_CONCURRENCY
+from day_event_options_merger import save_day_event_options
+from friends_trains_index import add_rider, remove_rider, user_friend_ids
+from event_friends_finder import (
+    add_friends_to_routes, new_friends_context, load_friends_trains, load_trips_memberships, record_version, record_reads,
+)
+from leg_payloads import COMPACT, PayloadWriter, encode_routes, payload_routes
+from recurring_trains import (
+    RECURRING_PATTERNS, PATTERN_STORAGE, weekday_of, pattern_ref, friends_recurring_ref, new_pattern, add_pattern,
+    read_patterns, active_pattern, remove_event_patterns, prune_friends_recurring, prune_patterns, weekdays,
+)
+from tracing import span, in_current_trace, debug_payload
+from datetime import datetime, timezone, timedelta, date as date_type
+from concurrent.futures import ThreadPoolExecutor
 
-jsonified_trenord_data_path = "maps/full_info_trips.json"
+jsonified_trenord_data_path = "maps/full_info_trips.bin"
 full_legs_partial_path = "maps/results/full_info_legs"
 maps_response_partial_path = "maps/responses/maps_response"
 event_options_partial_path = "maps/events/event_options"
+# The day view is answered from memory; when enabled, the _with_friends copies and the
+# merged day file are also written to the bucket, before the response is sent (Cloud
+# Functions throttles the CPU of an instance once it has answered)
+PERSIST_DAY_EVENT_OPTIONS = os.environ.get("PERSIST_DAY_EVENT_OPTIONS", "false").lower() == "true"
 
 
 def process_trip_options(origin, destination, event_start_time, event_end_time, event_id, key, bucket_name):
@@ -39,6 +53,8 @@ def process_trip_options(origin, destination, event_start_time, event_end_time,
         "full_legs_path": full_legs_full_path,
         "event_options_path": event_options_full_path,
     }
+    # Imported here: the planning modules are only needed by the create and update triggers
+    from event_options_builder import build_event_options
     return build_event_options(params), event_options_full_path
 
 def event_options_save_to_db(params):
@@ -49,56 +65,68 @@ def event_options_save_to_db(params):
     bucket_name = params.get("bucket_name")
     is_recurring = params.get("isRecurring")
     recurrence_end_date = params.get("recurrence_end_date")
+    skipped_dates = set(params.get("skipped_dates") or [])
 
-    # Download the event options file from the bucket
-
-    local_file_path = os.path.join(tempfile.gettempdir(), f"event_options_{event_id}.json")
-    download_from_bucket(bucket_name, event_options_path, local_file_path)
-
-    # Read the event options from the downloaded file
+    # Read the event options from the bucket
     try:
-        with open(local_file_path, 'r', encoding='utf-8') as f:
-            event_options = json.load(f)
+        event_options = payload_routes(get_json(bucket_name, event_options_path))
     except (FileNotFoundError, json.JSONDecodeError) as e:
         return {"success": False, "message": f"Error reading event options file: {str(e)}"}
     
     # Save the event options to the database
-    db = firestore.client()
+    db = get_db()
+    writes = WriteSet(db)
+    # Recurring events are stored once as weekly patterns (see recurring_trains)
+    use_patterns = bool(is_recurring and recurrence_end_date and RECURRING_PATTERNS)
     # Update the event document with the event_options_path
     event_doc_ref = db.collection("users").document(user_id).collection("events").document(event_id)
-    event_doc_ref.set({"event_options_path": event_options_path}, merge=True)
-    
-    # Add new routes
-    for route in event_options:
-        for leg_id in route:
-            trip_id = route[leg_id].get("trip_id")
-            from_stop = route[leg_id].get("from")
-            to_stop = route[leg_id].get("to")
-            if is_recurring:
-                recurrence_counter = event_start_date
-                while(recurrence_counter <= recurrence_end_date):
-                    date_str = recurrence_counter.strftime("%Y-%m-%d")
-                    # Ensure the date document exists
-                    db.collection("trains_match").document(date_str).set({"_exists": True}, merge=True)
-                    db.collection("trains_match").document(date_str).collection("trains").document(trip_id).set({"lastModified": firestore.SERVER_TIMESTAMP,}, merge=True)
-                    db.collection("trains_match").document(date_str).collection("trains").document(trip_id).collection("users").document(user_id).set({
-                        "from": from_stop,
-                        "to": to_stop,
-                        "confirmed": False,
-                    })
-                    recurrence_counter += datetime.timedelta(days=7)
-            else:
-                date_str = event_start_date.strftime("%Y-%m-%d")
-                # Ensure the date document exists
-                db.collection("trains_match").document(date_str).set({"lastModified": firestore.SERVER_TIMESTAMP}, merge=True)
-                db.collection("trains_match").document(date_str).collection("trains").document(trip_id).set({"lastModified": firestore.SERVER_TIMESTAMP,}, merge=True)
-                db.collection("trains_match").document(date_str).collection("trains").document(trip_id).collection("users").document(user_id).set({
-                    "from": from_stop,
-                    "to": to_stop,
+    writes.set(event_doc_ref, {
+        "event_options_path": event_options_path,
+        # Trains of the options, the day view revalidates on them without reading the blob
+        "trip_ids": sorted({leg.get("trip_id") for route in event_options for leg_key, leg in route.items()
+                            if leg_key.startswith("leg") and leg.get("trip_id")}),
+        "recurrence_storage": PATTERN_STORAGE if use_patterns else firestore.DELETE_FIELD,
+    }, merge=True)
+
+    friend_ids = user_friend_ids(db, user_id)
+    if use_patterns:
+        weekday = weekday_of(event_start_date)
+        pattern = new_pattern(event_start_date, recurrence_end_date, skipped_dates)
+        for route in event_options:
+            for leg_id in route:
+                leg = route[leg_id]
+                add_pattern(writes, friend_ids, weekday, leg.get("trip_id"), user_id, event_id,
+                            {**pattern, "from": leg.get("from"), "to": leg.get("to")})
+        stats = writes.commit()
+        log_write_stats(f"Event {event_id} options saved as recurring patterns", stats)
+        return {"success": True, "message": "Event options saved to DB", "stats": stats}
+
+    dates = [date for date in recurrence_dates(event_start_date, is_recurring, recurrence_end_date)
+             if date.isoformat() not in skipped_dates]
+    # Ensure the date documents exist
+    date_doc = {"_exists": True} if is_recurring else {"lastModified": firestore.SERVER_TIMESTAMP}
+
+    # Add new routes, one write per document however many routes share it
+    for date in dates:
+        date_str = date.strftime("%Y-%m-%d")
+        date_ref = db.collection("trains_match").document(date_str)
+        writes.set(date_ref, date_doc, merge=True)
+        for route in event_options:
+            for leg_id in route:
+                trip_id = route[leg_id].get("trip_id")
+                train_ref = date_ref.collection("trains").document(trip_id)
+                membership = {
+                    "from": route[leg_id].get("from"),
+                    "to": route[leg_id].get("to"),
                     "confirmed": False,
-                })
+                }
+                writes.set(train_ref, {"lastModified": firestore.SERVER_TIMESTAMP}, merge=True)
+                writes.set(train_ref.collection("users").document(user_id), membership)
+                add_rider(writes, friend_ids, date_str, trip_id, user_id, membership)
 
-    return None
+    stats = writes.commit()
+    log_write_stats(f"Event {event_id} options saved", stats)
+    return {"success": True, "message": "Event options saved to DB", "stats": stats}
 
 def create_event_trip_options_logic(event, key, bucket_name):
     data_raw = event.data
@@ -116,20 +144,7 @@ def create_event_trip_options_logic(event, key, bucket_name):
         return
     result, event_options_full_path = process_trip_options(origin, destination, event_start_time, event_end_time, f"_{event.params['user_id']}_{event.params['event_id']}", key, bucket_name)
     if result["success"]:
-        params = {
-            "user_id": event.params["user_id"],
-            "event_id": event.params["event_id"],
-            "event_start_date": event_start_time.astimezone(ZoneInfo("Europe/Rome")).date(),
-            "event_options_path": event_options_full_path,
-            "bucket_name": bucket_name,
-            "isRecurring": data.get("recurrent"),
-            # Convert recurrence_end to Europe/Rome timezone and pass as date
-            "recurrence_end_date": (
-                data.get("recurrence_end").astimezone(ZoneInfo("Europe/Rome")).date()
-                if data.get("recurrent") and data.get("recurrence_end") else None
-            ),
-        }
-        event_options_save_to_db(params)
+        result = event_options_save_to_db(save_params(event, data, event_options_full_path, bucket_name))
         if result["success"]:
             logging.info(f"Event options saved to DB for event {event.params['event_id']}")
         else:
@@ -137,7 +152,80 @@ def create_event_trip_options_logic(event, key, bucket_name):
     else:
         logging.error(f"Error processing event options: {result['message']}")
 
-def delete_event_trip_options_logic(event):
+def save_params(event, data, event_options_path, bucket_name):
+    # event_options_save_to_db params for the event document data
+    return {
+        "user_id": event.params["user_id"],
+        "event_id": event.params["event_id"],
+        "event_start_date": data.get("event_start").astimezone(ZoneInfo("Europe/Rome")).date(),
+        "event_options_path": event_options_path,
+        "bucket_name": bucket_name,
+        "isRecurring": data.get("recurrent"),
+        # Convert recurrence_end to Europe/Rome timezone and pass as date
+        "recurrence_end_date": (
+            data.get("recurrence_end").astimezone(ZoneInfo("Europe/Rome")).date()
+            if data.get("recurrent") and data.get("recurrence_end") else None
+        ),
+        # 'YYYY-MM-DD' dates of a recurring event the user will not travel on
+        "skipped_dates": data.get("skipped_dates") or [],
+    }
+
+def recurrence_dates(event_start_date, is_recurring, recurrence_end_date):
+    if not is_recurring:
+        return [event_start_date]
+    dates = []
+    recurrence_counter = event_start_date
+    while recurrence_counter <= recurrence_end_date:
+        dates.append(recurrence_counter)
+        recurrence_counter += timedelta(days=7)
+    return dates
+
+def remove_user_from_trains(db, user_id, dates, trip_ids):
+    # Deletes every (date, trip_id, user) membership and its friends index entries
+    # in batches, then the train documents left without users
+    writes = WriteSet(db)
+    train_refs = []
+    friend_ids = user_friend_ids(db, user_id)
+    for date in dates:
+        date_str = date.strftime("%Y-%m-%d")
+        trains_ref = db.collection("trains_match").document(date_str).collection("trains")
+        for trip_id in trip_ids:
+            train_ref = trains_ref.document(trip_id)
+            train_refs.append(train_ref)
+            writes.delete(train_ref.collection("users").document(user_id))
+            remove_rider(writes, friend_ids, date_str, trip_id, user_id)
+    stats = writes.commit()
+
+    def is_empty(train_ref):
+        return not list(train_ref.collection("users").limit(1).stream())
+
+    with ThreadPoolExecutor(max_workers=FIRESTORE_WRITE_CONCURRENCY) as executor:
+        empty = list(executor.map(in_current_trace(is_empty), train_refs))
+    for train_ref, train_empty in zip(train_refs, empty):
+        if train_empty:
+            writes.delete(train_ref)
+    trains_stats = writes.commit()
+    stats["trains_removed"] = trains_stats["ops"]
+    stats["seconds"] = round(stats["seconds"] + trains_stats["seconds"], 3)
+    return stats
+
+def event_trip_ids(db, data, user_id, event_id, bucket_name=None):
+    routes = data.get("routes", [])
+    if not routes:
+        routes_docs = db.collection("users").document(user_id).collection("events").document(event_id).collection("routes").stream()
+        routes = [doc.to_dict() for doc in routes_docs]
+    trip_ids = {trip_id for route in routes for trip_id in (route.get("trip_ids") or [])}
+    # The event options were registered for every option, not only the saved routes
+    if bucket_name and data.get("event_options_path"):
+        try:
+            event_options = payload_routes(get_json(bucket_name, data["event_options_path"]))
+            trip_ids.update(leg.get("trip_id") for route in event_options for leg in route.values())
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logging.warning(f"Event options of event {event_id} not readable, removing saved routes only: {e}")
+    trip_ids.discard(None)
+    return trip_ids
+
+def delete_event_trip_options_logic(event, bucket_name=None):
     data_raw = event.data
     if not data_raw:
         return
@@ -148,36 +236,37 @@ def delete_event_trip_options_logic(event):
         data_raw = data_raw.to_dict()
     data = data_raw.to_dict() if hasattr(data_raw, 'to_dict') else data_raw
     user_id = event.params["user_id"]
-    event_start_time = data.get("event_start")
-    recurrence_counter = event_start_time.date()
-    db = firestore.client()
-    routes = data.get("routes", [])
-    if not routes:
-        event_id = event.params["event_id"]
-        routes_docs = db.collection("users").document(user_id).collection("events").document(event_id).collection("routes").stream()
-        routes = [doc.to_dict() for doc in routes_docs]
-    if data.get("recurrent"):
-        # Convert recurrence_end to Europe/Rome timezone and use date
-        recurrence_end_date = data.get("recurrence_end").astimezone(ZoneInfo("Europe/Rome")).date()
-        while recurrence_counter <= recurrence_end_date:
-            for route in routes:
-                trip_ids = route.get("trip_ids")
-                if trip_ids:
-                    for trip_id in trip_ids:
-                        try:
-                            db.collection("trains_match").document(recurrence_counter.strftime("%Y-%m-%d")).collection("trains").document(trip_id).collection("users").document(user_id).delete()
-                        except Exception as e:
-                            logging.error(f"User {user_id} is not in trip {trip_id} of date {recurrence_counter}: {e}")
-            recurrence_counter += datetime.timedelta(days=7)
+    event_id = event.params["event_id"]
+    db = get_db()
+    trip_ids = event_trip_ids(db, data, user_id, event_id, bucket_name)
+    if not trip_ids:
+        return
+
+    event_start_date = data.get("event_start").astimezone(ZoneInfo("Europe/Rome")).date()
+    if data.get("recurrence_storage") == PATTERN_STORAGE:
+        try:
+            writes, materialized = remove_event_patterns(
+                db, user_id, event_id, weekday_of(event_start_date), sorted(trip_ids), user_friend_ids(db, user_id))
+            log_write_stats(f"Event {event_id} recurring patterns removed", writes.commit())
+        except Exception as e:
+            logging.error(f"Error removing recurring patterns of event {event_id}: {e}")
+            return
+        # Only the dates the app wrote memberships for, on confirming a train
+        dates = [date_type.fromisoformat(date_str) for date_str in materialized]
+        if not dates:
+            return
     else:
-        for route in routes:
-            trip_ids = route.get("trip_ids")
-            if trip_ids:
-                for trip_id in trip_ids:
-                    try:
-                        db.collection("trains_match").document(event_start_time.date().strftime("%Y-%m-%d")).collection("trains").document(trip_id).collection("users").document(user_id).delete()
-                    except Exception as e:
-                        logging.error(f"User {user_id} is not in trip {trip_id} of date {event_start_time}: {e}")
+        # Same dates as event_options_save_to_db, which registers on the Europe/Rome date
+        dates = recurrence_dates(
+            event_start_date,
+            data.get("recurrent") and data.get("recurrence_end"),
+            data.get("recurrence_end").astimezone(ZoneInfo("Europe/Rome")).date() if data.get("recurrence_end") else None,
+        )
+    try:
+        stats = remove_user_from_trains(db, user_id, dates, sorted(trip_ids))
+        log_write_stats(f"Event {event_id} options removed ({stats['trains_removed']} empty trains)", stats)
+    except Exception as e:
+        logging.error(f"Error removing user {user_id} from trips of event {event_id}: {e}")
 
 def update_event_trip_options_logic(event, key, bucket_name):
 
@@ -185,12 +274,12 @@ def update_event_trip_options_logic(event, key, bucket_name):
         logging.error("No previous data found for event trip options update.")
         return
     else:
-        logging.error("BEFORE DATA: " + event.data.before)
+        debug_payload("BEFORE DATA", event.data.before.to_dict())
     if event.data.after is None:
         logging.error("No new data found for event trip options update.")
         return
     else:
-        logging.error("AFTER DATA: " + event.data.after)
+        debug_payload("AFTER DATA", event.data.after.to_dict())
 
     before = event.data.before.to_dict()
     after = event.data.after.to_dict()
@@ -199,66 +288,254 @@ def update_event_trip_options_logic(event, key, bucket_name):
     changed = any(before.get(k) != after.get(k) for k in keys)
 
     if not changed:
+        recurrence_keys = ["recurrent", "recurrence_end", "skipped_dates"]
+        if before.get("event_options_path") and any(before.get(k) != after.get(k) for k in recurrence_keys):
+            # Same options, only the dates they are registered on change
+            update_event_recurrence_logic(event, before, after, bucket_name)
+            return
         logging.warning("No relevant changes detected in event trip options.")
         return
     
-    delete_event_trip_options_logic(event)
+    delete_event_trip_options_logic(event, bucket_name)
     user_id = event.params["user_id"]
     event_id = event.params["event_id"]
-    db = firestore.client()
+    db = get_db()
     try:
         routes_ref = db.collection("users").document(user_id).collection("events").document(event_id).collection("routes")
+        writes = WriteSet(db)
         for doc in routes_ref.stream():
-            doc.reference.delete()
+            writes.delete(doc.reference)
+        log_write_stats(f"Event {event_id} routes deleted", writes.commit())
     except Exception as e:
         logging.error(f"Error deleting routes for event {event_id}: {e}")
     create_event_trip_options_logic(event, key, bucket_name)
 
-def get_event_full_trip_data_logic(user_id, date, bucket_name):
+def update_event_recurrence_logic(event, before, after, bucket_name):
+    user_id = event.params["user_id"]
+    event_id = event.params["event_id"]
+    params = save_params(event, after, before["event_options_path"], bucket_name)
+    if not (before.get("recurrence_storage") == PATTERN_STORAGE and params["isRecurring"]
+            and params["recurrence_end_date"] and RECURRING_PATTERNS):
+        # Registered per date: unregister from the old dates, register on the new ones
+        delete_event_trip_options_logic(event, bucket_name)
+        result = event_options_save_to_db(params)
+        if not result["success"]:
+            logging.error(f"Error saving event options to DB: {result['message']}")
+        return
 
-    logging.info(f"get_event_full_trip_data_logic called with user_id: {user_id}, date: {date}")
+    # The patterns stay, only their validity and skipped dates change
+    db = get_db()
+    weekday = weekday_of(params["event_start_date"])
+    fields = new_pattern(params["event_start_date"], params["recurrence_end_date"], params["skipped_dates"])
+    patterns_by_trip = read_patterns(db, weekday, sorted(event_trip_ids(db, before, user_id, event_id, bucket_name)), user_id)
+    friend_ids = user_friend_ids(db, user_id)
+    writes = WriteSet(db)
+    dropped = set()
+    for trip_id, patterns in patterns_by_trip.items():
+        if event_id not in patterns:
+            continue
+        add_pattern(writes, friend_ids, weekday, trip_id, user_id, event_id, fields)
+        # Memberships the app wrote on dates the event no longer runs on are removed
+        # (an array remove, so a date confirmed meanwhile stays recorded)
+        materialized = patterns[event_id].get("materialized_dates", [])
+        removed = [date_str for date_str in materialized if active_pattern({event_id: fields}, date_str)[1] is None]
+        if removed:
+            writes.set(pattern_ref(db, weekday, trip_id, user_id),
+                       {"patterns": {event_id: {"materialized_dates": firestore.ArrayRemove(removed)}}}, merge=True)
+            dropped.update(removed)
+    log_write_stats(f"Event {event_id} recurrence updated", writes.commit())
+    if dropped:
+        remove_user_from_trains(db, user_id, [date_type.fromisoformat(date_str) for date_str in sorted(dropped)], sorted(patterns_by_trip))
 
-    db = firestore.client()
+def user_rides(db, user_id, bucket_name, since):
+    # Trains the user is registered on from the date since ('YYYY-MM-DD') on, found from
+    # the user's events: {(date_str, trip_id): membership} and, for recurring patterns,
+    # {(weekday, trip_id): {event_id: pattern}}
+    membership_keys = {}
+    patterns = {}
+    for event_doc in db.collection("users").document(user_id).collection("events").stream():
+        data = event_doc.to_dict()
+        if not data.get("event_start"):
+            continue
+        # Events over before since are skipped before reading anything else
+        event_start_date = data["event_start"].astimezone(ZoneInfo("Europe/Rome")).date()
+        recurrence_end_date = (data["recurrence_end"].astimezone(ZoneInfo("Europe/Rome")).date()
+                               if data.get("recurrent") and data.get("recurrence_end") else None)
+        if (recurrence_end_date or event_start_date).isoformat() < since:
+            continue
+        # The trains of the options are on the event document, older events read them
+        # from the routes and the options blob
+        trip_ids = data.get("trip_ids")
+        if trip_ids is None:
+            trip_ids = sorted(event_trip_ids(db, data, user_id, event_doc.id, bucket_name))
+        if not trip_ids:
+            continue
+        if data.get("recurrence_storage") == PATTERN_STORAGE:
+            weekday = weekday_of(event_start_date)
+            date_strs = set()
+            for trip_id, trip_patterns in read_patterns(db, weekday, trip_ids, user_id).items():
+                pattern = trip_patterns.get(event_doc.id)
+                if pattern is None or pattern.get("valid_until", "") < since:
+                    continue
+                date_strs.update(pattern.get("materialized_dates", []))
+                patterns.setdefault((weekday, trip_id), {})[event_doc.id] = {
+                    k: v for k, v in pattern.items() if k != "materialized_dates"}
+        else:
+            date_strs = {date.isoformat() for date in recurrence_dates(
+                event_start_date, recurrence_end_date is not None, recurrence_end_date)}
+        for date_str in date_strs:
+            if date_str < since:
+                continue
+            for trip_id in trip_ids:
+                ref = (db.collection("trains_match").document(date_str).collection("trains")
+                       .document(trip_id).collection("users").document(user_id))
+                membership_keys[ref.path] = (ref, (date_str, trip_id))
+    docs = db.get_all([ref for ref, _ in membership_keys.values()]) if membership_keys else []
+    rides = {membership_keys[doc.reference.path][1]: doc.to_dict() for doc in docs if doc.exists}
+    return rides, patterns
 
-    # Fetch events for the user on the specified date
-    events_ref = db.collection("users").document(user_id).collection("events")
-    # Convert the date string to a datetime object for querying
+def prune_expired_patterns_logic(today=None):
+    # Recurring patterns stay in the weekday documents after their last date; this drops
+    # the ones ended before today (Europe/Rome), then the trains_match memberships the
+    # app wrote for them, which deleting the event could no longer find
+    db = get_db()
+    date_str = (today or datetime.now(ZoneInfo("Europe/Rome")).date()).isoformat()
+    writes = WriteSet(db)
+    dropped = 0
+    materialized = {}
+    for weekday in weekdays:
+        dropped += prune_friends_recurring(writes, weekday, date_str)
+        materialized.update(prune_patterns(writes, weekday, date_str))
+    log_write_stats(f"Recurring patterns ended before {date_str} pruned", writes.commit())
+    for (user_id, trip_id), dates in sorted(materialized.items()):
+        remove_user_from_trains(db, user_id, [date_type.fromisoformat(date_str) for date_str in dates], [trip_id])
+    return {"friends_entries": dropped, "memberships": sum(len(dates) for dates in materialized.values())}
 
-    # Parse the input date (expected format: 'YYYY-MM-DD')
+def update_friends_trains_friendship_logic(event, bucket_name=None):
+    # Friendships are written on both users: each update of a user's friends indexes the
+    # rides of the friends added and drops the entries of the friends removed, in the
+    # friends trains index of that user only. Past dates are left as they are
+    before = event.data.before.to_dict() if event.data.before else {}
+    after = event.data.after.to_dict() if event.data.after else {}
+    before_friends = set(before.get("friends") or {})
+    after_friends = set(after.get("friends") or {})
+    if before_friends == after_friends:
+        return
+    user_id = event.params["user_id"]
+    db = get_db()
+    since = datetime.now(ZoneInfo("Europe/Rome")).date().isoformat()
+    writes = WriteSet(db)
+    for friend_id in sorted(before_friends ^ after_friends):
+        added = friend_id in after_friends
+        rides, patterns = user_rides(db, friend_id, bucket_name, since)
+        for (date_str, trip_id), membership in sorted(rides.items()):
+            if added:
+                add_rider(writes, [user_id], date_str, trip_id, friend_id, membership)
+            else:
+                remove_rider(writes, [user_id], date_str, trip_id, friend_id)
+        for (weekday, trip_id), event_patterns in sorted(patterns.items()):
+            riders = {friend_id: event_patterns if added else firestore.DELETE_FIELD}
+            writes.set(friends_recurring_ref(db, weekday, user_id), {"trips": {trip_id: riders}}, merge=True)
+    log_write_stats(f"Friends trains index of {user_id} updated for {len(before_friends ^ after_friends)} friends", writes.commit())
+
+def load_day_events(user_id, date, friends_context):
+    # Event options path and trip ids (None if not stored) of each event of the user on
+    # the date (expected format: 'YYYY-MM-DD')
+    events_ref = friends_context["db"].collection("users").document(user_id).collection("events")
     start_dt = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
     end_dt = start_dt + timedelta(days=1)
 
     query = events_ref.where("event_start", ">=", start_dt).where("event_start", "<", end_dt)
-    events_docs = list(query.stream())
+    with span("firestore.read"):
+        events_docs = list(query.stream())
+    record_reads(friends_context, max(1, len(events_docs)))
 
     logging.info(f"Found {len(events_docs)} events for user {user_id} on date {date}")
+
+    event_paths = {}
+    event_trips = {}
     for event in events_docs:
-        logging.info(f"Event ID: {event.id}, Data: {event.to_dict()}")
+        record_version(friends_context, event)
+        data = event.to_dict()
+        event_options_path = data.get("event_options_path")
+        if event_options_path:
+            event_paths[event.id] = event_options_path
+            event_trips[event.id] = data.get("trip_ids")
+        else:
+            logging.warning(f"Event {event.id} has no event options yet")
+    return event_paths, event_trips
 
-    event_options_with_friends = {}
+def record_blob_generation(friends_context, bucket_name, path):
+    # Read before the blob itself: a blob replaced in between changes the next ETag
+    info = get_blob_info(bucket_name, path)
+    friends_context["versions"].append((path, str(info["generation"]) if info else None))
 
-    # add friends info to event options
-    for event in events_docs:
-        friends_finder_params = {
-            "event_options_path": event.to_dict().get("event_options_path"),
-            "user_id": user_id,
-            "bucket_name": bucket_name,
-            "date": date
-        }
-        event_options_with_friends[event.id] = get_event_trip_friends_logic(friends_finder_params)
-
-    logging.info(f"event_options_with_friends: {event_options_with_friends}")
-
-    #merge all event options of the day into a single file
-    merger_params = {
-        "event_options_with_friends": event_options_with_friends,
-        "bucket_name": bucket_name,
-        "date": date,
-        "user_id": user_id
-    }
+def day_options_etag(friends_context, response_format):
+    # Weak ETag over the versions of everything the day response was built from
+    # (a document read twice, e.g. by an early revalidation, counts once)
+    versions = json.dumps([response_format, sorted(set(friends_context["versions"]))], default=str)
+    return 'W/"' + hashlib.sha256(versions.encode('utf-8')).hexdigest()[:32] + '"'
+
+def build_day_event_options(user_id, date, bucket_name, response_format=COMPACT, known_etags=()):
+    # Day response built in memory as a compact payload (see leg_payloads) with
+    # "events": {event_id: routes with friends}, plus the event options path of each event
+    # and the response ETag. The payload is None when the user has no event options that
+    # day, or when one of known_etags is still current
+    db = get_db()
+    # Friend profiles and train memberships are read once for all events of the day
+    friends_context = new_friends_context(db)
+    event_paths, event_trips = load_day_events(user_id, date, friends_context)
+    if not event_paths:
+        return None, event_paths, None
+
+    workers = min(8, len(event_paths))
+    if known_etags and (load_friends_trains(friends_context, user_id, date)
+                        or load_trips_memberships(friends_context, user_id, date, event_trips.values())):
+        # Every version is known before the blobs are read, from the friends trains index
+        # or from the memberships of the trains listed on the event documents
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(in_current_trace(lambda path: record_blob_generation(friends_context, bucket_name, path)), event_paths.values()))
+        etag = day_options_etag(friends_context, response_format)
+        if etag in known_etags:
+            return None, event_paths, etag
+        fetch = lambda path: get_json(bucket_name, path)
+    else:
+        def fetch(path):
+            record_blob_generation(friends_context, bucket_name, path)
+            return get_json(bucket_name, path)
+
+    # Event options blobs are downloaded concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        event_options = list(executor.map(in_current_trace(fetch), event_paths.values()))
+
+    # add friends info to event options, the stops of a trip shared by several events are kept once
+    writer = PayloadWriter()
+    events = {}
+    with span("day_options.add_friends"):
+        for event_id, payload in zip(event_paths, event_options):
+            events[event_id] = add_friends_to_routes(writer.add_payload(payload), user_id, date, friends_context)
 
-    day_events_options = get_day_event_trip_options_logic(merger_params)
+    logging.debug(f"Firestore reads for user {user_id} on {date}: {friends_context['reads']}")
+    return writer.payload(events=events), event_paths, day_options_etag(friends_context, response_format)
 
-    return day_events_options
+def persist_day_event_options(day_options, event_paths, user_id, date, bucket_name):
+    # Writes the _with_friends copies and the merged day file, returns the merged file path
+    for event_id, routes in day_options["events"].items():
+        put_json(bucket_name, event_paths[event_id] + "_with_friends.json", encode_routes(routes, source=day_options))
+    return save_day_event_options(day_options, bucket_name, date, user_id)
 
-    # return None
\ No newline at end of file
+def get_day_event_options_logic(user_id, date, bucket_name, response_format=COMPACT, known_etags=()):
+    # Read path of get_event_full_trip_data: returns (day options as a compact payload, ETag).
+    # The day options are None if there are none, or if the ETag is one of known_etags
+    logging.info(f"get_day_event_options_logic called with user_id: {user_id}, date: {date}")
+    day_options, event_paths, etag = build_day_event_options(user_id, date, bucket_name, response_format, known_etags)
+    if etag in known_etags:
+        return None, etag
+    if day_options and PERSIST_DAY_EVENT_OPTIONS:
+        # A failed copy does not fail the request, the response is built from memory
+        try:
+            with span("day_options.persist"):
+                persist_day_event_options(day_options, event_paths, user_id, date, bucket_name)
+        except Exception as e:
+            logging.error(f"Error persisting day event options of user {user_id} on {date}: {e}")
+    return day_options, etag
@@ -0,0 +1,98 @@
+import os
+from firebase_admin import firestore
+from db_manager import get_db, WriteSet, log_write_stats
+from recurring_trains import record_materialized_date, pattern_membership
+
+# Per-(date, user) index of the trains friends ride, maintained when memberships
+# are written so the day view does not query every leg at read time:
+#
+#   friends_trains/{date}/users/{user_id}
+#       {"trips": {trip_id: {friend_id: {"from": ..., "to": ..., "confirmed": ...}}}}
+#
+# A rider is fanned out to the documents of all its friends (friendships are mutual,
+# so a user's document collects every friend riding that day). Ghosting and mood are
+# not stored: they are applied when the index is read. Reads use the index only when
+# USE_FRIENDS_TRAINS_INDEX is on, after rebuild_friends_trains_index has backfilled
+# the dates registered before the index existed (call_rebuild_friends_trains_index,
+# callable by admins only).
+USE_FRIENDS_TRAINS_INDEX = os.environ.get("USE_FRIENDS_TRAINS_INDEX", "false").lower() == "true"
+friends_trains_collection = "friends_trains"
+
+
+def friends_trains_ref(db, date_str, user_id):
+    return db.collection(friends_trains_collection).document(date_str).collection("users").document(user_id)
+
+def user_friend_ids(db, user_id):
+    user_doc = db.collection("users").document(user_id).get()
+    if not user_doc.exists:
+        return []
+    return list(user_doc.to_dict().get("friends", {}))
+
+def add_rider(writes, friend_ids, date_str, trip_id, user_id, membership):
+    entry = {
+        "from": membership.get("from", ""),
+        "to": membership.get("to", ""),
+        "confirmed": membership.get("confirmed", False),
+    }
+    for friend_id in friend_ids:
+        writes.set(friends_trains_ref(writes.db, date_str, friend_id), {"trips": {trip_id: {user_id: entry}}}, merge=True)
+
+def remove_rider(writes, friend_ids, date_str, trip_id, user_id):
+    for friend_id in friend_ids:
+        writes.set(friends_trains_ref(writes.db, date_str, friend_id),
+                   {"trips": {trip_id: {user_id: firestore.DELETE_FIELD}}}, merge=True)
+
+def friends_trains_from_doc(doc):
+    # {trip_id: {friend_id: membership}}, or None when the user has no index document
+    if not doc.exists:
+        return None
+    return {trip_id: riders for trip_id, riders in doc.to_dict().get("trips", {}).items() if riders}
+
+def update_friends_trains_confirmation_logic(event):
+    # Membership documents are confirmed by the app; keep the friends' entries in sync.
+    # On a recurring train the app creates the date's membership with only the
+    # confirmation, from/to come from the pattern (see recurring_trains).
+    # Called on creates, with the new snapshot as event.data, and on updates with a Change
+    if hasattr(event.data, "after"):
+        before = event.data.before.to_dict() if event.data.before else {}
+        after = event.data.after.to_dict() if event.data.after else None
+    else:
+        before = {}
+        after = event.data.to_dict() if event.data else None
+    if after is None or before.get("confirmed") == after.get("confirmed"):
+        return
+    if not before and "from" in after:
+        # Registered by event_options_save_to_db, which already updated the index
+        return
+    db = get_db()
+    user_id = event.params["user_id"]
+    date_str = event.params["date"]
+    trip_id = event.params["trip_id"]
+    if "from" not in after:
+        pattern = record_materialized_date(db, user_id, date_str, trip_id)
+        if pattern is not None:
+            after = {**pattern_membership(pattern), **after}
+    writes = WriteSet(db)
+    add_rider(writes, user_friend_ids(db, user_id), date_str, trip_id, user_id, after)
+    writes.commit()
+
+def rebuild_friends_trains_index(date_str, db=None):
+    # Recomputes the whole index of one date from trains_match
+    db = db or get_db()
+    riders_by_trip = {}
+    for train_doc in db.collection("trains_match").document(date_str).collection("trains").stream():
+        riders_by_trip[train_doc.id] = {doc.id: doc.to_dict() for doc in train_doc.reference.collection("users").stream()}
+    rider_ids = sorted({user_id for riders in riders_by_trip.values() for user_id in riders})
+    user_docs = db.get_all([db.collection("users").document(user_id) for user_id in rider_ids]) if rider_ids else []
+    friends_of = {doc.id: list(doc.to_dict().get("friends", {})) for doc in user_docs if doc.exists}
+
+    writes = WriteSet(db)
+    # Stale documents of users that no longer have friends on a train are emptied
+    for doc in db.collection(friends_trains_collection).document(date_str).collection("users").stream():
+        writes.set(doc.reference, {"trips": {}})
+    for trip_id, riders in riders_by_trip.items():
+        for user_id, membership in riders.items():
+            add_rider(writes, friends_of.get(user_id, []), date_str, trip_id, user_id, membership)
+    stats = writes.commit()
+    log_write_stats(f"Friends trains index of {date_str} rebuilt", stats)
+    return stats
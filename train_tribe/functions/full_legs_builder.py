@@ -1,16 +1,31 @@
 import json
-import os
 import logging
-from bucket_manager import upload_to_bucket, download_from_bucket
-import tempfile
+import time
+from bucket_manager import get_json, put_json
+from trips_cache import get_trips_dataset
+from trips_table import NO_TIME
+from leg_payloads import encode_routes
+from tracing import add_span, count, debug_payload
+from trip_index import lookup_short_name
+from stop_resolver import resolve_stop_names, find_stop_index_in, save_stop_aliases
 from datetime import datetime
 from rapidfuzz import fuzz
 
-def find_stop_index(trip, stop_name):
+def is_trenord_agency(step):
+    # Transit step run by Trenord, the only agency in the GTFS feed
+    agencies = step['transit_details']['line'].get('agencies', [])
+    agency_name = agencies[0]['name'] if agencies and 'name' in agencies[0] else ''
+    return 'trenord' in agency_name.lower()
+
+def find_stop_index(table, trip_idx, stop_name):
     best_match_idx = None
     best_match_ratio = 0.0
-    for idx, stop in enumerate(trip['stops']):
-        match_ratio = fuzz.ratio(stop['stop_name'].lower(), stop_name.lower())
+    stop_name = stop_name.lower()
+    for idx, row in enumerate(table.stop_range(trip_idx)):
+        trip_stop_name = table.stop_names[table.stop_index[row]]
+        if not trip_stop_name:
+            continue
+        match_ratio = fuzz.ratio(trip_stop_name.lower(), stop_name)
         if match_ratio > best_match_ratio:
             best_match_ratio = match_ratio
             best_match_idx = idx
@@ -25,63 +40,84 @@ def normalize_time(time_str):
     except ValueError:
         return time_str[:5]  # fallback to existing behavior
 
-def find_matching_trip(possible_trips, trip_short_name, departure_time, departure_stop_name):
-    if len(possible_trips) == 1:
-        # logging.warning(f"Only one possible trip for short name {trip_short_name}")
-        return possible_trips[0]
-    
-    normalized_departure_time = normalize_time(departure_time)
-    
+def time_to_minutes(time_str):
+    try:
+        hours, minutes = time_str.split(':')[:2]
+        return int(hours) * 60 + int(minutes)
+    except (AttributeError, ValueError):
+        return None
+
+def locate_stop(table, trip_idx, stop_name, stop_positions, start=0):
+    # Resolved stops first, fuzzy matching on the trip's stops only as a fallback
+    if stop_positions:
+        idx = find_stop_index_in(table, trip_idx, stop_positions, start)
+        if idx is not None:
+            return idx
+    return find_stop_index(table, trip_idx, stop_name)
+
+def find_trips_departing_at(table, possible_trips, departure_minutes, departure_stop_name, departure_stops):
     matching_trips = []
 
-    for trip in possible_trips:
-        dep_stop_idx = find_stop_index(trip, departure_stop_name)
+    for trip_idx in possible_trips:
+        if departure_stops:
+            dep_stop_idx = find_stop_index_in(table, trip_idx, departure_stops)
+        else:
+            dep_stop_idx = find_stop_index(table, trip_idx, departure_stop_name)
         
         if dep_stop_idx is not None:
-            trip_dep_time = trip['stops'][dep_stop_idx].get('departure_time')
+            trip_dep_time = table.departure[table.trip_stop_offsets[trip_idx] + dep_stop_idx]
             # logging.warning(f"departure stop found: index = {dep_stop_idx}, name = {departure_stop_name}.")
             
-            if trip_dep_time and trip_dep_time.startswith(normalized_departure_time):
-                # logging.warning(f"Found matching trip for short name {trip_short_name}: {trip['trip_id']}")
-                matching_trips.append(trip)
+            if trip_dep_time != NO_TIME and trip_dep_time // 60 == departure_minutes:
+                # logging.warning(f"Found matching trip: {table.trip_ids[trip_idx]}")
+                matching_trips.append(trip_idx)
             # else:
-                # logging.warning(f"Time doesn't match! trip_dep_time: {trip_dep_time}, departure_time: {departure_time}, trip_short_name: {trip_short_name}")
+                # logging.warning(f"Time doesn't match! trip_dep_time: {trip_dep_time}, departure_minutes: {departure_minutes}")
+    return matching_trips
+
+def find_matching_trip(table, possible_trips, trip_short_name, departure_time, departure_stop_name, departure_stops=None):
+    # Returns the position of the matching trip in the trips table, or None
+    if len(possible_trips) == 1:
+        # logging.warning(f"Only one possible trip for short name {trip_short_name}")
+        return possible_trips[0]
+    
+    departure_minutes = time_to_minutes(normalize_time(departure_time))
+    
+    matching_trips = find_trips_departing_at(table, possible_trips, departure_minutes, departure_stop_name, departure_stops)
+    if not matching_trips and departure_stops:
+        # The resolved station may not be the one these trips use, retry with fuzzy matching
+        matching_trips = find_trips_departing_at(table, possible_trips, departure_minutes, departure_stop_name, None)
     
     if len(matching_trips) == 1:
         return matching_trips[0]
     elif len(matching_trips) > 1:
         # If there are multiple matches, return the one with the highest number of stops
-        matching_trips.sort(key=lambda x: len(x['stops']), reverse=True)
-        return matching_trips[0]
+        return max(matching_trips, key=table.stop_count)
     else:
         logging.warning(f"No matching trip found for short name {trip_short_name} with departure_time:{departure_time} from: {departure_stop_name}")
         return None
 
 def build_full_info_maps_legs(params):
     try:
-        logging.info("Starting build_full_info_maps_legs with params: %s", params)
-
-        # Prepare file paths
-        trips_path = os.path.join(tempfile.gettempdir(), "full_info_trips.json")
-        maps_path = os.path.join(tempfile.gettempdir(), "maps_response.json")
-
         output_path = params["full_legs_path"]
         bucket_name = params["bucket_name"]
         trips_blob = params["trips_path"]
         maps_blob = params["maps_path"]
+        service_date = params.get("service_date")  # ISO date of the event, optional
 
-        # Download input files
-        download_from_bucket(bucket_name, trips_blob, trips_path)
-        download_from_bucket(bucket_name, maps_blob, maps_path)
+        # Trips are served from the warm-instance cache, only reloaded when the blob changes
+        dataset = get_trips_dataset(bucket_name, trips_blob)
+        table = dataset["table"]
+        short_name_index = dataset["short_name_index"]
+        stop_resolver = dataset["stop_resolver"]
 
-        # Load trips and maps
-        with open(trips_path, encoding='utf-8') as f:
-            trips = json.load(f)
-        with open(maps_path, encoding='utf-8') as f:
-            maps = json.load(f)
+        # The caller may hand over the response it already has in memory
+        maps = params.get("maps_response")
+        if maps is None:
+            maps = get_json(bucket_name, maps_blob)
 
-        logging.info("Trips loaded: %s", trips)
-        logging.info("Maps loaded: %s", maps)
+        logging.debug("Trips loaded: %d trips", table.trip_count())
+        debug_payload("Maps loaded", maps)
 
     except FileNotFoundError as e:
         logging.error("File not found: %s", e)
@@ -91,34 +127,31 @@ def build_full_info_maps_legs(params):
         return {"success": False, "message": f"JSON parsing error: {str(e)}"}
 
     try:
-        # Group trips by short name to handle multiple trips with same short name
-        trips_by_short_name = {}
-        for trip in trips:
-            if 'trip_short_name' in trip:
-                if trip['trip_short_name'] not in trips_by_short_name:
-                    trips_by_short_name[trip['trip_short_name']] = []
-                trips_by_short_name[trip['trip_short_name']].append(trip)
-
-        logging.info("Trips grouped by short name")
+        started = time.perf_counter()
+        # Resolve every station name of the response to GTFS stops in one batch
+        station_names = []
+        for route in maps['routes']:
+            for leg in route['legs']:
+                for step in leg['steps']:
+                    if step.get('travel_mode') == 'TRANSIT':
+                        td = step['transit_details']
+                        station_names.append(td['departure_stop']['name'])
+                        station_names.append(td['arrival_stop']['name'])
+        stops_by_name = resolve_stop_names(stop_resolver, station_names)
 
         all_routes = []
         for route_idx, route in enumerate(maps['routes']):
-            logging.info("Processing route %d", route_idx)
             route_result = {}
             route_has_non_trenord = False
             
             for leg_idx, leg in enumerate(route['legs']):
-                logging.info("Processing leg %d", leg_idx)
                 step_num = 0
                 
                 for step in leg['steps']:
                     # Skip non-Trenord transit steps or non-rail transit
-                    if step.get('travel_mode') == 'TRANSIT':
-                        agencies = step['transit_details']['line'].get('agencies', [])
-                        agency_name = agencies[0]['name'] if agencies and 'name' in agencies[0] else ''
-                        if 'trenord' not in agency_name.lower():
-                            route_has_non_trenord = True
-                            continue
+                    if step.get('travel_mode') == 'TRANSIT' and not is_trenord_agency(step):
+                        route_has_non_trenord = True
+                        continue
                     
                     if (step.get('travel_mode') == 'TRANSIT' and 
                         step['transit_details']['line']['vehicle']['type'] == 'HEAVY_RAIL'):
@@ -127,23 +160,32 @@ def build_full_info_maps_legs(params):
                         trip_short_name = td['trip_short_name']
                         
                         # Find possible trips with this short name
-                        possible_trips = next((v for k, v in trips_by_short_name.items() if trip_short_name in k), [])
+                        possible_trips = lookup_short_name(short_name_index, trip_short_name)
+                        if service_date and table.has_calendar():
+                            # Only trips running on the event date, unless the calendar rules out all of them
+                            running = [trip_idx for trip_idx in possible_trips if table.runs_on(trip_idx, service_date)]
+                            possible_trips = running or possible_trips
                         
+                        departure_stops = stops_by_name.get(td['departure_stop']['name'])
+                        arrival_stops = stops_by_name.get(td['arrival_stop']['name'])
+
                         # Find the exact matching trip
-                        trip = find_matching_trip(
+                        trip_idx = find_matching_trip(
+                            table,
                             possible_trips, 
                             trip_short_name, 
                             td['departure_time']['text'], 
-                            td['departure_stop']['name']
+                            td['departure_stop']['name'],
+                            departure_stops
                         )
                         
-                        if not trip:
+                        if trip_idx is None:
                             logging.error(f"Trip not found for trip_short_name: {trip_short_name}")
                             continue
                         
                         # Find stop indices
-                        from_idx = find_stop_index(trip, td['departure_stop']['name'])
-                        to_idx = find_stop_index(trip, td['arrival_stop']['name'])
+                        from_idx = locate_stop(table, trip_idx, td['departure_stop']['name'], departure_stops)
+                        to_idx = locate_stop(table, trip_idx, td['arrival_stop']['name'], arrival_stops, from_idx or 0)
                         
                         if from_idx is None:
                             logging.error(f"Stop index not found for trip: {trip_short_name}, --from-- stop name: {td['departure_stop']['name']}")
@@ -153,24 +195,12 @@ def build_full_info_maps_legs(params):
                             logging.error(f"Stop index not found for trip: {trip_short_name}, --to-- stop name: {td['arrival_stop']['name']}")
                             continue
                         
-                        # Prepare stops output
-                        stops = trip['stops']
-                        stops_out = []
-                        for s in stops:
-                            stops_out.append({
-                                'stop_id': s['stop_id'],
-                                'stop_name': s['stop_name'],
-                                'stop_sequence': s['stop_sequence'],
-                                'arrival_time': s.get('arrival_time'),
-                                'departure_time': s.get('departure_time')
-                            })
-                        
-                        # Add leg to route result
+                        # Add leg to route result, the stops stay in the trips table
+                        first_row = table.trip_stop_offsets[trip_idx]
                         route_result[f'leg{step_num}'] = {
-                            'trip_id': trip['trip_id'],
-                            'stops': stops_out,
-                            'from': stops[from_idx]['stop_id'],
-                            'to': stops[to_idx]['stop_id']
+                            'trip_id': table.trip_ids[trip_idx],
+                            'from': table.stop_ids[table.stop_index[first_row + from_idx]],
+                            'to': table.stop_ids[table.stop_index[first_row + to_idx]]
                         }
                         step_num += 1
             
@@ -178,22 +208,22 @@ def build_full_info_maps_legs(params):
             if route_result and not route_has_non_trenord:
                 all_routes.append(route_result)
         
-        logging.info("All routes processed: %s", all_routes)
+        add_span("legs.matching", time.perf_counter() - started)
+        count("legs.matched", sum(len(route) for route in all_routes))
+        debug_payload("All routes processed", all_routes)
+
+        save_stop_aliases(stop_resolver, bucket_name)
 
     except KeyError as e:
         logging.error("KeyError: %s", e)
         return {"success": False, "message": f"Data structure error: {str(e)}"}
 
     try:
-        # Save output to temporary file and upload to bucket
-        tmp_output_path = os.path.join(tempfile.gettempdir(), "full_info_maps_legs.json")
-        with open(tmp_output_path, 'w', encoding='utf-8') as f:
-            json.dump(all_routes, f, indent=2, ensure_ascii=False)
-
-        upload_to_bucket(tmp_output_path, output_path, bucket_name)
+        # Upload output to bucket
+        put_json(bucket_name, output_path, encode_routes(all_routes, table))
 
     except IOError as e:
         logging.error("Error saving file: %s", e)
         return {"success": False, "message": f"Error saving file: {str(e)}", "full_legs": all_routes}
 
-    return {"success": True, "message": "File saved successfully"}
\ No newline at end of file
+    return {"success": True, "message": "File saved successfully", "full_legs": all_routes}
\ No newline at end of file
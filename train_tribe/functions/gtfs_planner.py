@@ -0,0 +1,178 @@
+import array
+import bisect
+import logging
+import threading
+from trips_table import NO_TIME
+from stop_resolver import resolve_stop_names
+
+# Offline journey planner over the Trenord timetable (Connection Scan Algorithm).
+# It answers "which trains get me from origin to destination in this time window"
+# straight from the trips table and emits the same leg0..legN route structure as
+# build_full_info_maps_legs, so no Directions call and no matching step is needed.
+#
+# Stops sharing a station name are one station. Changing trains needs
+# min_transfer_seconds, staying on board does not.
+min_transfer_seconds = 5 * 60
+max_journeys = 30
+max_legs = 8
+
+_planner_lock = threading.Lock()
+
+
+def build_connections(table, stations_of_stops):
+    # One connection per pair of consecutive stops of a trip, sorted by departure
+    dep, arr, from_station, to_station, trip, from_row = (array.array('i') for _ in range(6))
+    for trip_idx in range(table.trip_count()):
+        rows = table.stop_range(trip_idx)
+        for row in rows[:-1]:
+            departure = table.departure[row]
+            arrival = table.arrival[row + 1]
+            if departure == NO_TIME or arrival == NO_TIME:
+                continue
+            dep.append(departure)
+            arr.append(arrival)
+            from_station.append(stations_of_stops[table.stop_index[row]])
+            to_station.append(stations_of_stops[table.stop_index[row + 1]])
+            trip.append(trip_idx)
+            from_row.append(row)
+
+    order = sorted(range(len(dep)), key=dep.__getitem__)
+    return {
+        name: array.array('i', (column[i] for i in order))
+        for name, column in (("dep", dep), ("arr", arr), ("from_station", from_station),
+                             ("to_station", to_station), ("trip", trip), ("from_row", from_row))
+    }
+
+
+def get_planner(dataset):
+    # Built lazily once per trips dataset version and kept with it in the cache
+    planner = dataset.get("planner")
+    if planner is not None:
+        return planner
+    with _planner_lock:
+        if dataset.get("planner") is None:
+            table = dataset["table"]
+            resolver = dataset["stop_resolver"]
+            stations_of_stops = array.array('i', range(len(table.stop_ids)))
+            for station, stops in enumerate(resolver["stops_by_name"].values()):
+                for stop_idx in stops:
+                    stations_of_stops[stop_idx] = len(table.stop_ids) + station
+            dataset["planner"] = {
+                "table": table,
+                "resolver": resolver,
+                "stations_of_stops": stations_of_stops,
+                "connections": build_connections(table, stations_of_stops),
+            }
+            logging.info("GTFS planner built: %d connections", len(dataset["planner"]["connections"]["dep"]))
+    return dataset["planner"]
+
+
+def earliest_arrival(planner, origins, destinations, depart_after, last_departure, runs=None):
+    # Earliest-arrival scan over the connections departing from depart_after to
+    # last_departure; returns the journey as [(trip_idx, from_row, to_row), ...] or None
+    c = planner["connections"]
+    dep, arr, from_station, to_station, trip, from_row = (
+        c["dep"], c["arr"], c["from_station"], c["to_station"], c["trip"], c["from_row"])
+    ready = {station: depart_after for station in origins}  # earliest time a train can be boarded
+    arrived = {}
+    boarded = {}  # trip_idx -> connection where the trip was boarded
+    via = {}  # station -> (boarding connection, alighting connection)
+    best = None
+
+    for i in range(bisect.bisect_left(dep, depart_after), len(dep)):
+        departure = dep[i]
+        if departure > last_departure or (best is not None and departure > best):
+            break
+        trip_idx = trip[i]
+        if trip_idx not in boarded:
+            if ready.get(from_station[i], last_departure + 1) > departure:
+                continue
+            if runs is not None and not runs(trip_idx):
+                continue
+            boarded[trip_idx] = i
+        station = to_station[i]
+        if station not in arrived or arr[i] < arrived[station]:
+            arrived[station] = arr[i]
+            via[station] = (boarded[trip_idx], i)
+            if station not in origins:
+                ready[station] = min(ready.get(station, arr[i] + min_transfer_seconds), arr[i] + min_transfer_seconds)
+            if station in destinations and (best is None or arr[i] < best):
+                best = arr[i]
+                target = station
+
+    if best is None:
+        return None
+
+    journey = []
+    station = target
+    while station not in origins:
+        if len(journey) > max_legs:
+            return None
+        enter, leave = via[station]
+        journey.append((trip[enter], from_row[enter], from_row[leave] + 1))
+        station = from_station[enter]
+    journey.reverse()
+    return journey
+
+
+def journey_in_window(table, journey, window_start, window_end):
+    # Same test as select_routes in event_options_builder: the arrival times at the from
+    # and to stops of every leg are in the window, at minute resolution
+    start_minute = -(-window_start // 60)
+    end_minute = window_end // 60
+    for _, from_row, to_row in journey:
+        for row in (from_row, to_row):
+            arrival = table.arrival[row]
+            if arrival != NO_TIME and not start_minute <= arrival // 60 <= end_minute:
+                return False
+    return True
+
+
+def journey_to_route(table, journey):
+    # Lean legs, the stops stay in the trips table (see leg_payloads)
+    route = {}
+    for leg_num, (trip_idx, from_row, to_row) in enumerate(journey):
+        route[f'leg{leg_num}'] = {
+            'trip_id': table.trip_ids[trip_idx],
+            'from': table.stop_ids[table.stop_index[from_row]],
+            'to': table.stop_ids[table.stop_index[to_row]],
+        }
+    return route
+
+
+def plan_window(planner, origin, destination, window_start, window_end, runs=None):
+    # All non-dominated journeys within the window (seconds after midnight), found by
+    # repeating the earliest-arrival scan just after each journey's departure. Only trains
+    # departing inside the window are scanned, and only the journeys select_routes keeps
+    # count toward max_journeys
+    table = planner["table"]
+    resolved = resolve_stop_names(planner["resolver"], [origin, destination])
+    if not resolved.get(origin) or not resolved.get(destination):
+        logging.warning("GTFS planner could not resolve %s -> %s", origin, destination)
+        return None
+    stations = planner["stations_of_stops"]
+    origins = {stations[stop] for stop in resolved[origin]}
+    destinations = {stations[stop] for stop in resolved[destination]}
+
+    journeys = []
+    depart_after = window_start
+    while len(journeys) < max_journeys:
+        journey = earliest_arrival(planner, origins, destinations, depart_after, window_end, runs)
+        if journey is None:
+            break
+        _, first_row, _ = journey[0]
+        _, _, last_row = journey[-1]
+        departure = table.departure[first_row]
+        arrival = table.arrival[last_row]
+        if arrival > window_end:
+            break
+        depart_after = departure + 1
+        if not journey_in_window(table, journey, window_start, window_end):
+            continue
+        # A later departure with the same arrival dominates the previous journey,
+        # unless the previous one needs fewer changes
+        while journeys and journeys[-1][1] >= arrival and len(journeys[-1][2]) >= len(journey):
+            journeys.pop()
+        journeys.append((departure, arrival, journey))
+
+    return [journey_to_route(table, journey) for _, _, journey in journeys]
@@ -1,103 +1,349 @@
 import json
 import csv
+import hashlib
 import requests
 import zipfile
 import io
 import os
+import logging
+import resource
 import tempfile
-from bucket_manager import upload_to_bucket
+import time
+from bucket_manager import upload_to_bucket, get_json, put_json, list_blobs, delete_blob
+from trips_table import TripsTableWriter
+from service_calendar import build_service_calendar
+from tracing import add_span
+
+zip_url = "https://www.dati.lombardia.it/download/3z4k-mxz9/application%2Fzip"
+download_chunk_size = 1024 * 1024
+# Published feed versions: maps/versions/{version}/full_info_trips.bin + manifest.json
+versions_partial_path = "maps/versions/"
+# Published versions kept in the bucket, older ones are deleted after each publish
+FEED_VERSIONS_KEPT = int(os.environ.get("FEED_VERSIONS_KEPT", 5))
+
+
+class UnsortedStopTimesError(Exception):
+    pass
+
+
+def record_stage(stats, stage, started):
+    # ru_maxrss is in KiB on Linux and is the peak of the whole process so far
+    entry = {
+        "stage": stage,
+        "seconds": round(time.perf_counter() - started, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    stats.append(entry)
+    add_span(f"jsonify.{stage}", entry["seconds"])
+    logging.info("jsonify stage %s: %.3fs, peak RSS %.1f MB", stage, entry["seconds"], entry["peak_rss_mb"])
+
+
+def open_csv(z, filename):
+    # Rows are decoded straight from the archive member, nothing is extracted to disk
+    return csv.reader(io.TextIOWrapper(z.open(filename), encoding='utf-8-sig', newline=''))
+
+
+def read_csv_dicts(z, filename):
+    with io.TextIOWrapper(z.open(filename), encoding='utf-8-sig', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def iter_trip_stop_times(z, stop_id_to_name, assume_sorted=True):
+    # Yields (trip_id, stops) one trip at a time. GTFS feeds normally list stop_times
+    # grouped by trip, so only the current trip is held in memory. If a trip shows up
+    # again after being emitted, UnsortedStopTimesError is raised and the caller can
+    # retry with assume_sorted=False, which groups the whole file in memory first.
+    reader = open_csv(z, 'stop_times.txt')
+    header = next(reader)
+    col = {name: idx for idx, name in enumerate(header)}
+    trip_col = col['trip_id']
+    stop_col = col['stop_id']
+    seq_col = col['stop_sequence']
+    arr_col = col['arrival_time']
+    dep_col = col['departure_time']
+
+    def stop_info(row):
+        return {
+            "stop_id": row[stop_col],
+            "stop_name": stop_id_to_name.get(row[stop_col], None),
+            "stop_sequence": row[seq_col],
+            "arrival_time": row[arr_col],
+            "departure_time": row[dep_col]
+        }
+
+    if not assume_sorted:
+        trips_dict = {}
+        for row in reader:
+            trips_dict.setdefault(row[trip_col], []).append(stop_info(row))
+        yield from trips_dict.items()
+        return
+
+    emitted = set()
+    current_trip_id = None
+    current_stops = []
+    for row in reader:
+        trip_id = row[trip_col]
+        if trip_id != current_trip_id:
+            if current_trip_id is not None:
+                emitted.add(current_trip_id)
+                yield current_trip_id, current_stops
+            if trip_id in emitted:
+                raise UnsortedStopTimesError(f"stop_times.txt is not grouped by trip_id (trip {trip_id})")
+            current_trip_id = trip_id
+            current_stops = []
+        current_stops.append(stop_info(row))
+    if current_trip_id is not None:
+        yield current_trip_id, current_stops
+
+
+def load_feed_state(bucket_name, feed_state_path):
+    try:
+        return get_json(bucket_name, feed_state_path)
+    except FileNotFoundError:
+        return {}
+
+
+def download_feed(zip_path, state):
+    # Conditional download: returns the validators and content hash of the new feed,
+    # or None when the server says it has not changed since the stored state
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    digest = hashlib.sha256()
+    # Stream the archive to disk instead of holding it in response.content
+    with requests.get(zip_url, stream=True, headers=headers) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        with open(zip_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=download_chunk_size):
+                digest.update(chunk)
+                f.write(chunk)
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": digest.hexdigest(),
+        }
+
+
+def trip_hash(trip_short_name, stops_list, service_id=None):
+    payload = json.dumps([trip_short_name, service_id, stops_list], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def diff_trip_hashes(previous, current):
+    return {
+        "added": sorted(trip_id for trip_id in current if trip_id not in previous),
+        "removed": sorted(trip_id for trip_id in previous if trip_id not in current),
+        "changed": sorted(trip_id for trip_id, h in current.items() if trip_id in previous and previous[trip_id] != h),
+    }
+
+
+def read_service_calendar(z):
+    # None when the feed ships neither calendar.txt nor calendar_dates.txt
+    # or when they cannot be parsed: trips then count as running every day
+    names = set(z.namelist())
+    try:
+        calendar_rows = read_csv_dicts(z, 'calendar.txt') if 'calendar.txt' in names else []
+        calendar_dates_rows = read_csv_dicts(z, 'calendar_dates.txt') if 'calendar_dates.txt' in names else []
+        return build_service_calendar(calendar_rows, calendar_dates_rows)
+    except (KeyError, ValueError, IndexError) as e:
+        logging.warning("Service calendar not usable, trips will not be filtered by date: %s", e)
+        return None
+
+
+def write_trip_artifacts(trips, table_writer, json_path=None, trip_services=None):
+    # Feeds every trip to the compact table writer and, if requested, streams the
+    # JSON compatibility export to disk at the same time, one trip at a time
+    json_file = open(json_path, 'w', encoding='utf-8') if json_path else None
+    try:
+        if json_file:
+            json_file.write('[')
+        for i, (trip_id, trip_short_name, stops_list) in enumerate(trips):
+            table_writer.add_trip(trip_id, trip_short_name, stops_list, trip_services.get(trip_id) if trip_services else None)
+            if json_file:
+                if i:
+                    json_file.write(',')
+                json_file.write('\n')
+                json.dump({"trip_id": trip_id, "trip_short_name": trip_short_name, "stops": stops_list}, json_file, ensure_ascii=False)
+        if json_file:
+            json_file.write('\n]')
+    finally:
+        if json_file:
+            json_file.close()
+
 
 def jsonify(params):
-    tmp_dir = tempfile.gettempdir()
+    # Each run works in its own directory, so overlapping runs never share files
+    with tempfile.TemporaryDirectory(prefix="jsonify_") as tmp_dir:
+        return jsonify_in(params, tmp_dir)
+
+
+def jsonify_in(params, tmp_dir):
+    # With feed_state_path the refresh is incremental: an unchanged feed (HTTP 304 or
+    # same content hash) is not rebuilt, a changed one is published as a new version
+    # with a manifest of the trips added, removed and changed since the last one
+    stats = []
+    zip_path = os.path.join(tmp_dir, 'trenord_gtfs.zip')
+    stops_json = os.path.join(tmp_dir, 'stops.json')
+    trips_output_path = os.path.join(tmp_dir, 'full_info_trips.json')
+    table_output_path = os.path.join(tmp_dir, 'full_info_trips.bin')
+
     try:
-        stop_times_csv = os.path.join(tmp_dir, 'stop_times.txt')
-        stops_csv = os.path.join(tmp_dir, 'stops.txt')
-        trips_csv = os.path.join(tmp_dir, 'trips.txt')
-        stop_times_json = os.path.join(tmp_dir, 'stop-times.json')
-        stops_json = os.path.join(tmp_dir, 'stops.json')
-        trips_json_path = os.path.join(tmp_dir, 'trips.json')
-        stops_output_path = os.path.join(tmp_dir, 'full_info_stops.json')
-        trips_output_path = os.path.join(tmp_dir, 'full_info_trips.json')
-
-        result_output_path = params["result_output_path"]
+        compact_output_path = params["compact_output_path"]
+        # The JSON trips file is an optional compatibility export
+        result_output_path = params.get("result_output_path")
         stops_output_path = params["stops_output_path"]
         bucket_name = params["bucket_name"]
+        feed_state_path = params.get("feed_state_path")
+        state = load_feed_state(bucket_name, feed_state_path) if feed_state_path else {}
+        # force rebuilds even an unchanged feed, still diffing against the last version
+        force = params.get("force", False)
 
-        zip_url = "https://www.dati.lombardia.it/download/3z4k-mxz9/application%2Fzip"
-        response = requests.get(zip_url)
-        response.raise_for_status()
+        started = time.perf_counter()
+        feed = download_feed(zip_path, {} if force else state)
+        record_stage(stats, "download", started)
     except requests.RequestException as e:
         return {"success": False, "message": f"Errore durante il download del file zip: {str(e)}"}
 
-    try:
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            for filename in ['stop_times.txt', 'stops.txt', 'trips.txt']:
-                with z.open(filename) as src, open(os.path.join(tmp_dir, filename), 'wb') as dst:
-                    dst.write(src.read())
-    except (zipfile.BadZipFile, KeyError) as e:
-        return {"success": False, "message": f"Errore durante l'estrazione dei file: {str(e)}"}
+    if not force and (feed is None or (state.get("sha256") and feed["sha256"] == state["sha256"])):
+        logging.info("GTFS feed unchanged since version %s, nothing to rebuild", state.get("version"))
+        if feed is not None and (feed["etag"], feed["last_modified"]) != (state.get("etag"), state.get("last_modified")):
+            # Same content under new validators: keep them so the next check can get a 304
+            put_json(bucket_name, feed_state_path, {**state, "etag": feed["etag"], "last_modified": feed["last_modified"]}, indent=2)
+        return {"success": True, "message": "Feed unchanged", "changed": False, "stats": stats}
+    trip_hashes = {} if feed_state_path else None
 
     try:
-        with open(stop_times_csv, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            stops = list(reader)
-        with open(stops_csv, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            stops_info = list(reader)
-        with open(trips_csv, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            trips_info = list(reader)
-    except (FileNotFoundError, csv.Error) as e:
-        return {"success": False, "message": f"Errore durante la lettura dei file CSV: {str(e)}"}
+        try:
+            z = zipfile.ZipFile(zip_path)
+        except zipfile.BadZipFile as e:
+            return {"success": False, "message": f"Errore durante l'estrazione dei file: {str(e)}"}
 
-    try:
-        with open(stop_times_json, 'w', encoding='utf-8') as f:
-            json.dump(stops, f, ensure_ascii=False, indent=2)
-        with open(stops_json, 'w', encoding='utf-8') as f:
-            json.dump(stops_info, f, ensure_ascii=False, indent=2)
-        with open(trips_json_path, 'w', encoding='utf-8') as f:
-            json.dump(trips_info, f, ensure_ascii=False, indent=2)
-    except IOError as e:
-        return {"success": False, "message": f"Errore durante il salvataggio dei file JSON: {str(e)}"}
+        with z:
+            try:
+                started = time.perf_counter()
+                stops_info = read_csv_dicts(z, 'stops.txt')
+                trips_info = read_csv_dicts(z, 'trips.txt')
+                calendar = read_service_calendar(z)
+                record_stage(stats, "read_stops_and_trips", started)
+            except KeyError as e:
+                return {"success": False, "message": f"Errore durante l'estrazione dei file: {str(e)}"}
+            except csv.Error as e:
+                return {"success": False, "message": f"Errore durante la lettura dei file CSV: {str(e)}"}
 
-    try:
-        stop_id_to_name = {stop['stop_id']: stop['stop_name'] for stop in stops_info}
-        for stop in stops:
-            stop_id = stop.get('stop_id')
-            stop['stop_name'] = stop_id_to_name.get(stop_id, None)
+            try:
+                with open(stops_json, 'w', encoding='utf-8') as f:
+                    json.dump(stops_info, f, ensure_ascii=False, indent=2)
+            except IOError as e:
+                return {"success": False, "message": f"Errore durante il salvataggio dei file JSON: {str(e)}"}
 
-        with open(stops_output_path, 'w', encoding='utf-8') as f:
-            json.dump(stops, f, ensure_ascii=False, indent=2)
+            try:
+                started = time.perf_counter()
+                stop_id_to_name = {stop['stop_id']: stop['stop_name'] for stop in stops_info}
+                trip_id_to_short_name = {trip['trip_id']: trip.get('trip_short_name', None) for trip in trips_info}
+                trip_id_to_service = {trip['trip_id']: trip.get('service_id') for trip in trips_info}
+                del stops_info, trips_info
 
-        trips_dict = {}
-        for stop in stops:
-            trip_id = stop['trip_id']
-            stop_info = {
-                "stop_id": stop['stop_id'],
-                "stop_name": stop.get('stop_name'),
-                "stop_sequence": stop['stop_sequence'],
-                "arrival_time": stop['arrival_time'],
-                "departure_time": stop['departure_time']
-            }
-            trips_dict.setdefault(trip_id, []).append(stop_info)
-
-
-        trip_id_to_short_name = {trip['trip_id']: trip.get('trip_short_name', None) for trip in trips_info}
-        trips_json = [
-            {"trip_id": trip_id, "trip_short_name": trip_id_to_short_name.get(trip_id, None), "stops": stops_list}
-            for trip_id, stops_list in trips_dict.items()
-        ]
-
-        with open(trips_output_path, 'w', encoding='utf-8') as f:
-            json.dump(trips_json, f, ensure_ascii=False, indent=2)
+                def trips(assume_sorted):
+                    for trip_id, stops_list in iter_trip_stop_times(z, stop_id_to_name, assume_sorted):
+                        trip_short_name = trip_id_to_short_name.get(trip_id, None)
+                        if trip_hashes is not None:
+                            trip_hashes[trip_id] = trip_hash(trip_short_name, stops_list, trip_id_to_service.get(trip_id))
+                        yield trip_id, trip_short_name, stops_list
 
-    except Exception as e:
-        return {"success": False, "message": f"Errore durante la creazione dei file JSON completi: {str(e)}"}
+                json_path = trips_output_path if result_output_path else None
+                stops_table = list(stop_id_to_name.items())
+                try:
+                    table_writer = TripsTableWriter(stops_table, calendar)
+                    write_trip_artifacts(trips(True), table_writer, json_path, trip_id_to_service)
+                except UnsortedStopTimesError as e:
+                    logging.warning("%s, grouping stop_times in memory", e)
+                    if trip_hashes is not None:
+                        trip_hashes.clear()
+                    table_writer = TripsTableWriter(stops_table, calendar)
+                    write_trip_artifacts(trips(False), table_writer, json_path, trip_id_to_service)
+                table_writer.write(table_output_path)
+                del table_writer
+                record_stage(stats, "stop_times_to_trips", started)
+            except KeyError as e:
+                return {"success": False, "message": f"Errore durante l'estrazione dei file: {str(e)}"}
+            except Exception as e:
+                return {"success": False, "message": f"Errore durante la creazione dei file JSON completi: {str(e)}"}
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
 
     try:
-        upload_to_bucket(trips_output_path, result_output_path, bucket_name)
+        started = time.perf_counter()
+        upload_to_bucket(table_output_path, compact_output_path, bucket_name)
+        if result_output_path:
+            upload_to_bucket(trips_output_path, result_output_path, bucket_name)
         upload_to_bucket(stops_json, stops_output_path, bucket_name)
+        if feed_state_path:
+            manifest = publish_version(bucket_name, feed_state_path, state, feed, trip_hashes, table_output_path)
+        record_stage(stats, "upload", started)
+    except Exception as e:
+        return {"success": False, "message": f"Errore durante il caricamento su bucket: {str(e)}, temp_path: {table_output_path}"}
+
+    result = {"success": True, "message": "Files saved successfully", "changed": True, "stats": stats}
+    if feed_state_path:
+        result["manifest"] = manifest
+    return result
+
+
+def publish_version(bucket_name, feed_state_path, state, feed, trip_hashes, table_output_path):
+    # The state blob is written last: a failed publish is simply retried next time
+    version = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}_{feed['sha256'][:8]}"
+    version_path = f"{versions_partial_path}{version}/"
+    previous_hashes = {}
+    if state.get("trip_hashes_path"):
+        try:
+            previous_hashes = get_json(bucket_name, state["trip_hashes_path"])
+        except FileNotFoundError:
+            logging.warning("Trip hashes of version %s not found, every trip counts as added", state.get("version"))
+    diff = diff_trip_hashes(previous_hashes, trip_hashes)
+
+    upload_to_bucket(table_output_path, version_path + "full_info_trips.bin", bucket_name)
+    put_json(bucket_name, version_path + "trip_hashes.json", trip_hashes, gzip_transfer=True)
+    manifest = {
+        "version": version,
+        "previous_version": state.get("version"),
+        "feed_sha256": feed["sha256"],
+        "artifact_path": version_path + "full_info_trips.bin",
+        "trip_count": len(trip_hashes),
+        "counts": {change: len(trip_ids) for change, trip_ids in diff.items()},
+        **diff,
+    }
+    put_json(bucket_name, version_path + "manifest.json", manifest, gzip_transfer=True)
+    put_json(bucket_name, feed_state_path, {
+        **feed,
+        "version": version,
+        "manifest_path": version_path + "manifest.json",
+        "trip_hashes_path": version_path + "trip_hashes.json",
+    }, indent=2)
+    logging.info("GTFS feed version %s published: %s", version, manifest["counts"])
+    try:
+        prune_versions(bucket_name)
     except Exception as e:
-        return {"success": False, "message": f"Errore durante il caricamento su bucket: {str(e)}, temp_path: {trips_output_path}"}
+        logging.warning("Could not prune old GTFS feed versions: %s", e)
+    return {key: manifest[key] for key in ("version", "previous_version", "artifact_path", "counts")}
+
 
-    return {"success": True, "message": "Files saved successfully"}
+def prune_versions(bucket_name, keep=None):
+    # Deletes all but the `keep` latest versions; version names start with the UTC publish
+    # time, so they sort by age. The latest one is always kept, the next diff reads it
+    keep = max(1, FEED_VERSIONS_KEPT if keep is None else keep)
+    blobs_by_version = {}
+    for blob in list_blobs(bucket_name, versions_partial_path):
+        version = blob["name"][len(versions_partial_path):].split("/", 1)[0]
+        blobs_by_version.setdefault(version, []).append(blob["name"])
+    stale = sorted(blobs_by_version)[:-keep]
+    for version in stale:
+        for blob_name in blobs_by_version[version]:
+            delete_blob(bucket_name, blob_name)
+    if stale:
+        logging.info("GTFS feed versions pruned: %d deleted, %d kept", len(stale), len(blobs_by_version) - len(stale))
+    return stale
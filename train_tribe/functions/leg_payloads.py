@@ -0,0 +1,142 @@
+import logging
+from trips_table import StopTable, format_gtfs_time, parse_gtfs_time, to_int
+
+# Lean leg payloads. In memory a leg only references its trip: {"trip_id", "from", "to"},
+# plus "friends" once they are added. Stored and compact payloads keep the stops of every
+# trip once, in side tables shared by all the legs of the payload:
+#
+#   {"format": "compact",
+#    "stops": [[stop_id, stop_name], ...],
+#    "trips": {trip_id: [[stop, stop_sequence, arrival, departure], ...]},
+#    "routes": [{"leg0": {"trip_id", "from", "to", "from_idx", "to_idx"}, ...}, ...]}
+#
+# stop is a position in "stops", times are seconds after midnight (NO_TIME when missing),
+# from_idx/to_idx are the rows of the leg's from/to stops in its trip. A day payload has
+# "events": {event_id: routes} instead of "routes".
+# The full format, where every leg carries the whole stop list of its trip, is still
+# read from older blobs and served to older app versions (see expand_payload).
+COMPACT = "compact"
+FULL = "full"
+
+
+def is_compact(payload):
+    return isinstance(payload, dict) and payload.get("format") == COMPACT
+
+
+class PayloadWriter:
+
+    def __init__(self, table=None):
+        # table: trips table the stops of lean legs are read from
+        self.table = table
+        self.stops = StopTable()
+        self.trips = {}
+
+    def _trip_rows(self, leg, source):
+        # Stop rows of the leg's trip, from the leg itself, the payload it was read from
+        # or the trips table, in that order
+        trip_id = leg["trip_id"]
+        if "stops" in leg:
+            return [
+                [self.stops.intern(stop["stop_id"], stop.get("stop_name")), to_int(stop.get("stop_sequence")),
+                 parse_gtfs_time(stop.get("arrival_time")), parse_gtfs_time(stop.get("departure_time"))]
+                for stop in leg["stops"]
+            ]
+        if source and trip_id in source["trips"]:
+            source_stops = source["stops"]
+            return [
+                [self.stops.intern(*source_stops[stop]), sequence, arrival, departure]
+                for stop, sequence, arrival, departure in source["trips"][trip_id]
+            ]
+        table = self.table
+        trip_idx = table.trip_position(trip_id) if table else None
+        if trip_idx is not None:
+            return [
+                [self.stops.intern(table.stop_ids[table.stop_index[row]], table.stop_names[table.stop_index[row]]),
+                 table.stop_sequence[row], table.arrival[row], table.departure[row]]
+                for row in table.stop_range(trip_idx)
+            ]
+        logging.warning("Stops of trip %s not available, storing the leg without them", trip_id)
+        return []
+
+    def _row_of(self, rows, stop_id):
+        position = self.stops.position(stop_id)
+        return next((idx for idx, row in enumerate(rows) if row[0] == position), None)
+
+    def add_routes(self, routes, source=None):
+        # Lean copies of routes (full or lean legs) with from_idx/to_idx, their trips
+        # added to the side tables; source is the compact payload they were read from
+        lean_routes = []
+        for route in routes:
+            lean_route = {}
+            for leg_key, leg in route.items():
+                if not leg_key.startswith("leg"):
+                    lean_route[leg_key] = leg
+                    continue
+                rows = self.trips.get(leg["trip_id"])
+                if rows is None:
+                    rows = self.trips[leg["trip_id"]] = self._trip_rows(leg, source)
+                lean_leg = {key: value for key, value in leg.items() if key != "stops"}
+                lean_leg["from_idx"] = self._row_of(rows, leg["from"])
+                lean_leg["to_idx"] = self._row_of(rows, leg["to"])
+                lean_route[leg_key] = lean_leg
+            lean_routes.append(lean_route)
+        return lean_routes
+
+    def add_payload(self, payload):
+        # Routes of a stored payload, compact or full
+        if is_compact(payload):
+            return self.add_routes(payload["routes"], payload)
+        return self.add_routes(payload)
+
+    def payload(self, **content):
+        # content: routes=[...] or events={event_id: routes}
+        stops = [[stop_id, stop_name] for stop_id, stop_name in zip(self.stops.stop_ids, self.stops.stop_names)]
+        return {"format": COMPACT, "stops": stops, "trips": self.trips, **content}
+
+
+def encode_routes(routes, table=None, source=None):
+    writer = PayloadWriter(table)
+    return writer.payload(routes=writer.add_routes(routes, source))
+
+
+def payload_routes(payload):
+    # Routes of a stored payload, enough to read trip_id/from/to of every leg
+    return payload["routes"] if is_compact(payload) else payload
+
+
+def _expand_routes(routes, payload):
+    stops = payload["stops"]
+    expanded_trips = {}
+    expanded = []
+    for route in routes:
+        full_route = {}
+        for leg_key, leg in route.items():
+            if not leg_key.startswith("leg"):
+                full_route[leg_key] = leg
+                continue
+            trip_id = leg["trip_id"]
+            if trip_id not in expanded_trips:
+                expanded_trips[trip_id] = [
+                    {
+                        'stop_id': stops[stop][0],
+                        'stop_name': stops[stop][1],
+                        'stop_sequence': str(sequence),
+                        'arrival_time': format_gtfs_time(arrival),
+                        'departure_time': format_gtfs_time(departure),
+                    }
+                    for stop, sequence, arrival, departure in payload["trips"].get(trip_id, [])
+                ]
+            full_leg = {'trip_id': trip_id, 'stops': expanded_trips[trip_id], 'from': leg["from"], 'to': leg["to"]}
+            full_leg.update((key, value) for key, value in leg.items() if key not in full_leg and not key.endswith("_idx"))
+            full_route[leg_key] = full_leg
+        expanded.append(full_route)
+    return expanded
+
+
+def expand_payload(payload):
+    # Full format of a payload: a routes list, or {event_id: routes} for a day payload
+    if not is_compact(payload):
+        return payload
+    if "events" in payload:
+        return {event_id: _expand_routes(routes, payload) for event_id, routes in payload["events"].items()}
+    return _expand_routes(payload["routes"], payload)
@@ -2,39 +2,69 @@ from math import e
 import re
 from firebase_functions import https_fn
 from firebase_functions import firestore_fn
-from firebase_admin import initialize_app
 from firebase_functions.params import SecretParam
 from firebase_functions import scheduler_fn
+import gzip
 import json
-import tempfile
-import os
 import logging
-from jsonifier import jsonify
-from bucket_manager import download_from_bucket
-from event_trip_options_manager import (
-    create_event_trip_options_logic, 
-    delete_event_trip_options_logic, 
-    update_event_trip_options_logic,
-    get_event_full_trip_data_logic,
-)
+import os
+import threading
+from tracing import traced, span
 GOOGLE_MAPS_API_KEY = SecretParam('GOOGLE_MAPS_API_KEY')
 
 bucket_name = "traintribe-f2c7b.firebasestorage.app"
 jsonified_trenord_trips_data_path = "maps/full_info_trips.json"
+compact_trenord_trips_data_path = "maps/full_info_trips.bin"
 jsonified_trenord_stops_data_path = "maps/stops.json"
+gtfs_feed_state_path = "maps/gtfs_feed_state.json"
 full_legs_partial_path = "maps/results/full_info_legs"
 maps_response_partial_path = "maps/responses/maps_response"
 event_options_partial_path = "maps/events/event_options"
 
-initialize_app()
+# Pipeline modules are imported by the handlers that use them, and the Firebase app and
+# the storage and Firestore clients are created on first use (see db_manager and
+# bucket_manager), so a cold instance only loads what its function needs.
+# With WARM_UP_ON_START=true a new instance preloads the trips dataset in the background.
+WARM_UP_ON_START = os.environ.get("WARM_UP_ON_START", "false").lower() == "true"
+
+def warm_up():
+    from trips_cache import get_trips_dataset
+    try:
+        get_trips_dataset(bucket_name, compact_trenord_trips_data_path)
+    except Exception as e:
+        logging.warning("Warm-up failed: %s", e)
+
+# FUNCTIONS_CONTROL_API is set when the CLI loads the module to discover the functions
+if WARM_UP_ON_START and os.environ.get("FUNCTIONS_CONTROL_API") != "true":
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def json_response(req, payload, etag=None):
+    # Compact JSON, gzip-compressed when the client accepts it; the ETag lets the
+    # client revalidate with If-None-Match
+    with span("http.encode"):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+    if etag:
+        headers["ETag"] = etag
+    if len(body) > 1024 and "gzip" in req.headers.get("Accept-Encoding", ""):
+        with span("http.gzip"):
+            body = gzip.compress(body, compresslevel=6, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return https_fn.Response(body, mimetype="application/json", headers=headers)
 
 @https_fn.on_request()
+@traced("call_jsonify")
 def call_jsonify(req: https_fn.Request) -> https_fn.Response:
-    
+    from jsonifier import jsonify
+
     params = {
+        "compact_output_path": compact_trenord_trips_data_path,
         "result_output_path": jsonified_trenord_trips_data_path,
         "stops_output_path": jsonified_trenord_stops_data_path,
         "bucket_name": bucket_name,
+        "feed_state_path": gtfs_feed_state_path,
+        # ?force=true rebuilds even when the feed has not changed
+        "force": req.args.get("force") == "true",
     }
 
     result = jsonify(params)
@@ -45,11 +75,15 @@ def call_jsonify(req: https_fn.Request) -> https_fn.Response:
         return https_fn.Response(f"Error: {result['message']}", status=500)
     
 @scheduler_fn.on_schedule(schedule="0 0 * * 1")
+@traced("call_jsonify_scheduled")
 def call_jsonify_scheduled(req: https_fn.Request) -> https_fn.Response:
+    from jsonifier import jsonify
     params = {
+    "compact_output_path": compact_trenord_trips_data_path,
     "result_output_path": jsonified_trenord_trips_data_path,
     "stops_output_path": jsonified_trenord_stops_data_path,
     "bucket_name": bucket_name,
+    "feed_state_path": gtfs_feed_state_path,
     }
 
     result = jsonify(params)
@@ -59,20 +93,76 @@ def call_jsonify_scheduled(req: https_fn.Request) -> https_fn.Response:
     else:
         return https_fn.Response(f"Error: {result['message']}", status=500)
 
+@scheduler_fn.on_schedule(schedule="30 3 * * *")
+@traced("call_prune_directions_cache")
+def call_prune_directions_cache(event: scheduler_fn.ScheduledEvent) -> None:
+    # Bucket entries of the Directions cache expire after a day but are not deleted on read
+    from directions_cache import prune_directions_cache
+    prune_directions_cache(bucket_name)
+
+@scheduler_fn.on_schedule(schedule="0 4 * * *")
+@traced("call_prune_expired_patterns")
+def call_prune_expired_patterns(event: scheduler_fn.ScheduledEvent) -> None:
+    from event_trip_options_manager import prune_expired_patterns_logic
+    prune_expired_patterns_logic()
+
+@https_fn.on_call()
+@traced("call_rebuild_friends_trains_index")
+def call_rebuild_friends_trains_index(req: https_fn.CallableRequest) -> dict:
+    # Backfills the friends trains index of one date ({"date": "YYYY-MM-DD"}). Rewrites
+    # the index of every user of the date: only for accounts with the admin custom claim
+    from friends_trains_index import rebuild_friends_trains_index
+    if req.auth is None or not req.auth.token.get("admin", False):
+        raise https_fn.HttpsError(https_fn.FunctionsErrorCode.PERMISSION_DENIED, "Admin privileges required.")
+    date = (req.data or {}).get("date")
+    if not date:
+        raise https_fn.HttpsError(https_fn.FunctionsErrorCode.INVALID_ARGUMENT, "Date parameter is required.")
+    return rebuild_friends_trains_index(date)
+
 @firestore_fn.on_document_created(document="users/{user_id}/events/{event_id}", secrets=[GOOGLE_MAPS_API_KEY])
+@traced("firestore_event_trip_options_create")
 def firestore_event_trip_options_create(event: firestore_fn.Event[dict]) -> None:
+    from event_trip_options_manager import create_event_trip_options_logic
     create_event_trip_options_logic(event, GOOGLE_MAPS_API_KEY, bucket_name)
 
 @firestore_fn.on_document_deleted(document="users/{user_id}/events/{event_id}")
+@traced("firestore_event_trip_options_delete")
 def firestore_event_trip_options_delete(event: firestore_fn.Event[dict]) -> None:
-    delete_event_trip_options_logic(event)
+    from event_trip_options_manager import delete_event_trip_options_logic
+    delete_event_trip_options_logic(event, bucket_name)
 
 @firestore_fn.on_document_updated(document="users/{user_id}/events/{event_id}", secrets=[GOOGLE_MAPS_API_KEY])
+@traced("firestore_event_trip_options_update")
 def firestore_event_trip_options_update(event: firestore_fn.Event[dict]) -> None:
+    from event_trip_options_manager import update_event_trip_options_logic
     update_event_trip_options_logic(event, GOOGLE_MAPS_API_KEY, bucket_name)
 
+@firestore_fn.on_document_updated(document="trains_match/{date}/trains/{trip_id}/users/{user_id}")
+@traced("firestore_train_confirmation_update")
+def firestore_train_confirmation_update(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]) -> None:
+    from friends_trains_index import update_friends_trains_confirmation_logic
+    update_friends_trains_confirmation_logic(event)
+
+# Confirming a recurring train creates the date's membership. Memberships created by the
+# backend carry from/to and return straight away (triggers cannot filter on the writer)
+@firestore_fn.on_document_created(document="trains_match/{date}/trains/{trip_id}/users/{user_id}")
+@traced("firestore_train_confirmation_create")
+def firestore_train_confirmation_create(event: firestore_fn.Event[dict]) -> None:
+    from friends_trains_index import update_friends_trains_confirmation_logic
+    update_friends_trains_confirmation_logic(event)
+
+@firestore_fn.on_document_updated(document="users/{user_id}")
+@traced("firestore_user_friends_update")
+def firestore_user_friends_update(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]) -> None:
+    # Adds and removes the rides of changed friends in the friends trains index
+    from event_trip_options_manager import update_friends_trains_friendship_logic
+    update_friends_trains_friendship_logic(event, bucket_name)
+
 @https_fn.on_request()
+@traced("get_event_full_trip_data")
 def get_event_full_trip_data(req: https_fn.Request) -> https_fn.Response:
+    from event_trip_options_manager import get_day_event_options_logic
+    from leg_payloads import COMPACT, FULL, expand_payload
     req_params = req.args
     if not req_params:
         logging.error("No parameters provided in request.")
@@ -97,12 +187,17 @@ def get_event_full_trip_data(req: https_fn.Request) -> https_fn.Response:
         logging.error("Date not provided in request parameters.")
         return https_fn.Response("Date parameter is required.", status=400)
     logging.info("Using user_id: %s, date: %s", user_id, date)
-    day_json_path = get_event_full_trip_data_logic(user_id, date, bucket_name)
-    if day_json_path is not None:
-        tmp_path = os.path.join(tempfile.gettempdir(), "day_event_options.json")
-        download_from_bucket(bucket_name, day_json_path, tmp_path)
-        with open(tmp_path, "r", encoding="utf-8") as f:
-            day_options = json.load(f)
-        return https_fn.Response(json.dumps(day_options), mimetype="application/json")
+    # ?format=compact answers with the stops of each trip once (see leg_payloads),
+    # older app versions get every leg with its full stop list
+    response_format = COMPACT if req_params.get("format") == COMPACT else FULL
+    known_etags = [etag.strip() for etag in req.headers.get("If-None-Match", "").split(",") if etag.strip()]
+    day_options, etag = get_day_event_options_logic(user_id, date, bucket_name, response_format, known_etags)
+    if etag and etag in known_etags:
+        return https_fn.Response(status=304, headers={"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"})
+    if day_options:
+        if response_format == FULL:
+            with span("payload.expand"):
+                day_options = expand_payload(day_options)
+        return json_response(req, day_options, etag)
     else:
         return https_fn.Response("No trips found.", status=404)
\ No newline at end of file
@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 
 import logging
-import tempfile
 import requests
-import json
-import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from bucket_manager import upload_to_bucket
+from bucket_manager import put_json
+from directions_cache import get_directions
 from full_legs_builder import build_full_info_maps_legs
+from tracing import span, count
 
 endpoint = 'https://maps.googleapis.com/maps/api/directions/json?'
 
+
+class DirectionsRequestError(Exception):
+    pass
+
+
+def request_directions(maps_params):
+    count("maps.requests")
+    with span("maps.request"):
+        response = requests.get(endpoint, params=maps_params)
+    if response.status_code != 200:
+        raise DirectionsRequestError(response.text)
+    return response.json()
+
+
 def ask_maps(params):
 
     try:
@@ -33,40 +46,37 @@ def ask_maps(params):
     except ValueError:
         return {"success": False, "message": "Formato orario non valido. Usa YYYY-MM-DD HH:MM."}
 
-    
-    response = requests.get(endpoint, params=maps_params)
-    if response.status_code == 200:
-        response_json = response.json()        
-        try:
-            tmp_output_path = os.path.join(tempfile.gettempdir(), "maps_response.json")
-            with open(tmp_output_path, 'w', encoding='utf-8') as f:
-                json.dump(response_json, f, indent=2, ensure_ascii=False)
+    try:
+        # Served from the shared Directions cache when the same query was answered before
+        response_json = get_directions(maps_params, params["bucket_name"], request_directions)
+    except DirectionsRequestError as e:
+        logging.error("Error in Google Maps API request: %s", e)
+        return {"success": False, "message": f"Error in Google Maps API request: {e}"}
 
-            upload_to_bucket(tmp_output_path, params["maps_path"], params["bucket_name"])
+    try:
+        put_json(params["bucket_name"], params["maps_path"], response_json)
 
-        except IOError as e:
-            logging.error("Error saving file: %s", e)
-            return {"success": False, "message": f"Error saving file: {e}"}
+    except IOError as e:
+        logging.error("Error saving file: %s", e)
+        return {"success": False, "message": f"Error saving file: {e}"}
 
-        #prepare params for full_legs_builder function
+    #prepare params for full_legs_builder function
 
-        full_legs_params={
-            "full_legs_path": params["full_legs_path"],
-            "bucket_name": params["bucket_name"],
-            "trips_path": params["trips_path"],
-            "maps_path": params["maps_path"],
-        }
+    full_legs_params={
+        "full_legs_path": params["full_legs_path"],
+        "bucket_name": params["bucket_name"],
+        "trips_path": params["trips_path"],
+        "maps_path": params["maps_path"],
+        "maps_response": response_json,
+        "service_date": params.get("service_date"),
+    }
 
-        #call full_legs_builder function
+    #call full_legs_builder function
 
-        result = build_full_info_maps_legs(full_legs_params)
+    result = build_full_info_maps_legs(full_legs_params)
 
-        if result["success"]:
-            return {"success": True, "message": "Full legs builder completed successfully."}
-        else:
-            logging.error("Full legs builder error: %s", result["message"])
-            return {"success": False, "message": f"Full legs builder error: {result['message']}"}
-        
+    if result["success"]:
+        return {"success": True, "message": "Full legs builder completed successfully.", "full_legs": result["full_legs"]}
     else:
-        logging.error("Error in Google Maps API request: %s", response.text)
-        return {"success": False, "message": f"Error in Google Maps API request: {response.text}"}
\ No newline at end of file
+        logging.error("Full legs builder error: %s", result["message"])
+        return {"success": False, "message": f"Full legs builder error: {result['message']}"}
@@ -1,5 +1,5 @@
 bucket_name = "traintribe-f2c7b.firebasestorage.app"
-jsonified_trenord_data_path = "maps/full_info_trips.json"
+jsonified_trenord_data_path = "maps/full_info_trips.bin"
 full_legs_partial_path = "maps/results/full_info_legs"
 maps_response_partial_path = "maps/responses/maps_response"
 event_options_partial_path = "maps/events/event_options"
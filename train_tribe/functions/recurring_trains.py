@@ -0,0 +1,188 @@
+import logging
+import os
+from datetime import date as date_type
+from firebase_admin import firestore
+from db_manager import WriteSet
+
+# Recurring events register their trains once, as a weekly pattern expanded when a date
+# is read, instead of one trains_match membership per week:
+#
+#   trains_recurring/{weekday}/trains/{trip_id}/users/{user_id}
+#       {"patterns": {event_id: {"from", "to", "valid_from", "valid_until",
+#                                "skipped_dates": [...], "materialized_dates": [...]}}}
+#
+#   friends_trains_recurring/{weekday}/users/{user_id}
+#       {"trips": {trip_id: {friend_id: {event_id: pattern}}}}
+#
+# weekday is the lower-case English day name, dates are 'YYYY-MM-DD' on the Europe/Rome
+# calendar. A pattern runs on the dates of its weekday from valid_from to valid_until
+# that are not in skipped_dates. The second collection is the recurring counterpart of
+# the friends trains index (see friends_trains_index).
+#
+# A trains_match membership of the same user, date and train takes precedence over the
+# pattern: the app confirms a recurring train by writing one, and the confirmation
+# trigger records that date in materialized_dates so that deleting the event removes it.
+# Events stored this way are marked with recurrence_storage = "pattern"; older recurring
+# events keep their per-week memberships. Creating, editing or deleting a recurring
+# event costs O(routes) writes whatever the recurrence length.
+RECURRING_PATTERNS = os.environ.get("RECURRING_PATTERNS", "true").lower() == "true"
+PATTERN_STORAGE = "pattern"
+recurring_trains_collection = "trains_recurring"
+friends_recurring_collection = "friends_trains_recurring"
+weekdays = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def weekday_of(date):
+    # date: datetime.date or 'YYYY-MM-DD'
+    if isinstance(date, str):
+        date = date_type.fromisoformat(date)
+    return weekdays[date.weekday()]
+
+def pattern_ref(db, weekday, trip_id, user_id):
+    return (db.collection(recurring_trains_collection).document(weekday)
+            .collection("trains").document(trip_id).collection("users").document(user_id))
+
+def friends_recurring_ref(db, weekday, user_id):
+    return db.collection(friends_recurring_collection).document(weekday).collection("users").document(user_id)
+
+def new_pattern(start_date, end_date, skipped_dates=()):
+    return {
+        "valid_from": start_date.isoformat(),
+        "valid_until": end_date.isoformat(),
+        "skipped_dates": sorted(set(skipped_dates)),
+    }
+
+def active_pattern(patterns, date_str):
+    # (event_id, pattern) of the first pattern running on the date, (None, None) if none
+    for event_id in sorted(patterns):
+        pattern = patterns[event_id]
+        if (pattern.get("valid_from", "") <= date_str <= pattern.get("valid_until", "")
+                and date_str not in pattern.get("skipped_dates", [])):
+            return event_id, pattern
+    return None, None
+
+def pattern_membership(pattern):
+    return {"from": pattern.get("from", ""), "to": pattern.get("to", ""), "confirmed": False}
+
+def expand_membership(patterns, date_str, membership=None):
+    # Membership of a user on the date: the pattern running that day, overridden by the
+    # fields set in the trains_match membership when there is one. None when neither applies
+    _, pattern = active_pattern(patterns or {}, date_str)
+    if pattern is None:
+        return membership
+    return {**pattern_membership(pattern), **{k: v for k, v in (membership or {}).items() if v not in ("", None)}}
+
+def add_pattern(writes, friend_ids, weekday, trip_id, user_id, event_id, pattern):
+    # Also changes some fields (validity, skipped dates) of an existing pattern
+    writes.set(pattern_ref(writes.db, weekday, trip_id, user_id), {"patterns": {event_id: pattern}}, merge=True)
+    for friend_id in friend_ids:
+        writes.set(friends_recurring_ref(writes.db, weekday, friend_id),
+                   {"trips": {trip_id: {user_id: {event_id: pattern}}}}, merge=True)
+
+def remove_pattern(writes, friend_ids, weekday, trip_id, user_id, event_id, remaining):
+    # remaining: the other patterns of the user on the train, the document goes with the last one
+    ref = pattern_ref(writes.db, weekday, trip_id, user_id)
+    if remaining:
+        writes.set(ref, {"patterns": {event_id: firestore.DELETE_FIELD}}, merge=True)
+    else:
+        writes.delete(ref)
+    for friend_id in friend_ids:
+        riders = {user_id: {event_id: firestore.DELETE_FIELD}} if remaining else {user_id: firestore.DELETE_FIELD}
+        writes.set(friends_recurring_ref(writes.db, weekday, friend_id), {"trips": {trip_id: riders}}, merge=True)
+
+def read_patterns(db, weekday, trip_ids, user_id):
+    # {trip_id: {event_id: pattern}} of the user, one batched read
+    # The documents are named after the user, the train is found from the path
+    refs = {trip_id: pattern_ref(db, weekday, trip_id, user_id) for trip_id in trip_ids}
+    trip_of = {ref.path: trip_id for trip_id, ref in refs.items()}
+    docs = db.get_all(list(refs.values())) if refs else []
+    return {trip_of[doc.reference.path]: doc.to_dict().get("patterns", {}) for doc in docs if doc.exists}
+
+def event_pattern_dates(patterns_by_trip, event_id):
+    # Dates on which the app wrote trains_match memberships for the event
+    return sorted({
+        date_str
+        for patterns in patterns_by_trip.values()
+        for date_str in patterns.get(event_id, {}).get("materialized_dates", [])
+    })
+
+def remove_event_patterns(db, user_id, event_id, weekday, trip_ids, friend_ids, writes=None):
+    # Removes the event's patterns and friends index entries; returns the write set and
+    # the dates the app materialized, whose trains_match memberships are still to remove
+    writes = writes or WriteSet(db)
+    patterns_by_trip = read_patterns(db, weekday, trip_ids, user_id)
+    for trip_id, patterns in patterns_by_trip.items():
+        if event_id in patterns:
+            remaining = {other for other in patterns if other != event_id}
+            remove_pattern(writes, friend_ids, weekday, trip_id, user_id, event_id, remaining)
+    return writes, event_pattern_dates(patterns_by_trip, event_id)
+
+def record_materialized_date(db, user_id, date_str, trip_id):
+    # Called when a trains_match membership is written for a date; returns the pattern
+    # running that day (None if the train is not a recurring one of the user) after
+    # adding the date to its materialized_dates. The date is added with an array union,
+    # so confirmations of other dates landing at the same time are not lost
+    ref = pattern_ref(db, weekday_of(date_str), trip_id, user_id)
+    doc = ref.get()
+    if not doc.exists:
+        return None
+    event_id, pattern = active_pattern(doc.to_dict().get("patterns", {}), date_str)
+    if pattern is None:
+        return None
+    if date_str not in pattern.get("materialized_dates", []):
+        ref.set({"patterns": {event_id: {"materialized_dates": firestore.ArrayUnion([date_str])}}}, merge=True)
+        logging.info("Recurring train %s of user %s materialized on %s", trip_id, user_id, date_str)
+    return pattern
+
+def ended_patterns(patterns, date_str):
+    # Event ids of the patterns whose last date is before the date
+    return sorted(event_id for event_id, pattern in patterns.items() if pattern.get("valid_until", "") < date_str)
+
+def prune_friends_recurring(writes, weekday, date_str):
+    # Drops the patterns ended before the date from the friends recurring index of the
+    # weekday; documents left without any pattern are deleted. Returns the patterns dropped
+    dropped = 0
+    for doc in writes.db.collection(friends_recurring_collection).document(weekday).collection("users").stream():
+        trips = {}
+        left = False
+        for trip_id, riders in doc.to_dict().get("trips", {}).items():
+            for rider_id, patterns in riders.items():
+                ended = ended_patterns(patterns, date_str)
+                dropped += len(ended)
+                if len(ended) < len(patterns):
+                    left = True
+                    if ended:
+                        trips.setdefault(trip_id, {})[rider_id] = {event_id: firestore.DELETE_FIELD for event_id in ended}
+                elif ended:
+                    trips.setdefault(trip_id, {})[rider_id] = firestore.DELETE_FIELD
+        if not left:
+            writes.delete(doc.reference)
+        elif trips:
+            writes.set(doc.reference, {"trips": trips}, merge=True)
+    return dropped
+
+def prune_patterns(writes, weekday, date_str):
+    # Drops the patterns ended before the date from trains_recurring. Returns the dates the
+    # app materialized for them that no remaining pattern runs on, {(user_id, trip_id): [date_str]}.
+    # The train documents only hold the users collection, hence list_documents
+    materialized = {}
+    for train_ref in writes.db.collection(recurring_trains_collection).document(weekday).collection("trains").list_documents():
+        for doc in train_ref.collection("users").stream():
+            patterns = doc.to_dict().get("patterns", {})
+            ended = ended_patterns(patterns, date_str)
+            if not ended:
+                continue
+            remaining = {event_id: pattern for event_id, pattern in patterns.items() if event_id not in ended}
+            if remaining:
+                writes.set(doc.reference, {"patterns": {event_id: firestore.DELETE_FIELD for event_id in ended}}, merge=True)
+            else:
+                writes.delete(doc.reference)
+            dates = sorted({
+                materialized_date
+                for event_id in ended
+                for materialized_date in patterns[event_id].get("materialized_dates", [])
+                if active_pattern(remaining, materialized_date)[1] is None
+            })
+            if dates:
+                materialized[(doc.id, train_ref.id)] = dates
+    return materialized
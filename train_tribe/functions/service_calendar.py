@@ -0,0 +1,68 @@
+import base64
+from datetime import date, datetime, timedelta
+
+# Service days of the GTFS feed (calendar.txt + calendar_dates.txt) as one bitmap per
+# service_id: bit i is set when the service runs on start_date + i days. Stored in the
+# trips table header so trips can be filtered by the date of an event.
+weekdays = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def parse_gtfs_date(value):
+    return datetime.strptime(value.strip(), "%Y%m%d").date()
+
+
+def build_service_calendar(calendar_rows, calendar_dates_rows):
+    # Returns {"start_date", "days", "services", "bitmaps"}, None when the feed has no calendar
+    calendar_rows = list(calendar_rows)
+    calendar_dates_rows = list(calendar_dates_rows)
+    dates = [parse_gtfs_date(row[key]) for row in calendar_rows for key in ("start_date", "end_date")]
+    dates += [parse_gtfs_date(row["date"]) for row in calendar_dates_rows]
+    if not dates:
+        return None
+    start = min(dates)
+    days = (max(dates) - start).days + 1
+
+    bitmaps = {}
+    for row in calendar_rows:
+        bitmap = bitmaps.setdefault(row["service_id"], bytearray((days + 7) // 8))
+        running = [row.get(weekday, "0").strip() == "1" for weekday in weekdays]
+        day = parse_gtfs_date(row["start_date"])
+        end = parse_gtfs_date(row["end_date"])
+        while day <= end:
+            if running[day.weekday()]:
+                _set(bitmap, (day - start).days, True)
+            day += timedelta(days=1)
+    for row in calendar_dates_rows:
+        bitmap = bitmaps.setdefault(row["service_id"], bytearray((days + 7) // 8))
+        # exception_type 1 adds the date, 2 removes it
+        _set(bitmap, (parse_gtfs_date(row["date"]) - start).days, row["exception_type"].strip() == "1")
+
+    services = sorted(bitmaps)
+    return {
+        "start_date": start.strftime("%Y%m%d"),
+        "days": days,
+        "services": services,
+        "bitmaps": [base64.b64encode(bytes(bitmaps[service])).decode('ascii') for service in services],
+    }
+
+
+def _set(bitmap, day, value):
+    if value:
+        bitmap[day // 8] |= 1 << (day % 8)
+    else:
+        bitmap[day // 8] &= ~(1 << (day % 8))
+
+
+def services_running_on(calendar, day):
+    # Positions in calendar["services"] of the services running on the given date
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    offset = (day - parse_gtfs_date(calendar["start_date"])).days
+    if not 0 <= offset < calendar["days"]:
+        return frozenset()
+    running = set()
+    for position, encoded in enumerate(calendar["bitmaps"]):
+        bitmap = base64.b64decode(encoded)
+        if bitmap[offset // 8] >> (offset % 8) & 1:
+            running.add(position)
+    return frozenset(running)
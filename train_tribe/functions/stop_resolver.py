@@ -0,0 +1,116 @@
+import json
+import logging
+import re
+import threading
+import unicodedata
+from rapidfuzz import fuzz, process
+from bucket_manager import get_bytes, get_blob_info, get_json, put_json, PreconditionFailed
+
+# Resolves Google Maps station names to GTFS stops, built once per trips dataset.
+# Names are first looked up exactly after normalization, then through the alias
+# table of names resolved in earlier requests, and only then fuzzy-matched against
+# the list of unique GTFS station names. Fuzzy resolutions are added to the alias
+# table, which is persisted in the bucket and reloaded with every new dataset.
+# Instances merge their aliases into the stored table with a conditional write, so
+# concurrent saves do not drop each other's aliases.
+stop_aliases_path = "maps/stop_aliases.json"
+alias_save_attempts = 5
+min_match_ratio = 60  # scaled 0-100 in rapidfuzz, same threshold as find_stop_index
+
+_non_alnum = re.compile(r'[^0-9a-z]+')
+
+
+def normalize_stop_name(name):
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return _non_alnum.sub(' ', name.casefold()).strip()
+
+
+def build_stop_resolver(table, aliases=None):
+    # Station names map to the positions of their stops in the trips table stop list
+    stops_by_name = {}
+    for stop_idx, stop_name in enumerate(table.stop_names):
+        if stop_name:
+            stops_by_name.setdefault(normalize_stop_name(stop_name), set()).add(stop_idx)
+
+    return {
+        "stops_by_name": {name: frozenset(stops) for name, stops in stops_by_name.items()},
+        "names": sorted(stops_by_name),
+        "aliases": dict(aliases or {}),
+        "dirty": False,
+        "lock": threading.Lock(),
+    }
+
+
+def resolve_stop_names(resolver, stop_names):
+    # Returns {stop_name: frozenset of stop positions}, None for names that cannot be resolved
+    stops_by_name = resolver["stops_by_name"]
+    resolved = {}
+    unresolved = {}
+    for stop_name in set(stop_names):
+        normalized = normalize_stop_name(stop_name)
+        target = normalized if normalized in stops_by_name else resolver["aliases"].get(normalized)
+        if target in stops_by_name:
+            resolved[stop_name] = stops_by_name[target]
+        else:
+            unresolved.setdefault(normalized, []).append(stop_name)
+
+    for normalized, originals in unresolved.items():
+        match = process.extractOne(normalized, resolver["names"], scorer=fuzz.ratio, score_cutoff=min_match_ratio)
+        stops = None
+        if match:
+            stops = stops_by_name[match[0]]
+            with resolver["lock"]:
+                resolver["aliases"][normalized] = match[0]
+                resolver["dirty"] = True
+        for stop_name in originals:
+            resolved[stop_name] = stops
+    return resolved
+
+
+def find_stop_index_in(table, trip_idx, stop_positions, start=0):
+    # Index within the trip of the first stop (from start on) among the resolved stops
+    stop_index = table.stop_index
+    rows = table.stop_range(trip_idx)
+    for idx in range(start, len(rows)):
+        if stop_index[rows[idx]] in stop_positions:
+            return idx
+    return None
+
+
+def load_stop_aliases(bucket_name):
+    try:
+        return get_json(bucket_name, stop_aliases_path)
+    except FileNotFoundError:
+        return {}
+    except (IOError, json.JSONDecodeError) as e:
+        logging.warning("Could not load stop aliases: %s", e)
+        return {}
+
+
+def save_stop_aliases(resolver, bucket_name):
+    with resolver["lock"]:
+        if not resolver["dirty"]:
+            return
+        aliases = dict(resolver["aliases"])
+        resolver["dirty"] = False
+    try:
+        for _ in range(alias_save_attempts):
+            info = get_blob_info(bucket_name, stop_aliases_path)
+            generation = info["generation"] if info else 0
+            try:
+                stored = json.loads(get_bytes(bucket_name, stop_aliases_path, generation)) if info else {}
+                put_json(bucket_name, stop_aliases_path, dict(sorted({**stored, **aliases}.items())),
+                         indent=2, if_generation_match=generation)
+            except (FileNotFoundError, PreconditionFailed):
+                # Replaced by another instance since it was read: merge again
+                continue
+            with resolver["lock"]:
+                for name, target in stored.items():
+                    resolver["aliases"].setdefault(name, target)
+            return
+        raise IOError(f"{stop_aliases_path} kept changing while saving")
+    except (IOError, json.JSONDecodeError) as e:
+        logging.warning("Could not save stop aliases: %s", e)
+        with resolver["lock"]:
+            resolver["dirty"] = True
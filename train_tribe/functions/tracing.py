@@ -0,0 +1,158 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Lightweight request tracing. Each function invocation opens a trace (see main.py);
+# inside it, span() times a stage and count() adds to a counter. Spans and counters are
+# aggregated by name (calls, total and max time), so a trace stays small however many
+# legs or documents a request touches. When the request ends, a sampled trace is written
+# as one JSON line on stdout, which Cloud Logging ingests as a structured entry:
+#
+#   {"severity": "INFO", "message": "trace get_event_full_trip_data 412.3ms",
+#    "trace_name": ..., "duration_ms": ..., "spans": {name: {"calls", "total_ms", "max_ms"}},
+#    "counters": {name: value}, ...fields}
+#
+# Outside a trace, or in a trace that was not sampled, span() and count() cost next to
+# nothing. Handlers are wrapped with @traced (see main.py). Worker threads join the caller's trace through in_current_trace().
+# debug_payload() logs large values at DEBUG level only, formatted lazily and capped.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_PAYLOAD_LIMIT = int(os.environ.get("TRACE_PAYLOAD_LIMIT", "2000"))
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                entry = self.spans[name] = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0}
+            entry["calls"] += 1
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, duration):
+        spans = {
+            name: {"calls": entry["calls"], "total_ms": round(entry["total_ms"], 2), "max_ms": round(entry["max_ms"], 2)}
+            for name, entry in self.spans.items()
+        }
+        return {
+            "severity": "INFO",
+            "message": f"trace {self.name} {duration * 1000:.1f}ms",
+            "trace_name": self.name,
+            "duration_ms": round(duration * 1000, 2),
+            "spans": spans,
+            "counters": dict(self.counters),
+            **self.fields,
+        }
+
+
+@contextmanager
+def trace(name, **fields):
+    # Root of a request; fields are added to the emitted record (keep them small)
+    if random.random() >= TRACE_SAMPLE_RATE:
+        token = _current.set(None)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+    current = Trace(name, fields)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        try:
+            sys.stdout.write(json.dumps(current.record(time.perf_counter() - started), default=str) + "\n")
+            sys.stdout.flush()
+        except Exception as e:
+            logging.warning("Trace %s not emitted: %s", name, e)
+
+
+def traced(name):
+    # Decorator form of trace() for function handlers
+    def decorator(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with trace(name):
+                return fn(*args, **kwargs)
+        return run
+    return decorator
+
+
+@contextmanager
+def span(name):
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_span(name, time.perf_counter() - started)
+
+
+def add_span(name, seconds):
+    # For stages timed by the caller
+    current = _current.get()
+    if current is not None:
+        current.add_span(name, seconds)
+
+
+def count(name, value=1):
+    current = _current.get()
+    if current is not None:
+        current.count(name, value)
+
+
+def in_current_trace(fn):
+    # Wraps fn so that calls from other threads (executor workers) join the caller's trace
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+class _Capped:
+    # Formats the value only if the log record is actually emitted
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.value, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = repr(self.value)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text)} chars)"
+        return text
+
+
+def debug_payload(label, value, limit=None):
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("%s: %s", label, _Capped(value, limit or TRACE_PAYLOAD_LIMIT))
@@ -0,0 +1,64 @@
+import re
+
+# Index over GTFS trip_short_name values, built once per trips dataset version.
+# Lookup order is well defined and deterministic:
+#   1. exact short name
+#   2. normalized short name (case, spacing, punctuation and leading zeros ignored)
+#   3. numeric core of the short name (e.g. "RE 2415" and "2415A" both map to "2415")
+# Matches at levels 2 and 3 may span several GTFS keys: their trips are returned
+# in key order. Unlike the old substring scan, "24" never matches "2415".
+
+_non_alnum = re.compile(r'[^0-9A-Z]')
+_digit_runs = re.compile(r'\d+')
+
+
+def normalize_short_name(name):
+    normalized = _non_alnum.sub('', str(name).upper())
+    if normalized.isdigit():
+        normalized = normalized.lstrip('0') or '0'
+    return normalized
+
+
+def numeric_core(name):
+    runs = _digit_runs.findall(str(name))
+    if not runs:
+        return None
+    # Longest digit run, the last one on ties ("S5 24123" -> "24123")
+    core = max(reversed(runs), key=len)
+    return core.lstrip('0') or '0'
+
+
+def build_short_name_index(trips_by_short_name):
+    by_normalized = {}
+    by_core = {}
+    for key in sorted(trips_by_short_name, key=str):
+        if key is None:
+            continue
+        by_normalized.setdefault(normalize_short_name(key), []).append(key)
+        core = numeric_core(key)
+        if core is not None:
+            by_core.setdefault(core, []).append(key)
+
+    def merge(keys):
+        if len(keys) == 1:
+            return trips_by_short_name[keys[0]]
+        return [trip for key in keys for trip in trips_by_short_name[key]]
+
+    return {
+        "exact": trips_by_short_name,
+        "normalized": {k: merge(keys) for k, keys in by_normalized.items()},
+        "core": {k: merge(keys) for k, keys in by_core.items()},
+    }
+
+
+def lookup_short_name(index, trip_short_name):
+    trips = index["exact"].get(trip_short_name)
+    if trips:
+        return trips
+    trips = index["normalized"].get(normalize_short_name(trip_short_name))
+    if trips:
+        return trips
+    core = numeric_core(trip_short_name)
+    if core is not None:
+        return index["core"].get(core, [])
+    return []
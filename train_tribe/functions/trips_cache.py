@@ -0,0 +1,155 @@
+import array
+import json
+import os
+import logging
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from trips_table import TripsTable
+from bucket_manager import download_from_bucket, get_bytes, get_blob_info
+from trip_index import build_short_name_index
+from stop_resolver import build_stop_resolver, load_stop_aliases
+
+# Parsed trips datasets are kept in memory across invocations on a warm instance.
+# Entries are keyed on (bucket, blob) and tagged with the blob generation they were
+# loaded from: a new upload of the artifact gets a new generation and is reloaded.
+# TRIPS_CACHE_MAX_BYTES bounds the size of the loaded datasets in memory (tables,
+# indexes and resolver, see dataset_size), not the size of the artifacts.
+TRIPS_CACHE_MAX_BYTES = int(os.environ.get("TRIPS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+TRIPS_CACHE_REVALIDATE_SECONDS = float(os.environ.get("TRIPS_CACHE_REVALIDATE_SECONDS", 60))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_load_lock = threading.RLock()
+
+
+def group_trips_by_short_name(table):
+    # Group trip positions by short name to handle multiple trips with same short name
+    trips_by_short_name = {}
+    for trip_idx, trip_short_name in enumerate(table.trip_short_names):
+        trips_by_short_name.setdefault(trip_short_name, []).append(trip_idx)
+    return trips_by_short_name
+
+
+def _load_table(bucket_name, blob_name, generation):
+    # JSON artifacts are parsed and converted in memory
+    if not blob_name.endswith(".bin"):
+        return TripsTable.from_trips(json.loads(get_bytes(bucket_name, blob_name, generation)))
+
+    # Compact artifacts are memory-mapped from a local copy
+    fd, tmp_path = tempfile.mkstemp(suffix=".bin")
+    os.close(fd)
+    try:
+        download_from_bucket(bucket_name, blob_name, tmp_path, generation=generation)
+        # The mapping stays valid after the file is unlinked
+        return TripsTable.from_file(tmp_path)
+    finally:
+        os.remove(tmp_path)
+
+
+def _load_dataset(bucket_name, blob_name, info):
+    table = _load_table(bucket_name, blob_name, info["generation"])
+    trips_by_short_name = group_trips_by_short_name(table)
+    return {
+        "generation": info["generation"],
+        "table": table,
+        "trips_by_short_name": trips_by_short_name,
+        "short_name_index": build_short_name_index(trips_by_short_name),
+        "stop_resolver": build_stop_resolver(table, load_stop_aliases(bucket_name)),
+    }
+
+
+def dataset_size(dataset):
+    # Approximate bytes held in memory by a loaded dataset: every object reachable from
+    # it counted once, plus the mapped columns of compact tables (resident once read)
+    seen = set()
+    stack = [dataset]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, memoryview):
+            size += sys.getsizeof(obj) + obj.nbytes
+            continue
+        if isinstance(obj, (str, bytes, int, float, bool, array.array)) or obj is None:
+            size += sys.getsizeof(obj)
+            continue
+        if isinstance(obj, dict):
+            size += sys.getsizeof(obj)
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sys.getsizeof(obj)
+            stack.extend(obj)
+        elif isinstance(obj, TripsTable):
+            # The memory map itself is counted through the column views
+            size += sys.getsizeof(obj)
+            stack.extend(value for name, value in vars(obj).items() if name not in ("_buffer", "_running_lock"))
+    return size
+
+
+def _cached_entry(key, generation=None):
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    if generation is not None and entry["dataset"]["generation"] != generation:
+        return None
+    _cache.move_to_end(key)
+    return entry
+
+
+def _store(key, dataset, size):
+    if size > TRIPS_CACHE_MAX_BYTES:
+        logging.warning("Trips dataset %s (%d bytes in memory) exceeds the cache limit, not caching it", key[1], size)
+        return
+    _cache[key] = {"dataset": dataset, "size": size, "checked_at": time.monotonic()}
+    _cache.move_to_end(key)
+    total = sum(entry["size"] for entry in _cache.values())
+    while total > TRIPS_CACHE_MAX_BYTES and len(_cache) > 1:
+        evicted_key, evicted = _cache.popitem(last=False)
+        total -= evicted["size"]
+        logging.info("Evicted trips dataset %s from cache", evicted_key[1])
+
+
+def get_trips_dataset(bucket_name, blob_name):
+    key = (bucket_name, blob_name)
+
+    # Fast path: recently revalidated entry, no network round-trip at all
+    with _cache_lock:
+        entry = _cached_entry(key)
+        if entry and time.monotonic() - entry["checked_at"] < TRIPS_CACHE_REVALIDATE_SECONDS:
+            return entry["dataset"]
+
+    # Only one thread revalidates/loads at a time, the others reuse its result
+    with _load_lock:
+        info = get_blob_info(bucket_name, blob_name)
+        if info is None and blob_name.endswith(".bin"):
+            # Compact artifact not produced yet (jsonify not run since deploy): use the JSON export
+            logging.warning("%s not found, falling back to the JSON trips export", blob_name)
+            return get_trips_dataset(bucket_name, blob_name[:-len(".bin")] + ".json")
+        if info is None:
+            raise FileNotFoundError(f"gs://{bucket_name}/{blob_name}")
+
+        with _cache_lock:
+            entry = _cached_entry(key, info["generation"])
+            if entry:
+                entry["checked_at"] = time.monotonic()
+                return entry["dataset"]
+
+        logging.info("Loading trips dataset %s (generation %s)", blob_name, info["generation"])
+        dataset = _load_dataset(bucket_name, blob_name, info)
+
+        with _cache_lock:
+            _cache.pop(key, None)
+            _store(key, dataset, dataset_size(dataset))
+
+    return dataset
+
+
+def clear_trips_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,232 @@
+import array
+import json
+import mmap
+import struct
+import sys
+import threading
+from service_calendar import services_running_on
+
+# Compact, column-oriented trips artifact written by jsonify (maps/full_info_trips.bin).
+#
+# Layout: MAGIC, uint32 header length, JSON header, then int32 columns aligned to 8 bytes.
+# The header holds the interned string tables (trip ids, short names, stop ids, stop
+# names) and the offset/length of every column. Stop times are stored trip after trip:
+# the stops of trip t are rows trip_stop_offsets[t] to trip_stop_offsets[t + 1].
+# Times are seconds after midnight of the service day (GTFS allows values past 24h),
+# NO_TIME when missing. Columns are memory-mapped, nothing is parsed per stop on load.
+# Since version 2 the header may carry the service calendar (see service_calendar) and
+# trip_service holds the calendar position of each trip's service, NO_SERVICE if unknown.
+MAGIC = b"TTRIPS01"
+NO_TIME = -1
+NO_SERVICE = -1
+COLUMNS = ("trip_stop_offsets", "stop_index", "stop_sequence", "arrival", "departure", "trip_service")
+_ALIGN = 8
+
+
+def parse_gtfs_time(value):
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except (AttributeError, ValueError):
+        return NO_TIME
+
+
+def format_gtfs_time(seconds):
+    if seconds == NO_TIME:
+        return ""
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours:02d}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def to_int(value):
+    # GTFS integer fields (stop_sequence), 0 when missing or malformed
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class StopTable:
+    # Stops interned in order of first use, each stop_id once; used by the trips table
+    # and by the side tables of leg payloads (see leg_payloads)
+
+    def __init__(self, stops=()):
+        self.stop_ids = []
+        self.stop_names = []
+        self._positions = {}
+        for stop_id, stop_name in stops:
+            self.intern(stop_id, stop_name)
+
+    def intern(self, stop_id, stop_name):
+        position = self._positions.get(stop_id)
+        if position is None:
+            position = len(self.stop_ids)
+            self._positions[stop_id] = position
+            self.stop_ids.append(stop_id)
+            self.stop_names.append(stop_name)
+        return position
+
+    def position(self, stop_id):
+        return self._positions.get(stop_id)
+
+
+class TripsTableWriter:
+
+    def __init__(self, stops=(), calendar=None):
+        # stops: iterable of (stop_id, stop_name), interned up front so the stop
+        # table keeps the stops.txt order; calendar as built by build_service_calendar
+        self.calendar = calendar
+        self._service_positions = {service: idx for idx, service in enumerate(calendar["services"])} if calendar else {}
+        self.stops = StopTable(stops)
+        self.trip_ids = []
+        self.trip_short_names = []
+        self.columns = {name: array.array('i') for name in COLUMNS}
+        self.columns["trip_stop_offsets"].append(0)
+
+    def add_trip(self, trip_id, trip_short_name, stops, service_id=None):
+        columns = self.columns
+        for stop in stops:
+            columns["stop_index"].append(self.stops.intern(stop['stop_id'], stop.get('stop_name')))
+            columns["stop_sequence"].append(to_int(stop.get('stop_sequence')))
+            columns["arrival"].append(parse_gtfs_time(stop.get('arrival_time')))
+            columns["departure"].append(parse_gtfs_time(stop.get('departure_time')))
+        columns["trip_stop_offsets"].append(len(columns["stop_index"]))
+        columns["trip_service"].append(self._service_positions.get(service_id, NO_SERVICE))
+        self.trip_ids.append(trip_id)
+        self.trip_short_names.append(trip_short_name)
+
+    def _header(self, column_layout):
+        return {
+            "version": 2,
+            "trip_ids": self.trip_ids,
+            "trip_short_names": self.trip_short_names,
+            "stop_ids": self.stops.stop_ids,
+            "stop_names": self.stops.stop_names,
+            "calendar": self.calendar,
+            "columns": column_layout,
+        }
+
+    def write(self, path):
+        # Column offsets depend on the header size, which depends on the offsets:
+        # lay out the columns after a header with placeholder offsets, then grow
+        # the reserved space until the real header fits.
+        reserved = 0
+        while True:
+            offset = _align(len(MAGIC) + 4 + reserved)
+            layout = {}
+            for name in COLUMNS:
+                layout[name] = [offset, len(self.columns[name])]
+                offset = _align(offset + len(self.columns[name]) * 4)
+            header = json.dumps(self._header(layout), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if len(header) <= reserved:
+                break
+            reserved = len(header) + 64
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name in COLUMNS:
+                f.write(b'\0' * (layout[name][0] - f.tell()))
+                column = self.columns[name]
+                if sys.byteorder != 'little':
+                    column = array.array('i', column)
+                    column.byteswap()
+                column.tofile(f)
+
+    def to_table(self):
+        return TripsTable(self._header(None), dict(self.columns))
+
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class TripsTable:
+
+    def __init__(self, header, columns, buffer=None):
+        self.trip_ids = header["trip_ids"]
+        self.trip_short_names = header["trip_short_names"]
+        self.stop_ids = header["stop_ids"]
+        self.stop_names = header["stop_names"]
+        self.trip_stop_offsets = columns["trip_stop_offsets"]
+        self.stop_index = columns["stop_index"]
+        self.stop_sequence = columns["stop_sequence"]
+        self.arrival = columns["arrival"]
+        self.departure = columns["departure"]
+        # Version 1 tables have no calendar: every trip counts as running every day
+        self.calendar = header.get("calendar")
+        self.trip_service = columns.get("trip_service")
+        self._buffer = buffer  # keeps the memory map alive as long as the table
+        self._trip_positions = None
+        self._running_services = {}
+        self._running_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a trips table")
+        (header_len,) = struct.unpack_from('<I', buffer, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(buffer[header_start:header_start + header_len].decode('utf-8'))
+
+        view = memoryview(buffer)
+        columns = {}
+        for name in COLUMNS:
+            if name not in header["columns"]:
+                continue
+            offset, length = header["columns"][name]
+            if sys.byteorder == 'little':
+                columns[name] = view[offset:offset + length * 4].cast('i')
+            else:
+                column = array.array('i', view[offset:offset + length * 4].tobytes())
+                column.byteswap()
+                columns[name] = column
+        return cls(header, columns, buffer)
+
+    @classmethod
+    def from_trips(cls, trips):
+        # Builds a table from the JSON trips list (full_info_trips.json)
+        writer = TripsTableWriter()
+        for trip in trips:
+            writer.add_trip(trip['trip_id'], trip.get('trip_short_name'), trip['stops'])
+        return writer.to_table()
+
+    def trip_count(self):
+        return len(self.trip_ids)
+
+    def stop_range(self, trip_idx):
+        return range(self.trip_stop_offsets[trip_idx], self.trip_stop_offsets[trip_idx + 1])
+
+    def stop_count(self, trip_idx):
+        return self.trip_stop_offsets[trip_idx + 1] - self.trip_stop_offsets[trip_idx]
+
+    def trip_position(self, trip_id):
+        if self._trip_positions is None:
+            self._trip_positions = {trip_id: idx for idx, trip_id in enumerate(self.trip_ids)}
+        return self._trip_positions.get(trip_id)
+
+    def has_calendar(self):
+        return self.calendar is not None and self.trip_service is not None
+
+    def runs_on(self, trip_idx, day):
+        # day is a date or an ISO date string; trips with an unknown service always run
+        if not self.has_calendar():
+            return True
+        service = self.trip_service[trip_idx]
+        if service == NO_SERVICE:
+            return True
+        running = self._running_services.get(day)
+        if running is None:
+            with self._running_lock:
+                running = self._running_services.setdefault(day, services_running_on(self.calendar, day))
+        return service in running
+
+    def find_stop(self, trip_idx, stop_id):
+        # Row of stop_id within the trip, None if the trip does not call there
+        for row in self.stop_range(trip_idx):
+            if self.stop_ids[self.stop_index[row]] == stop_id:
+                return row
+        return None